@@ -0,0 +1,113 @@
+"""ログインしていない利用者(ゲスト)のカート
+
+ゲストのカートは {商品ID: 数量} を署名付きCookieに保存し、DBにもキャッシュにも書き込まない。
+サーバー側に状態を持たないので、ワーカーやサーバーが複数あっても共有の設定は要らず、
+キャッシュの追い出しでカートが消えることもない。ログイン・登録時にユーザーのカートへまとめて移す
+(merge_guest_cart)。Cookieの大きさを抑えるため、入れられる商品の種類には上限がある。
+
+設定(任意):
+    GUEST_CART_TIMEOUT      最後の更新から保持する秒数(既定 7日)
+    GUEST_CART_COOKIE_NAME  カートを入れるCookie名(既定 'guest_cart')
+    GUEST_CART_MAX_ITEMS    入れられる商品の種類の上限(既定 50)
+"""
+from django.conf import settings
+from django.core import signing
+from rest_framework import serializers
+
+from products.models import Product
+from .models import Cart, CartItem, fold_operations
+from .serializers import CartItemSerializer
+
+COOKIE_SALT = 'carts.guest'
+
+
+def get_timeout():
+    return getattr(settings, 'GUEST_CART_TIMEOUT', 7 * 24 * 60 * 60)
+
+
+def get_cookie_name():
+    return getattr(settings, 'GUEST_CART_COOKIE_NAME', 'guest_cart')
+
+
+def get_max_items():
+    return getattr(settings, 'GUEST_CART_MAX_ITEMS', 50)
+
+
+class GuestCart:
+    def __init__(self, quantities=None, stored=False):
+        self.quantities = quantities or {}
+        self.stored = stored  # Cookieにカートがあったか
+        self.changed = False
+
+    @classmethod
+    def load(cls, request):
+        """Cookieからカートを読み込む(Cookieがない・期限切れ・改ざんされている場合は空のカート)"""
+        value = request.COOKIES.get(get_cookie_name())
+        if value is None:
+            return cls()
+        try:
+            items = signing.loads(value, salt=COOKIE_SALT, max_age=get_timeout())
+        except signing.BadSignature:
+            return cls()
+        return cls({product_id: quantity for product_id, quantity in items}, stored=True)
+
+    def __contains__(self, product_id):
+        return product_id in self.quantities
+
+    def apply_operations(self, operations, product_ids):
+        """Cart.apply_operations と同じ操作を適用する(product_ids にない商品は無視する)"""
+        quantities = fold_operations(self.quantities, [
+            operation for operation in operations if operation['product_id'] in product_ids
+        ])
+        quantities = {product_id: quantity for product_id, quantity in quantities.items() if quantity}
+        if len(quantities) > max(len(self.quantities), get_max_items()):
+            raise serializers.ValidationError(
+                f'ログインしていない場合、カートに入れられる商品は{get_max_items()}種類までです'
+            )
+        self.quantities = quantities
+        self.changed = True
+
+    def save(self, response):
+        """変更があればカートをCookieに保存する"""
+        if not self.changed:
+            return
+        # JSONのキーは文字列になるため、[商品ID, 数量] の組のリストにする
+        value = signing.dumps(list(self.quantities.items()), salt=COOKIE_SALT, compress=True)
+        response.set_cookie(get_cookie_name(), value, max_age=get_timeout(), httponly=True, samesite='Lax')
+
+    def clear(self, response):
+        response.delete_cookie(get_cookie_name(), samesite='Lax')
+
+    def to_representation(self, context=None):
+        """CartSerializer と同じ形のデータを返す(商品は1クエリで取得)"""
+        products = Product.objects.for_list().in_bulk(self.quantities)
+        items = [
+            CartItem(product=products[product_id], quantity=quantity)
+            for product_id, quantity in self.quantities.items()
+            if product_id in products  # 削除された商品は除く
+        ]
+        return {
+            'id': None,
+            'items': CartItemSerializer(items, many=True, context=context).data,
+            'total_price': sum(item.get_subtotal() for item in items),
+            'item_count': sum(item.quantity for item in items),
+        }
+
+
+def merge_guest_cart(request, user, response):
+    """ゲストのカートをユーザーのカートに加えて、ゲストのカートを消す
+
+    同じ商品がすでにあれば数量を足す。一括UPSERTのため商品数によらずクエリ数は一定。
+    """
+    guest_cart = GuestCart.load(request)
+    if not guest_cart.stored:
+        return
+    if guest_cart.quantities:
+        prices = dict(Product.objects.filter(pk__in=guest_cart.quantities).values_list('pk', 'price'))
+        if prices:
+            cart, _ = Cart.objects.get_or_create(user=user)
+            cart.apply_operations([
+                {'action': 'add', 'product_id': product_id, 'quantity': guest_cart.quantities[product_id]}
+                for product_id in prices  # 削除された商品は除く
+            ], prices)
+    guest_cart.clear(response)
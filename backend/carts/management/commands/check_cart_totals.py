@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.db.models import F, Q
+
+from carts.models import Cart
+
+
+class Command(BaseCommand):
+    help = 'カートに保存した合計金額・商品点数がアイテムの集計と一致しているか確認する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='一致しないカートを集計し直す')
+        parser.add_argument('--show', type=int, default=20, help='表示する不一致カートの最大件数')
+
+    def handle(self, *args, **options):
+        mismatched = Cart.objects.with_computed_totals().filter(
+            ~Q(total_price=F('computed_total_price')) | ~Q(item_count=F('computed_item_count'))
+        )
+        rows = list(mismatched.values_list(
+            'pk', 'total_price', 'computed_total_price', 'item_count', 'computed_item_count'
+        ))
+        if not rows:
+            self.stdout.write(self.style.SUCCESS('すべてのカートの合計が一致しています'))
+            return
+
+        self.stdout.write(self.style.WARNING(f'合計が一致しないカート: {len(rows)}件'))
+        for pk, total_price, computed_total_price, item_count, computed_item_count in rows[:options['show']]:
+            self.stdout.write(
+                f'  カート {pk}: 合計金額 {total_price} (集計 {computed_total_price}) / '
+                f'点数 {item_count} (集計 {computed_item_count})'
+            )
+
+        if options['fix']:
+            fixed = Cart.objects.filter(pk__in=[row[0] for row in rows]).recalculate_totals()
+            self.stdout.write(self.style.SUCCESS(f'{fixed}件のカートを集計し直しました'))
@@ -0,0 +1,38 @@
+# Generated by Django 5.2 on 2026-10-17 14:55
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def fill_totals(apps, schema_editor):
+    """既存のカートの合計金額・点数をアイテムから集計する"""
+    Cart = apps.get_model('carts', 'Cart')
+    CartItem = apps.get_model('carts', 'CartItem')
+    items = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+    Cart.objects.update(
+        total_price=Coalesce(Subquery(items.annotate(total=Sum(F('product__price') * F('quantity'))).values('total')), 0),
+        item_count=Coalesce(Subquery(items.annotate(count=Sum('quantity')).values('count')), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carts', '0001_initial'),
+        ('products', '0003_product_product_created_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='商品点数'),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='total_price',
+            field=models.PositiveIntegerField(default=0, verbose_name='合計金額'),
+        ),
+        migrations.RunPython(fill_totals, migrations.RunPython.noop),
+    ]
@@ -1,6 +1,33 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, OuterRef, Prefetch, Subquery, Sum, prefetch_related_objects
+from django.db.models.functions import Coalesce
 from django.conf import settings
-from products.models import Product
+from django.utils import timezone
+from products.models import PRODUCT_LIST_COLUMNS, Product
+
+class CartItemQuerySet(models.QuerySet):
+    def with_subtotal(self):
+        """小計(価格×数量)をDB側で計算して付与"""
+        return self.annotate(subtotal=F('product__price') * F('quantity'))
+
+    def for_display(self):
+        """シリアライズ用に商品・カテゴリー・小計を必要なカラムだけまとめて取得"""
+        return (
+            self.select_related('product__category')
+            .only('id', 'cart', 'quantity', *[f'product__{column}' for column in PRODUCT_LIST_COLUMNS])
+            .with_subtotal()
+        )
+
+class CartQuerySet(models.QuerySet):
+    def with_computed_totals(self):
+        """アイテムから集計し直した合計金額・点数を computed_total_price / computed_item_count として付与"""
+        total_price, item_count = computed_totals()
+        return self.annotate(computed_total_price=total_price, computed_item_count=item_count)
+
+    def recalculate_totals(self):
+        """合計金額・点数をアイテムから集計し直して保存する(1クエリ)"""
+        total_price, item_count = computed_totals()
+        return self.update(total_price=total_price, item_count=item_count, updated_at=timezone.now())
 
 class Cart(models.Model):
     user = models.OneToOneField(
@@ -11,14 +38,85 @@ class Cart(models.Model):
     )
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='作成日時')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='更新日時')
+    # アイテムの変更時に差分で更新する集計値(表示のたびにアイテムを集計しない)
+    total_price = models.PositiveIntegerField(default=0, verbose_name='合計金額')
+    item_count = models.PositiveIntegerField(default=0, verbose_name='商品点数')
+
+    objects = CartQuerySet.as_manager()
 
     class Meta:
         verbose_name = 'カート'
         verbose_name_plural = 'カート'
 
-    def get_total_price(self):
-        """カート内の商品の合計金額を計算"""
-        return sum(item.get_subtotal() for item in self.items.all())
+    def prefetch_items(self):
+        """小計付きのカート内アイテムを1クエリで読み込む"""
+        prefetch_related_objects([self], Prefetch('items', queryset=CartItem.objects.for_display()))
+        return self
+
+    def lock(self):
+        """カートの行をロックし、合計金額・点数をロックした時点の値にする(トランザクション内で呼ぶ)
+
+        アイテムの変更はカート単位で直列にする。アイテムの行だけのロックでは、まだカートにない商品を
+        同時に追加したときに両方が「なし」と読んで上書きし合い、合計金額だけが二重に加算される。
+        """
+        self.total_price, self.item_count = (
+            Cart.objects.select_for_update().values_list('total_price', 'item_count').get(pk=self.pk)
+        )
+
+    def add_to_totals(self, amount, count):
+        """合計金額に amount を、商品点数に count を加える(減らす場合は負の値。lock() の後に呼ぶ)
+
+        ロック中は他から変更されないため、読み直さずに手元の値にも同じ差分を加える。
+        """
+        now = timezone.now()
+        Cart.objects.filter(pk=self.pk).update(
+            total_price=F('total_price') + amount,
+            item_count=F('item_count') + count,
+            updated_at=now
+        )
+        self.total_price += amount
+        self.item_count += count
+        self.updated_at = now
+
+    def apply_operations(self, operations, prices):
+        """追加・数量変更・削除の操作をまとめて適用する
+
+        カートをロックして現在のアイテムに操作を畳み込み、一括UPSERTと一括DELETEで書き込む。
+        prices は対象商品の {商品ID: 価格}(存在しない商品を含めないこと)。
+        """
+        with transaction.atomic():
+            self.lock()
+            current = dict(
+                self.items.filter(product_id__in=prices)
+                .values_list('product_id', 'quantity')
+            )
+            quantities = fold_operations(current, operations)
+
+            upserts = [
+                CartItem(cart=self, product_id=product_id, quantity=quantity)
+                for product_id, quantity in quantities.items()
+                if quantity and quantity != current.get(product_id)
+            ]
+            removed = [product_id for product_id, quantity in quantities.items() if not quantity and product_id in current]
+
+            if upserts:
+                CartItem.objects.bulk_create(
+                    upserts,
+                    update_conflicts=True,
+                    unique_fields=['cart', 'product'],
+                    update_fields=['quantity', 'updated_at']
+                )
+            if removed:
+                CartItem.objects.filter(cart=self, product_id__in=removed).delete()
+
+            differences = {
+                product_id: quantity - current.get(product_id, 0)
+                for product_id, quantity in quantities.items()
+            }
+            self.add_to_totals(
+                sum(prices[product_id] * difference for product_id, difference in differences.items()),
+                sum(differences.values())
+            )
 
 class CartItem(models.Model):
     cart = models.ForeignKey(
@@ -36,6 +134,8 @@ class CartItem(models.Model):
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='作成日時')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='更新日時')
 
+    objects = CartItemQuerySet.as_manager()
+
     class Meta:
         verbose_name = 'カート内アイテム'
         verbose_name_plural = 'カート内アイテム'
@@ -43,4 +143,31 @@ class CartItem(models.Model):
 
     def get_subtotal(self):
         """小計を計算"""
+        if hasattr(self, 'subtotal'):  # with_subtotal()でDB側計算済み
+            return self.subtotal
         return self.product.price * self.quantity
+
+
+def fold_operations(quantities, operations):
+    """{商品ID: 数量} に操作を先頭から順に適用した結果を返す(削除した商品は数量0)
+
+    updateはカートにない商品なら追加する。
+    """
+    quantities = dict(quantities)
+    for operation in operations:
+        product_id = operation['product_id']
+        if operation['action'] == 'add':
+            quantities[product_id] = quantities.get(product_id, 0) + operation['quantity']
+        elif operation['action'] == 'update':
+            quantities[product_id] = operation['quantity']
+        else:
+            quantities[product_id] = 0
+    return quantities
+
+
+def computed_totals():
+    """カートごとの合計金額・点数をアイテムから集計するサブクエリ"""
+    items = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+    total_price = items.annotate(total=Sum(F('product__price') * F('quantity'))).values('total')
+    item_count = items.annotate(count=Sum('quantity')).values('count')
+    return Coalesce(Subquery(total_price), 0), Coalesce(Subquery(item_count), 0)
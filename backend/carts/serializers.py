@@ -1,10 +1,11 @@
 from rest_framework import serializers
+from ec_shop.performance import TimedSerializerMixin
 from .models import Cart, CartItem
-from products.serializers import ProductSerializer
+from products.serializers import ProductListSerializer
 from products.models import Product
 
-class CartItemSerializer(serializers.ModelSerializer):
-    product = ProductSerializer(read_only=True)
+class CartItemSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    product = ProductListSerializer(read_only=True)
     product_id = serializers.PrimaryKeyRelatedField(
         source='product',
         queryset=Product.objects.all(),
@@ -20,14 +21,41 @@ class CartItemSerializer(serializers.ModelSerializer):
     def get_subtotal(self, obj):
         return obj.get_subtotal()
 
-class CartSerializer(serializers.ModelSerializer):
+class CartSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     items = CartItemSerializer(many=True, read_only=True)
-    total_price = serializers.SerializerMethodField()
 
     class Meta:
         model = Cart
-        fields = ['id', 'items', 'total_price']
-        read_only_fields = ['id']
+        fields = ['id', 'items', 'total_price', 'item_count']
+        read_only_fields = ['id', 'total_price', 'item_count']
+
+class CartOperationSerializer(serializers.Serializer):
+    """まとめて更新する操作1件分"""
+    ACTIONS = ['add', 'update', 'remove']
+
+    action = serializers.ChoiceField(choices=ACTIONS)
+    product_id = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=1, required=False)
+
+    def validate(self, attrs):
+        if attrs['action'] == 'update' and 'quantity' not in attrs:
+            raise serializers.ValidationError({'quantity': 'updateにはquantityが必要です'})
+        if attrs['action'] == 'add':
+            attrs.setdefault('quantity', 1)
+        return attrs
+
+class CartBatchSerializer(serializers.Serializer):
+    operations = serializers.ListField(
+        child=CartOperationSerializer(),
+        allow_empty=False,
+        max_length=200
+    )
 
-    def get_total_price(self, obj):
-        return obj.get_total_price() 
\ No newline at end of file
+    def validate_operations(self, operations):
+        # 商品の存在確認と価格の取得を1クエリで行う
+        product_ids = {operation['product_id'] for operation in operations}
+        self.prices = dict(Product.objects.filter(pk__in=product_ids).values_list('pk', 'price'))
+        missing = sorted(product_ids - set(self.prices))
+        if missing:
+            raise serializers.ValidationError(f'存在しない商品です: {missing}')
+        return operations
@@ -0,0 +1,31 @@
+"""商品の価格変更・削除時に、その商品が入っているカートの合計金額を集計し直す"""
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from products.models import Product
+from products.signals import prices_changed
+from .models import Cart
+
+
+@receiver(post_save, sender=Product)
+def update_totals_on_price_change(sender, instance, created, **kwargs):
+    previous_price = getattr(instance, '_previous_price', None)  # products.signals で保存前に控えた価格
+    if not created and previous_price is not None and previous_price != instance.price:
+        Cart.objects.filter(items__product=instance).recalculate_totals()
+
+
+@receiver(prices_changed)
+def update_totals_on_bulk_price_change(sender, product_ids, **kwargs):
+    Cart.objects.filter(items__product__in=product_ids).recalculate_totals()
+
+
+@receiver(pre_delete, sender=Product)
+def remember_carts(sender, instance, **kwargs):
+    # 削除後はカートアイテムも消えて対象のカートが分からなくなるため、先に控えておく
+    instance._cart_ids = list(Cart.objects.filter(items__product=instance).values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Product)
+def update_totals_on_delete(sender, instance, **kwargs):
+    if getattr(instance, '_cart_ids', None):
+        Cart.objects.filter(pk__in=instance._cart_ids).recalculate_totals()
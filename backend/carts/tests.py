@@ -1,3 +1,305 @@
-from django.test import TestCase
+import threading
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection, connections
+from django.core.cache import caches
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from ec_shop.testing import RouteBudgetMixin, retry_on_lock
+
+from products.models import Category, Product
+from .guest import get_cookie_name
+from . import models
+from .models import Cart, CartItem
+
+User = get_user_model()
+
+
+class CartQueryCountTests(TestCase):
+    """カートのシリアライズがアイテム数に比例したクエリを発行しないことを確認する"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.cart = Cart.objects.create(user=self.user)
+        self.category = Category.objects.create(name='食品')
+
+    def add_items(self, count):
+        for i in range(count):
+            product = Product.objects.create(
+                name=f'商品{i}', description='', price=100 + i, stock=10, category=self.category
+            )
+            self.client.post('/api/carts/add_item/', {'product_id': product.pk, 'quantity': 2})
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/carts/')
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response.data
+
+    def test_list_query_count_is_constant(self):
+        self.add_items(1)
+        small, _ = self.count_queries()
+        self.add_items(30)
+        large, data = self.count_queries()
+        self.assertEqual(large, small)
+        self.assertEqual(len(data['items']), 31)
+
+    def test_total_price_matches_items(self):
+        self.add_items(3)
+        _, data = self.count_queries()
+        self.assertEqual(data['total_price'], sum(item['subtotal'] for item in data['items']))
+        self.assertEqual(data['total_price'], (100 + 101 + 102) * 2)
+        self.assertEqual(data['item_count'], 6)
+
+
+class CartTotalsTests(TestCase):
+    """カートに保存した合計金額・点数の更新"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.apple = Product.objects.create(name='りんご', description='', price=100, stock=10)
+        self.pear = Product.objects.create(name='なし', description='', price=250, stock=10)
+
+    def post(self, action, **data):
+        response = self.client.post(f'/api/carts/{action}/', data)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_totals_follow_item_changes(self):
+        self.post('add_item', product_id=self.apple.pk, quantity=2)
+        self.post('add_item', product_id=self.apple.pk, quantity=1)
+        data = self.post('add_item', product_id=self.pear.pk, quantity=1)
+        self.assertEqual((data['total_price'], data['item_count']), (550, 4))
+
+        data = self.post('update_quantity', product_id=self.apple.pk, quantity=5)
+        self.assertEqual((data['total_price'], data['item_count']), (750, 6))
+
+        data = self.post('remove_item', product_id=self.pear.pk)
+        self.assertEqual((data['total_price'], data['item_count']), (500, 5))
+
+    def test_price_change_and_product_deletion_update_carts(self):
+        self.post('add_item', product_id=self.apple.pk, quantity=3)
+        self.post('add_item', product_id=self.pear.pk, quantity=1)
+
+        self.apple.price = 120
+        self.apple.save()
+        cart = Cart.objects.get(user=self.user)
+        self.assertEqual((cart.total_price, cart.item_count), (610, 4))
+
+        self.pear.delete()
+        cart.refresh_from_db()
+        self.assertEqual((cart.total_price, cart.item_count), (360, 3))
+
+    def test_batch_applies_operations_in_order(self):
+        self.post('add_item', product_id=self.pear.pk, quantity=2)
+        banana = Product.objects.create(name='バナナ', description='', price=50, stock=10)
+        response = self.client.post('/api/carts/batch/', {'operations': [
+            {'action': 'add', 'product_id': self.apple.pk, 'quantity': 2},
+            {'action': 'add', 'product_id': self.apple.pk},
+            {'action': 'update', 'product_id': banana.pk, 'quantity': 4},
+            {'action': 'remove', 'product_id': self.pear.pk},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        quantities = {item['product']['id']: item['quantity'] for item in response.data['items']}
+        self.assertEqual(quantities, {self.apple.pk: 3, banana.pk: 4})
+        self.assertEqual((response.data['total_price'], response.data['item_count']), (500, 7))
+
+    def test_batch_query_count_is_independent_of_operations(self):
+        products = [
+            Product.objects.create(name=f'商品{i}', description='', price=10, stock=10) for i in range(30)
+        ]
+        Cart.objects.create(user=self.user)
+
+        def batch(count):
+            operations = [{'action': 'add', 'product_id': product.pk} for product in products[:count]]
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.post('/api/carts/batch/', {'operations': operations}, format='json')
+            self.assertEqual(response.status_code, 200)
+            return len(ctx.captured_queries)
+
+        self.assertEqual(batch(2), batch(30))
+        self.assertEqual(Cart.objects.get(user=self.user).item_count, 32)
+
+    def test_batch_rejects_unknown_products_without_changes(self):
+        response = self.client.post('/api/carts/batch/', {'operations': [
+            {'action': 'add', 'product_id': self.apple.pk},
+            {'action': 'add', 'product_id': 999999},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_check_command_fixes_drift(self):
+        self.post('add_item', product_id=self.apple.pk, quantity=3)
+        Cart.objects.update(total_price=1, item_count=1)
+
+        out = StringIO()
+        call_command('check_cart_totals', '--fix', stdout=out)
+        self.assertIn('1件', out.getvalue())
+        cart = Cart.objects.get(user=self.user)
+        self.assertEqual((cart.total_price, cart.item_count), (300, 3))
+
+
+class GuestCartTests(TestCase):
+    """ログインしていない利用者のカートと、ログイン時の引き継ぎ"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.apple = Product.objects.create(name='りんご', description='', price=100, stock=10)
+        self.pear = Product.objects.create(name='なし', description='', price=250, stock=10)
+
+    def post(self, action, data):
+        response = self.client.post(f'/api/carts/{action}/', data, format='json')
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_guest_cart_does_not_write_to_database(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.post('add_item', {'product_id': self.apple.pk, 'quantity': 2})
+            self.post('batch', {'operations': [
+                {'action': 'add', 'product_id': self.pear.pk},
+                {'action': 'update', 'product_id': self.apple.pk, 'quantity': 3},
+            ]})
+        self.assertTrue(all(query['sql'].startswith('SELECT') for query in ctx.captured_queries))
+        self.assertFalse(Cart.objects.exists())
+
+        data = self.client.get('/api/carts/').data
+        self.assertEqual((data['total_price'], data['item_count']), (550, 4))
+        data = self.post('remove_item', {'product_id': self.pear.pk})
+        self.assertEqual([item['product']['id'] for item in data['items']], [self.apple.pk])
+
+    def test_guest_cart_is_kept_in_cookie(self):
+        self.post('add_item', {'product_id': self.apple.pk, 'quantity': 2})
+        # サーバー側のキャッシュ(ワーカーごとのローカルメモリなど)には依存しない
+        caches['default'].clear()
+        data = self.client.get('/api/carts/').data
+        self.assertEqual(data['item_count'], 2)
+
+        # 改ざんされたCookieは空のカートとして扱う
+        self.client.cookies[get_cookie_name()] = self.client.cookies[get_cookie_name()].value + 'x'
+        data = self.client.get('/api/carts/').data
+        self.assertEqual(data['items'], [])
+
+    @override_settings(GUEST_CART_MAX_ITEMS=1)
+    def test_guest_cart_item_limit(self):
+        self.post('add_item', {'product_id': self.apple.pk, 'quantity': 1})
+        response = self.client.post('/api/carts/add_item/', {'product_id': self.pear.pk}, format='json')
+        self.assertEqual(response.status_code, 400)
+        data = self.post('add_item', {'product_id': self.apple.pk, 'quantity': 1})
+        self.assertEqual(data['item_count'], 2)
+
+    def test_non_numeric_input_is_rejected(self):
+        for action, data in [
+            ('remove_item', {'product_id': 'abc'}),
+            ('update_quantity', {'product_id': 'abc', 'quantity': 1}),
+            ('update_quantity', {'product_id': self.apple.pk, 'quantity': 'many'}),
+            ('update_quantity', {'product_id': self.apple.pk, 'quantity': -1}),
+        ]:
+            with self.subTest(action=action, data=data):
+                response = self.client.post(f'/api/carts/{action}/', data, format='json')
+                self.assertEqual(response.status_code, 400)
+
+    def test_login_merges_guest_cart(self):
+        user = User.objects.create_user(username='buyer', password='pass')
+        cart = Cart.objects.create(user=user)
+        cart.apply_operations([{'action': 'add', 'product_id': self.apple.pk, 'quantity': 1}], {self.apple.pk: 100})
+
+        self.post('add_item', {'product_id': self.apple.pk, 'quantity': 2})
+        self.post('add_item', {'product_id': self.pear.pk, 'quantity': 1})
+        response = self.client.post('/api/users/login_api/', {'username': 'buyer', 'password': 'pass'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.cookies[get_cookie_name()].value, '')
+
+        data = self.client.get('/api/carts/').data
+        quantities = {item['product']['id']: item['quantity'] for item in data['items']}
+        self.assertEqual(quantities, {self.apple.pk: 3, self.pear.pk: 1})
+        self.assertEqual((data['total_price'], data['item_count']), (550, 4))
+
+
+class ConcurrentCartUpdateTests(TransactionTestCase):
+    """まだカートにない商品を同時に追加しても、合計金額がアイテムとずれないことを確認する"""
+
+    def test_concurrent_batches_keep_totals_consistent(self):
+        user = User.objects.create_user(username='buyer', password='pass')
+        product = Product.objects.create(name='りんご', description='', price=100, stock=10)
+        Cart.objects.create(user=user)
+        # 両方のリクエストがアイテムを読んだ後に書き込むよう、読み取りと書き込みの間で待ち合わせる
+        # (カートをロックしていれば後のリクエストは読み取り前で待つため、待ち合わせは時間切れになる)
+        barrier = threading.Barrier(2, timeout=1)
+        fold_operations = models.fold_operations
+
+        def fold_after_both_read(current, operations):
+            try:
+                barrier.wait()
+            except threading.BrokenBarrierError:
+                pass
+            return fold_operations(current, operations)
+
+        def add():
+            try:
+                retry_on_lock(lambda: Cart.objects.get(user=user).apply_operations(
+                    [{'action': 'add', 'product_id': product.pk, 'quantity': 2}], {product.pk: product.price}
+                ))
+            finally:
+                connections.close_all()
+
+        with mock.patch.object(models, 'fold_operations', fold_after_both_read):
+            threads = [threading.Thread(target=add) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        cart = Cart.objects.with_computed_totals().get(user=user)
+        self.assertEqual(CartItem.objects.get(cart=cart).quantity, 4)
+        self.assertEqual((cart.total_price, cart.item_count), (400, 4))
+        self.assertEqual((cart.computed_total_price, cart.computed_item_count), (400, 4))
+
+
+# ルートごとのクエリ数の予算(「URL名 メソッド」: 上限)。数え方は ec_shop/tests.py を参照。
+QUERY_BUDGETS = {
+    'cart-list GET': 2,
+    # 商品・カートの取得 2、カートのロック・アイテムの取得と更新・合計の更新 4、SAVEPOINT / RELEASE 2、
+    # レスポンスのアイテム 1(他の変更系も同じ構成で、商品の取得がないものは1件少ない)
+    'cart-add-item POST': 9,
+    'cart-update-quantity POST': 8,
+    'cart-remove-item POST': 8,
+    'cart-batch POST': 9,
+}
+
+
+class QueryBudgetTests(RouteBudgetMixin, TestCase):
+    """カートのAPIのクエリ数がデータ量によらず一定で、予算以内であることを確認する"""
+
+    query_budgets = QUERY_BUDGETS
+
+    def test_cart_list_get(self):
+        self.assertRouteBudget('cart-list GET', lambda _: self.client.get('/api/carts/'), self.fill_cart)
+
+    def test_cart_add_item_post(self):
+        self.assertRouteBudget('cart-add-item POST', lambda product: self.client.post(
+            '/api/carts/add_item/', {'product_id': product.pk, 'quantity': 1}, format='json'
+        ), lambda n: self.fill_cart(n)[0])
+
+    def test_cart_update_quantity_post(self):
+        self.assertRouteBudget('cart-update-quantity POST', lambda product: self.client.post(
+            '/api/carts/update_quantity/', {'product_id': product.pk, 'quantity': 3}, format='json'
+        ), lambda n: self.fill_cart(n)[0])
+
+    def test_cart_remove_item_post(self):
+        self.assertRouteBudget('cart-remove-item POST', lambda product: self.client.post(
+            '/api/carts/remove_item/', {'product_id': product.pk}, format='json'
+        ), lambda n: self.fill_cart(n)[0])
+
+    def test_cart_batch_post(self):
+        self.assertRouteBudget('cart-batch POST', lambda products: self.client.post('/api/carts/batch/', {
+            'operations': [{'action': 'add', 'product_id': product.pk, 'quantity': 1} for product in products]
+        }, format='json'), self.make_products)
@@ -2,16 +2,25 @@ from django.shortcuts import render
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import AllowAny
+from django.http import Http404
 from django.shortcuts import get_object_or_404
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from .guest import GuestCart
 from .models import Cart, CartItem
-from .serializers import CartSerializer, CartItemSerializer
+from .serializers import CartSerializer, CartItemSerializer, CartBatchSerializer, CartOperationSerializer
 
 # Create your views here.
 
 class CartViewSet(viewsets.GenericViewSet):
+    """カートAPI
+
+    ログインしていない場合はゲストのカート(carts/guest.py)を使い、DBには書き込まない。
+    """
     serializer_class = CartSerializer
-    permission_classes = [IsAuthenticated]
+    permission_classes = [AllowAny]
 
     def get_queryset(self):
         return Cart.objects.filter(user=self.request.user)
@@ -20,42 +29,72 @@ class CartViewSet(viewsets.GenericViewSet):
         cart, _ = Cart.objects.get_or_create(user=self.request.user)
         return cart
 
+    def locked_items(self, cart):
+        """合計金額の差分を正しく計算できるよう、カートをロックしてからアイテムを取得する(トランザクション内で呼ぶ)"""
+        cart.lock()
+        return CartItem.objects.filter(cart=cart).select_related('product')
+
+    def get_cart_data(self, cart):
+        """アイテムを1クエリで読み込んでからカートをシリアライズ"""
+        return self.get_serializer(cart.prefetch_items()).data
+
+    def is_guest(self):
+        return not self.request.user.is_authenticated
+
+    def guest_response(self, guest_cart, operations=(), product_ids=()):
+        """ゲストのカートに操作を適用して返す"""
+        if operations:
+            guest_cart.apply_operations(operations, product_ids)
+        response = Response(guest_cart.to_representation(self.get_serializer_context()))
+        guest_cart.save(response)
+        return response
+
     def list(self, request):
         """カートの内容を取得"""
+        if self.is_guest():
+            return self.guest_response(GuestCart.load(request))
         cart = self.get_or_create_cart()
-        serializer = self.get_serializer(cart)
-        return Response(serializer.data)
+        return Response(self.get_cart_data(cart))
 
     @action(detail=False, methods=['post'])
     def add_item(self, request):
         """商品をカートに追加"""
-        cart = self.get_or_create_cart()
         serializer = CartItemSerializer(data=request.data)
         
         if serializer.is_valid():
             product = serializer.validated_data['product']
             quantity = serializer.validated_data.get('quantity', 1)
+
+            if self.is_guest():
+                return self.guest_response(
+                    GuestCart.load(request),
+                    [{'action': 'add', 'product_id': product.pk, 'quantity': quantity}],
+                    {product.pk}
+                )
             
-            # 既存のカートアイテムがあれば数量を更新、なければ新規作成
-            cart_item, created = CartItem.objects.get_or_create(
-                cart=cart,
-                product=product,
-                defaults={'quantity': quantity}
-            )
-            
-            if not created:
-                cart_item.quantity += quantity
-                cart_item.save()
+            cart = self.get_or_create_cart()
+            with transaction.atomic():
+                cart.lock()  # 同じ商品の同時追加で合計金額だけが二重に加算されないようにする
+                # 既存のカートアイテムがあれば数量を更新、なければ新規作成
+                cart_item, created = CartItem.objects.get_or_create(
+                    cart=cart,
+                    product=product,
+                    defaults={'quantity': quantity}
+                )
+
+                if not created:
+                    CartItem.objects.filter(pk=cart_item.pk).update(
+                        quantity=F('quantity') + quantity, updated_at=timezone.now()
+                    )
+                cart.add_to_totals(product.price * quantity, quantity)
             
-            cart_serializer = self.get_serializer(cart)
-            return Response(cart_serializer.data)
+            return Response(self.get_cart_data(cart))
         
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     @action(detail=False, methods=['post'])
     def remove_item(self, request):
         """商品をカートから削除"""
-        cart = self.get_or_create_cart()
         product_id = request.data.get('product_id')
         
         if not product_id:
@@ -63,17 +102,29 @@ class CartViewSet(viewsets.GenericViewSet):
                 {'error': 'product_id is required'},
                 status=status.HTTP_400_BAD_REQUEST
             )
+
+        # 数値でない値は400にする
+        operation = CartOperationSerializer(data={'action': 'remove', 'product_id': product_id})
+        operation.is_valid(raise_exception=True)
+        product_id = operation.validated_data['product_id']
+
+        if self.is_guest():
+            guest_cart = GuestCart.load(request)
+            if product_id not in guest_cart:
+                raise Http404
+            return self.guest_response(guest_cart, [operation.validated_data], {product_id})
         
-        cart_item = get_object_or_404(CartItem, cart=cart, product_id=product_id)
-        cart_item.delete()
+        cart = self.get_or_create_cart()
+        with transaction.atomic():
+            cart_item = get_object_or_404(self.locked_items(cart), product_id=product_id)
+            cart_item.delete()
+            cart.add_to_totals(-cart_item.product.price * cart_item.quantity, -cart_item.quantity)
         
-        cart_serializer = self.get_serializer(cart)
-        return Response(cart_serializer.data)
+        return Response(self.get_cart_data(cart))
 
     @action(detail=False, methods=['post'])
     def update_quantity(self, request):
         """カート内の商品の数量を更新"""
-        cart = self.get_or_create_cart()
         product_id = request.data.get('product_id')
         quantity = request.data.get('quantity')
         
@@ -83,15 +134,48 @@ class CartViewSet(viewsets.GenericViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        if int(quantity) <= 0:
-            return Response(
-                {'error': 'quantity must be positive'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
+        # 数値でない値や1未満の数量は400にする
+        operation = CartOperationSerializer(
+            data={'action': 'update', 'product_id': product_id, 'quantity': quantity}
+        )
+        operation.is_valid(raise_exception=True)
+        product_id = operation.validated_data['product_id']
+        quantity = operation.validated_data['quantity']
+
+        if self.is_guest():
+            guest_cart = GuestCart.load(request)
+            if product_id not in guest_cart:
+                raise Http404
+            return self.guest_response(guest_cart, [operation.validated_data], {product_id})
         
-        cart_item = get_object_or_404(CartItem, cart=cart, product_id=product_id)
-        cart_item.quantity = quantity
-        cart_item.save()
+        cart = self.get_or_create_cart()
+        with transaction.atomic():
+            cart_item = get_object_or_404(self.locked_items(cart), product_id=product_id)
+            previous_quantity = cart_item.quantity
+            cart_item.quantity = quantity
+            cart_item.save(update_fields=['quantity', 'updated_at'])
+            difference = cart_item.quantity - previous_quantity
+            cart.add_to_totals(cart_item.product.price * difference, difference)
         
-        cart_serializer = self.get_serializer(cart)
-        return Response(cart_serializer.data)
+        return Response(self.get_cart_data(cart))
+
+    @action(detail=False, methods=['post'])
+    def batch(self, request):
+        """複数の追加・数量変更・削除をまとめて適用し、カートを1回だけ返す
+
+        例: {"operations": [{"action": "add", "product_id": 1, "quantity": 2},
+                            {"action": "update", "product_id": 2, "quantity": 1},
+                            {"action": "remove", "product_id": 3}]}
+        操作は先頭から順に適用される。updateはカートにない商品なら追加する。
+        """
+        serializer = CartBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        operations = serializer.validated_data['operations']
+
+        if self.is_guest():
+            return self.guest_response(GuestCart.load(request), operations, serializer.prices)
+
+        cart = self.get_or_create_cart()
+        cart.apply_operations(operations, serializer.prices)
+
+        return Response(self.get_cart_data(cart))
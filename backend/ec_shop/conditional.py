@@ -0,0 +1,101 @@
+"""ETag / Last-Modified による条件付きGET
+
+ConditionalGetMixin は list/retrieve などのレスポンスを build_response() で作り、
+get_validators() の ETag・Last-Modified で照合して、変化がなければシリアライズせずに 304 Not Modified を返す。
+既定の get_validators() は対象データの件数と updated_at の最大値を1クエリで集計する
+(注文のように利用者ごとに絞り込まれた、件数の少ないデータ向け)。
+商品カタログはキャッシュのバージョン番号から ETag を作るため集計しない(products/cache.py)。
+
+ETag はレスポンス本文ではなくデータの状態から作るので弱いETag(W/"...")として返し、
+If-None-Match は強い/弱いETagのどちらも弱い比較で照合する。
+"""
+import hashlib
+
+from django.db.models import Count, Max
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+
+def make_etag(request, *parts):
+    """リクエスト(パス・利用者・形式)とデータの状態を表す parts から弱いETagを作る"""
+    source = '|'.join([
+        request.get_full_path(),
+        str(request.user.pk),
+        request.accepted_renderer.format,
+        *map(str, parts),
+    ])
+    return 'W/' + quote_etag(hashlib.sha1(source.encode()).hexdigest())
+
+
+class ConditionalGetMixin:
+    """list/retrieve に ETag・Last-Modified を付け、変化がなければ 304 を返すビューセット用Mixin
+
+    独自のアクションも build_response() を通せば同じように扱われる。
+    レスポンスの作り方を変えるMixin(キャッシュなど)は build_response() を上書きして super() に渡す。
+    """
+
+    # 最終更新日時として見るフィールド(ネストして返す関連モデルの updated_at も含める)
+    conditional_timestamp_fields = ['updated_at']
+
+    def list(self, request, *args, **kwargs):
+        return self.build_response(request, lambda: super(ConditionalGetMixin, self).list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.build_response(request, lambda: super(ConditionalGetMixin, self).retrieve(request, *args, **kwargs))
+
+    def get_object_queryset(self):
+        """retrieve対象の1件だけに絞ったクエリセット"""
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        return self.filter_queryset(self.get_queryset()).filter(
+            **{self.lookup_field: self.kwargs[lookup_url_kwarg]}
+        )
+
+    def get_validators(self, request):
+        """(ETag, Last-Modified) を返す。(None, None) なら照合せずにそのまま返す
+
+        対象データの件数と conditional_timestamp_fields の最大値を1クエリで集計する。
+        """
+        fields = self.conditional_timestamp_fields
+        queryset = self.get_object_queryset() if self.action == 'retrieve' else self.filter_queryset(self.get_queryset())
+        probe = queryset.order_by().aggregate(
+            count=Count('pk', distinct=True),
+            **{f'max_{i}': Max(field) for i, field in enumerate(fields)}
+        )
+        if self.action == 'retrieve' and not probe['count']:
+            return None, None  # 存在しない場合は通常どおり404を返す
+
+        timestamps = [probe[f'max_{i}'] for i in range(len(fields)) if probe[f'max_{i}']]
+        last_modified = max(timestamps) if timestamps else None
+        etag = make_etag(request, probe['count'], *[timestamp.isoformat() for timestamp in timestamps])
+        return etag, last_modified
+
+    def build_response(self, request, build):
+        """変化がなければ 304 を、あれば build() のレスポンスに ETag・Last-Modified を付けて返す"""
+        etag, last_modified = self.get_validators(request)
+        if etag is None and last_modified is None:
+            return build()
+
+        if self.is_not_modified(request, etag, last_modified):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = build()
+            if response.status_code != status.HTTP_200_OK:
+                return response
+        if etag:
+            response['ETag'] = etag
+        if last_modified:
+            response['Last-Modified'] = http_date(last_modified.timestamp())
+        return response
+
+    def is_not_modified(self, request, etag, last_modified):
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match:
+            # 弱い比較: W/ の有無は無視してETag値だけを比べる
+            etags = [tag.removeprefix('W/') for tag in parse_etags(if_none_match)]
+            return '*' in etags or (etag is not None and etag.removeprefix('W/') in etags)
+
+        if_modified_since = parse_http_date_safe(request.headers.get('If-Modified-Since') or '')
+        if if_modified_since and last_modified:
+            return int(last_modified.timestamp()) <= if_modified_since
+        return False
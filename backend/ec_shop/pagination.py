@@ -0,0 +1,85 @@
+"""共通のページネーション
+
+API: OFFSETを使わないカーソル(キーセット)方式なので、深いページでも1ページ目と同じコストで取得できる。
+1ページの件数は REST_FRAMEWORK['PAGE_SIZE'](未設定なら20件)、
+?page_size= で指定できる上限は settings.API_MAX_PAGE_SIZE(未設定なら100件)。
+
+管理画面: EstimatedCountPaginator で大きなテーブルの COUNT(*) を避ける。
+"""
+from django.conf import settings
+from django.contrib.admin.views.main import PAGE_VAR
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+from rest_framework.pagination import CursorPagination
+from rest_framework.settings import api_settings
+
+
+class BaseCursorPagination(CursorPagination):
+    page_size_query_param = 'page_size'
+
+    def __init__(self):
+        self.page_size = api_settings.PAGE_SIZE or 20
+        self.max_page_size = getattr(settings, 'API_MAX_PAGE_SIZE', 100)
+
+
+class CreatedAtCursorPagination(BaseCursorPagination):
+    """作成日時の新しい順(商品・注文の Meta.ordering と同じ)"""
+    ordering = ('-created_at', '-id')
+
+
+class NameCursorPagination(BaseCursorPagination):
+    """名前順(カテゴリーの Meta.ordering と同じ)"""
+    ordering = ('name', 'id')
+
+
+class IdCursorPagination(BaseCursorPagination):
+    """ID順"""
+    ordering = ('id',)
+
+
+class EstimatedCountPaginator(Paginator):
+    """件数を数え切らない管理画面用のPaginator
+
+    件数は settings.ADMIN_COUNT_LIMIT(未設定なら10000件)までしか数えず、それより多ければ
+    上限に1ページ分を足した件数として扱う(次のページに進める)。上限は開いているページの末尾まで広げるので、
+    上限を超えたページも開ける。
+    PostgreSQLで絞り込みのない一覧は、統計情報の推定行数(pg_class.reltuples)を使う。
+    ModelAdmin には EstimatedCountAdminMixin で組み込む(開いているページ番号を渡す)。
+    """
+
+    def __init__(self, *args, page_number=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.page_number = page_number
+
+    @cached_property
+    def count(self):
+        limit = max(getattr(settings, 'ADMIN_COUNT_LIMIT', 10000), self.page_number * self.per_page)
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if not queryset.query.where and connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+                    [queryset.model._meta.db_table]
+                )
+                row = cursor.fetchone()
+            if row and row[0] > limit:
+                return int(row[0])
+        # LIMIT付きで数えるので、どれだけ行があっても上限件数(と1行)までしか読まない
+        count = queryset.order_by()[:limit + 1].count()
+        return limit + self.per_page if count > limit else count
+
+
+class EstimatedCountAdminMixin:
+    """一覧で EstimatedCountPaginator を使う ModelAdmin 用Mixin"""
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False  # 絞り込み時の「全○件」のための COUNT(*) もしない
+
+    def get_paginator(self, request, queryset, per_page, orphans=0, allow_empty_first_page=True):
+        try:
+            page_number = max(int(request.GET.get(PAGE_VAR, 1)), 1)
+        except ValueError:
+            page_number = 1  # 不正な値は管理画面の側でエラーにする
+        return self.paginator(queryset, per_page, orphans, allow_empty_first_page, page_number=page_number)
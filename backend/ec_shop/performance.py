@@ -0,0 +1,259 @@
+"""リクエストごとのパフォーマンス計測
+
+PerformanceMiddleware はリクエストごとに次を計測する。
+    db         SQLの件数と実行時間(すべてのDB接続の execute_wrapper で記録)
+    serialize  シリアライザでの変換時間(TimedSerializerMixin を付けたシリアライザ)
+    payment    決済サービスの呼び出し時間(timer('payment') で囲んだ部分)
+    total      リクエスト全体の時間
+
+結果は Server-Timing ヘッダーで返し、遅いリクエストは実行時間の長いクエリとともにログ
+(ロガー 'ec_shop.performance')に出す。集計値はプロセスごとに保持し、metrics ビューで
+Prometheusのテキスト形式として返す(webhook受信箱の件数も含む)。
+
+Server-Timing はクエリ数や処理時間を外部に見せるため、既定では DEBUG のときとスタッフの利用者にだけ付ける。
+metrics ビューは METRICS_TOKEN の Bearer トークンを付けたリクエストか、スタッフの利用者にだけ返す
+(リバースプロキシの後ろでは接続元のIPアドレスがプロキシになるため、IPアドレスでは制限しない)。
+
+設定(任意):
+    PERFORMANCE_SERVER_TIMING     Server-Timing ヘッダーを付けるか(既定 None: DEBUG のときとスタッフの利用者だけ。
+                                  True で常に、False で付けない)
+    PERFORMANCE_SLOW_REQUEST_MS   この時間(ミリ秒)以上かかったリクエストをログに出す(既定 500、None で出さない)
+    PERFORMANCE_SLOW_QUERY_COUNT  上記のログに出すクエリの数(既定 5)
+    METRICS_TOKEN                 metrics ビューの Bearer トークン(既定 None: スタッフの利用者だけ)
+"""
+import contextvars
+import hmac
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse
+
+logger = logging.getLogger(__name__)
+
+# 処理中のリクエストの RequestMetrics(sync_to_async で別スレッドに移っても引き継がれる)
+current = contextvars.ContextVar('request_metrics', default=None)
+
+DURATION_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.timings = defaultdict(float)  # 名前: 秒
+        self.queries = defaultdict(lambda: [0, 0.0])  # SQL: [回数, 秒]
+        self.query_count = 0
+        self.depth = defaultdict(int)  # 入れ子になった timer を二重に数えないための深さ
+
+    def add_query(self, sql, duration):
+        self.query_count += 1
+        self.timings['db'] += duration
+        stats = self.queries[sql]
+        stats[0] += 1
+        stats[1] += duration
+
+    def top_queries(self, count):
+        """合計時間の長い順に (SQL, 回数, 秒) を返す(同じSQLはまとめる)"""
+        ranked = sorted(self.queries.items(), key=lambda item: item[1][1], reverse=True)
+        return [(sql, calls, duration) for sql, (calls, duration) in ranked[:count]]
+
+
+@contextmanager
+def timer(name):
+    """処理中のリクエストの計測に name の時間を加える(リクエスト外では何もしない)"""
+    metrics = current.get()
+    if metrics is None or metrics.depth[name]:
+        yield
+        return
+    metrics.depth[name] += 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.timings[name] += time.perf_counter() - start
+        metrics.depth[name] -= 1
+
+
+def record_query(execute, sql, params, many, context):
+    """すべてのDB接続に付ける execute_wrapper"""
+    metrics = current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.add_query(sql, time.perf_counter() - start)
+
+
+def install_query_recorder(connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+# 非同期ビューの sync_to_async など、別スレッドで作られるDB接続にも付ける
+connection_created.connect(install_query_recorder, dispatch_uid='ec_shop.performance')
+
+
+class TimedSerializerMixin:
+    """シリアライザでの変換時間を serialize として計測する(入れ子のシリアライザは外側だけ数える)"""
+
+    def to_representation(self, instance):
+        with timer('serialize'):
+            return super().to_representation(instance)
+
+
+class Registry:
+    """プロセス内で集計するカウンターとヒストグラム(ビュー名ごと)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = defaultdict(int)  # (ビュー名, メソッド, ステータス): 件数
+        self.durations = defaultdict(lambda: [0] * (len(DURATION_BUCKETS) + 1))  # ビュー名: バケットごとの件数
+        self.totals = defaultdict(float)  # (指標, ビュー名): 合計
+
+    def observe(self, view, method, status_code, metrics, total):
+        bucket = next((i for i, bound in enumerate(DURATION_BUCKETS) if total <= bound), len(DURATION_BUCKETS))
+        with self.lock:
+            self.requests[(view, method, status_code)] += 1
+            self.durations[view][bucket] += 1
+            self.totals[('request_duration_seconds', view)] += total
+            self.totals[('db_queries', view)] += metrics.query_count
+            for name, seconds in metrics.timings.items():
+                self.totals[(f'{name}_duration_seconds', view)] += seconds
+
+    def render(self):
+        """Prometheusのテキスト形式で返す"""
+        with self.lock:
+            requests = dict(self.requests)
+            durations = {view: list(counts) for view, counts in self.durations.items()}
+            totals = dict(self.totals)
+
+        lines = ['# TYPE http_requests_total counter']
+        for (view, method, status_code), count in sorted(requests.items()):
+            lines.append(f'http_requests_total{{view="{view}",method="{method}",status="{status_code}"}} {count}')
+
+        lines.append('# TYPE http_request_duration_seconds histogram')
+        for view, counts in sorted(durations.items()):
+            cumulative = 0
+            for bound, count in zip([*DURATION_BUCKETS, '+Inf'], counts):
+                cumulative += count
+                lines.append(f'http_request_duration_seconds_bucket{{view="{view}",le="{bound}"}} {cumulative}')
+            lines.append(f'http_request_duration_seconds_count{{view="{view}"}} {cumulative}')
+            lines.append(
+                f'http_request_duration_seconds_sum{{view="{view}"}} {totals[("request_duration_seconds", view)]:.6f}'
+            )
+
+        for name in sorted({name for name, _ in totals} - {'request_duration_seconds'}):
+            lines.append(f'# TYPE {name}_total counter')
+            for (metric, view), value in sorted(totals.items()):
+                if metric == name:
+                    lines.append(f'{name}_total{{view="{view}"}} {round(value, 6)}')
+        return lines
+
+
+registry = Registry()
+
+
+class PerformanceMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+        self.server_timing = getattr(settings, 'PERFORMANCE_SERVER_TIMING', None)
+        self.slow_request_ms = getattr(settings, 'PERFORMANCE_SLOW_REQUEST_MS', 500)
+        self.slow_query_count = getattr(settings, 'PERFORMANCE_SLOW_QUERY_COUNT', 5)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        # 接続済みのDB接続には connection_created が送られないため、ここでも付ける
+        for alias in connections:
+            install_query_recorder(connections[alias])
+        metrics = RequestMetrics()
+        token = current.set(metrics)
+        try:
+            response = self.get_response(request)
+        finally:
+            current.reset(token)
+        return self.finish(request, response, metrics)
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        token = current.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current.reset(token)
+        return self.finish(request, response, metrics)
+
+    def finish(self, request, response, metrics):
+        total = time.perf_counter() - metrics.start
+        match = request.resolver_match
+        view = match.view_name if match else 'unmatched'
+        registry.observe(view, request.method, response.status_code, metrics, total)
+
+        if self.shows_server_timing(request):
+            response['Server-Timing'] = ', '.join([
+                f'db;dur={metrics.timings["db"] * 1000:.1f};desc="{metrics.query_count} queries"',
+                *(
+                    f'{name};dur={metrics.timings[name] * 1000:.1f}'
+                    for name in ('serialize', 'payment') if name in metrics.timings
+                ),
+                f'total;dur={total * 1000:.1f}',
+            ])
+
+        if self.slow_request_ms is not None and total * 1000 >= self.slow_request_ms:
+            top = '\n'.join(
+                f'  {duration * 1000:.1f} ms x{calls}: {sql}'
+                for sql, calls, duration in metrics.top_queries(self.slow_query_count)
+            )
+            logger.warning(
+                '遅いリクエスト: %s %s %s %.0f ms (SQL %d件 %.0f ms)\n%s',
+                request.method, request.path, response.status_code, total * 1000,
+                metrics.query_count, metrics.timings['db'] * 1000, top
+            )
+        return response
+
+    def shows_server_timing(self, request):
+        if self.server_timing is not None:
+            return self.server_timing
+        # DRFの認証結果も request.user に反映される
+        return settings.DEBUG or is_staff(request)
+
+
+def is_staff(request):
+    user = getattr(request, 'user', None)
+    return bool(user and user.is_staff)
+
+
+def collect_webhook_metrics():
+    from orders import webhooks
+
+    stats = webhooks.get_metrics()
+    lines = ['# TYPE webhook_events gauge']
+    for status in ('pending', 'processed', 'failed'):
+        lines.append(f'webhook_events{{status="{status}"}} {stats[status]}')
+    lines += ['# TYPE webhook_lag_seconds gauge', f'webhook_lag_seconds {stats["lag_seconds"]:.3f}']
+    return lines
+
+
+def metrics(request):
+    """集計値をPrometheusのテキスト形式で返す(METRICS_TOKEN のトークンかスタッフの利用者のみ)"""
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    authorization = request.headers.get('Authorization', '')
+    if not (token and hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode())) and not is_staff(request):
+        raise PermissionDenied
+    lines = registry.render() + collect_webhook_metrics()
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,159 @@
+"""テスト用のヘルパー
+
+QueryBudgetMixin: データ量を変えながら同じリクエストを送り、発行されるクエリ数が
+データ量によらず一定で、かつ宣言した予算以内であることを確認する。
+RouteBudgetMixin: ルートごとの予算(各アプリの tests.py の QUERY_BUDGETS)で確認するテスト用に、
+ログイン済みのクライアントとテストデータの作成を加えたもの。
+retry_on_lock: 同時実行のテストで、SQLiteのロックの競合によるエラーをやり直す。
+"""
+import itertools
+import random
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import OperationalError, connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLResolver, get_resolver
+from rest_framework.test import APIClient
+
+from carts.models import Cart, CartItem
+from orders.models import Order, OrderItem
+from products.models import Category, Product
+
+
+class QueryBudgetMixin:
+    # クエリ数を比べるデータ量(最初の大きさで1回空打ちしてから計測する)
+    query_budget_sizes = (2, 10)
+
+    def count_queries(self, func):
+        """func() の戻り値と、その間に発行されたクエリを返す"""
+        with CaptureQueriesContext(connection) as ctx:
+            result = func()
+        return result, ctx.captured_queries
+
+    def assertQueryBudget(self, budget, request, populate=lambda n: None, sizes=None):
+        """populate(n) で n 件のデータを用意して request(populate の戻り値) を呼び、クエリ数を確認する
+
+        計測の前にはキャッシュを空にするので、キャッシュに頼らないときのクエリ数になる
+        (キャッシュに置くデータは populate の中で用意すること)。
+        """
+        sizes = sizes or self.query_budget_sizes
+        counts = {}
+        for n in [sizes[0], *sizes]:  # 1回目はセッションの作成など初回だけの処理を除くための空打ち
+            for cache in caches.all():
+                cache.clear()
+            state = populate(n)
+            response, queries = self.count_queries(lambda: request(state))
+            self.assertLess(response.status_code, 400, getattr(response, 'content', b'')[:500])
+            counts[n] = len(queries)
+
+        detail = '\n'.join(query['sql'] for query in queries)
+        self.assertEqual(
+            len(set(counts.values())), 1,
+            f'データ量によってクエリ数が変わります {counts}(最後の計測のクエリ):\n{detail}'
+        )
+        self.assertLessEqual(
+            counts[sizes[-1]], budget,
+            f'クエリ数 {counts[sizes[-1]]} が予算 {budget} を超えています:\n{detail}'
+        )
+
+
+class RouteBudgetMixin(QueryBudgetMixin):
+    """query_budgets(「URL名 メソッド」: 上限)のルートの予算で確認する
+
+    ルートを追加したら、そのアプリの tests.py の QUERY_BUDGETS に予算を、QueryBudgetTests に
+    test_<URL名>_<メソッド> を追加する(ec_shop/tests.py ですべてのルートにあることを確認する)。
+    """
+
+    query_budgets = {}
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='buyer', password='pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.sequence = itertools.count()
+
+    def assertRouteBudget(self, route, request, populate=lambda n: None):
+        self.assertQueryBudget(self.query_budgets[route], request, populate)
+
+    def unique(self, prefix):
+        return f'{prefix}{next(self.sequence)}'
+
+    def make_products(self, n, category=None, stock=100):
+        category = category or Category.objects.create(name=self.unique('カテゴリー'))
+        return Product.objects.bulk_create([
+            Product(name=self.unique('商品'), description='', price=100, stock=stock, category=category)
+            for _ in range(n)
+        ])
+
+    def fill_cart(self, n, user=None):
+        cart, _ = Cart.objects.get_or_create(user=user or self.user)
+        products = self.make_products(n)
+        CartItem.objects.bulk_create([CartItem(cart=cart, product=product, quantity=1) for product in products])
+        Cart.objects.filter(pk=cart.pk).recalculate_totals()
+        return products
+
+    def make_order(self, items, user=None, **kwargs):
+        order = Order.objects.create(user=user or self.user, shipping_address='東京都', total_price=100 * items, **kwargs)
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, quantity=1, price=100) for product in self.make_products(items)
+        ])
+        return order
+
+    def guest_client(self, n):
+        """n 種類の商品をカートに入れたゲストのクライアント"""
+        client = APIClient()
+        client.post('/api/carts/batch/', {'operations': [
+            {'action': 'add', 'product_id': product.pk, 'quantity': 1} for product in self.make_products(n)
+        ]}, format='json')
+        return client
+
+
+def retry_on_lock(func, timeout=30):
+    """func() を実行し、SQLiteのロックの競合でエラーになった場合は少し待ってやり直す
+
+    SQLiteには行ロック(select_for_update)がない代わりに書き込みがDB全体で直列になり、
+    競合したトランザクションは更新を失う代わりにエラーになる(テストDBの共有キャッシュの
+    メモリDBでは「database table is locked」)。PostgreSQLでは行ロックを待つので起きない。
+    ロックを待つ代わりにやり直すことで、どちらのDBでも同時実行の結果だけを確認できる。
+    """
+    deadline = time.monotonic() + timeout
+    for attempt in itertools.count():
+        try:
+            return func()
+        except OperationalError as e:
+            if 'locked' not in str(e) or time.monotonic() > deadline:
+                raise
+            # 多数のスレッドが読み取りのロックを取り続けて書き込みが進まなくならないよう、待ち時間を延ばす
+            time.sleep(random.uniform(0, min(0.2, 0.001 * 2 ** attempt)))
+
+
+def iter_routes(resolver=None, exclude=('admin',)):
+    """URLconf のすべてのルートについて (URL名, HTTPメソッド) を返す
+
+    ビューセットは actions の、クラスベースのビューはハンドラーのあるメソッドを返す。
+    関数ビューはメソッドを調べられないため None を返す。
+    exclude の名前空間と、名前のないルート(メディア配信など)は除く。
+    """
+    resolver = resolver or get_resolver()
+    for pattern in resolver.url_patterns:
+        if isinstance(pattern, URLResolver):
+            if pattern.namespace not in exclude:
+                yield from iter_routes(pattern, exclude)
+            continue
+        if not pattern.name:
+            continue
+        callback = pattern.callback
+        view_class = getattr(callback, 'cls', None) or getattr(callback, 'view_class', None)
+        if getattr(callback, 'actions', None):
+            methods = [method for method in callback.actions if method != 'head']
+        elif view_class is not None:
+            methods = [
+                method for method in view_class.http_method_names
+                if method not in ('head', 'options') and hasattr(view_class, method)
+            ]
+        else:
+            methods = [None]
+        for method in methods:
+            yield pattern.name, method.upper() if method else None
@@ -0,0 +1,246 @@
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase, modify_settings, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from carts import tests as carts_tests
+from orders import tests as orders_tests
+from orders.models import Order, WebhookEvent
+from products import tests as products_tests
+from products.cache import get_cache
+from products.models import Product
+from . import performance
+from .testing import RouteBudgetMixin, iter_routes
+
+User = get_user_model()
+
+
+@modify_settings(MIDDLEWARE={'append': 'ec_shop.performance.PerformanceMiddleware'})
+@override_settings(PAYMENT_PROVIDER='fake', PAYMENT_FAKE_PROVIDER={'latency': 0})
+class PerformanceMiddlewareTests(TestCase):
+    """リクエストごとの計測(Server-Timing・遅いリクエストのログ・metrics)"""
+
+    def setUp(self):
+        get_cache().clear()
+        # Server-Timing は既定ではスタッフの利用者にだけ付く
+        self.user = User.objects.create_user(username='staff', password='pass', is_staff=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        Product.objects.create(name='りんご', description='', price=100, stock=10)
+
+    def server_timing(self, response):
+        entries = {}
+        for entry in response['Server-Timing'].split(', '):
+            name, *params = entry.split(';')
+            entries[name] = dict(param.split('=', 1) for param in params)
+        return entries
+
+    def test_server_timing_reports_queries_and_serializer(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/products/')
+        timing = self.server_timing(response)
+        self.assertEqual(timing['db']['desc'], f'"{len(ctx.captured_queries)} queries"')
+        self.assertIn('serialize', timing)
+        self.assertGreaterEqual(float(timing['total']['dur']), float(timing['db']['dur']))
+
+    def test_payment_provider_time_is_reported(self):
+        order = Order.objects.create(user=self.user, shipping_address='東京都', total_price=100)
+        response = self.client.post(
+            f'/api/orders/orders/{order.pk}/process_payment/',
+            {'payment_method': 'card', 'payment_method_id': 'pm_card_visa'}, format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('payment', self.server_timing(response))
+
+    def test_server_timing_is_hidden_from_other_users_by_default(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user(username='buyer', password='pass'))
+        self.assertNotIn('Server-Timing', client.get('/api/products/'))
+        self.assertNotIn('Server-Timing', APIClient().get('/api/products/'))
+
+        with override_settings(DEBUG=True):
+            self.assertIn('Server-Timing', APIClient().get('/api/products/'))
+        with override_settings(PERFORMANCE_SERVER_TIMING=True):
+            self.assertIn('Server-Timing', APIClient().get('/api/products/'))
+        with override_settings(PERFORMANCE_SERVER_TIMING=False):
+            self.assertNotIn('Server-Timing', self.client.get('/api/products/'))
+
+    @override_settings(PERFORMANCE_SLOW_REQUEST_MS=0, PERFORMANCE_SLOW_QUERY_COUNT=1)
+    def test_slow_request_logs_top_queries(self):
+        with self.assertLogs('ec_shop.performance', 'WARNING') as logs:
+            self.client.get('/api/products/')
+        message = logs.records[0].getMessage()
+        self.assertIn('GET /api/products/ 200', message)
+        self.assertEqual(message.count('\n'), 1)  # 上位1件のクエリのみ
+        self.assertIn('SELECT', message)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_endpoint(self):
+        self.client.get('/api/products/')
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('http_requests_total{view="product-list",method="GET",status="200"}', body)
+        self.assertIn('http_request_duration_seconds_bucket{view="product-list",le="+Inf"}', body)
+        self.assertIn('db_queries_total{view="product-list"}', body)
+        self.assertIn('webhook_events{status="pending"} 0', body)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_requires_token_or_staff(self):
+        # 接続元のIPアドレス(リバースプロキシの後ろでは常にプロキシ)では許可しない
+        self.assertEqual(APIClient().get('/metrics').status_code, 403)
+        self.assertEqual(APIClient().get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        self.assertEqual(APIClient().get('/metrics', HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+        client = APIClient()
+        client.force_login(User.objects.create_user(username='buyer', password='pass'))
+        self.assertEqual(client.get('/metrics').status_code, 403)
+        client.force_login(self.user)
+        self.assertEqual(client.get('/metrics').status_code, 200)
+        with override_settings(METRICS_TOKEN=None):
+            self.assertEqual(client.get('/metrics').status_code, 200)
+            self.assertEqual(APIClient().get('/metrics', HTTP_AUTHORIZATION='Bearer None').status_code, 403)
+
+    def test_timer_outside_request_is_noop(self):
+        with performance.timer('payment'):
+            pass
+        self.assertIsNone(performance.current.get())
+
+
+# ルートごとのクエリ数の予算(「URL名 メソッド」: 上限)。データ量によらず一定であることも確認する。
+# 予算は各アプリの tests.py の QUERY_BUDGETS に置く(users はテストモジュールを持たないためここに置く)。
+# 予算は計測した件数そのものにして、増えたら見直す。10件以上のルートには内訳を書く。
+# TestCase のトランザクション内で数えるため、atomic ブロックごとに SAVEPOINT / RELEASE の2件を含む。
+QUERY_BUDGETS = {
+    'api-root GET': 0,
+    'user-list GET': 1,
+    'user-list POST': 2,
+    'user-detail GET': 1,
+    'user-detail PUT': 3,
+    'user-detail PATCH': 2,
+    # 取得 1、カスケード削除の対象(カート・注文)の収集 2、関連テーブルごとの DELETE 9
+    'user-detail DELETE': 12,
+    # 重複の確認・作成 2、ログイン(セッションの作成・last_login)5、
+    # ゲストカートの引き継ぎ(価格・カートの取得と作成・ロック・一括追加・合計)11、セッションの保存 3
+    'user-register POST': 21,
+    # 認証 1、ログイン 5、ゲストカートの引き継ぎ(既存のカートなので作成なし)8、セッションの保存 3
+    'user-login-api POST': 17,
+    'user-logout POST': 4,
+    'metrics GET': 1,
+}
+
+# ルートの予算を置くモジュール(QUERY_BUDGETS と QueryBudgetTests を持つ)
+BUDGET_MODULES = [carts_tests, orders_tests, products_tests]
+
+
+class QueryBudgetTests(RouteBudgetMixin, TestCase):
+    """ユーザー・ルート・計測のAPIのクエリ数がデータ量によらず一定で、予算以内であることを確認する"""
+
+    query_budgets = QUERY_BUDGETS
+
+    def test_every_route_has_a_budget(self):
+        suites = {route: QueryBudgetTests for route in QUERY_BUDGETS}
+        for module in BUDGET_MODULES:
+            for route in module.QUERY_BUDGETS:
+                with self.subTest(route=route, module=module.__name__):
+                    self.assertNotIn(route, suites)  # 予算は1か所にだけ置く
+                suites[route] = module.QueryBudgetTests
+
+        names = {name for name, _ in (key.split() for key in suites)}
+        for name, method in set(iter_routes()):
+            with self.subTest(route=name, method=method):
+                if method is None:  # 関数ビューはURL名だけ確認する
+                    self.assertIn(name, names)
+                else:
+                    self.assertIn(f'{name} {method}', suites)
+        for route, suite in suites.items():
+            with self.subTest(route=route):
+                self.assertTrue(hasattr(suite, 'test_' + route.replace('-', '_').replace(' ', '_').lower()))
+
+    # ユーザー
+
+
+    def test_api_root_get(self):
+        self.assertRouteBudget('api-root GET', lambda _: self.client.get('/api/'))
+
+    def test_user_list_get(self):
+        self.assertRouteBudget(
+            'user-list GET', lambda _: self.client.get('/api/users/'),
+            lambda n: [User.objects.create_user(username=self.unique('user')) for _ in range(n)]
+        )
+
+    def test_user_list_post(self):
+        self.assertRouteBudget('user-list POST', lambda _: self.client.post('/api/users/', {
+            'username': self.unique('user'), 'email': 'user@example.com',
+            'password': 'a-Strong-passw0rd', 'password2': 'a-Strong-passw0rd'
+        }, format='json'))
+
+    def user_with_orders(self, n):
+        user = User.objects.create_user(username=self.unique('user'))
+        for _ in range(n):
+            self.make_order(2, user=user)
+        self.fill_cart(n, user=user)
+        return user
+
+    def test_user_detail_get(self):
+        self.assertRouteBudget(
+            'user-detail GET', lambda user: self.client.get(f'/api/users/{user.pk}/'), self.user_with_orders
+        )
+
+    def test_user_detail_put(self):
+        users = []
+
+        def put(user):
+            users.append(user)
+            return self.client.put(f'/api/users/{user.pk}/', {
+                'username': self.unique('user'), 'email': 'user@example.com',
+                'password': 'a-Strong-passw0rd', 'password2': 'a-Strong-passw0rd'
+            }, format='json')
+
+        self.assertRouteBudget('user-detail PUT', put, self.user_with_orders)
+        for user in users:
+            user.refresh_from_db()
+            self.assertTrue(user.check_password('a-Strong-passw0rd'))
+
+    def test_user_detail_patch(self):
+        self.assertRouteBudget(
+            'user-detail PATCH',
+            lambda user: self.client.patch(f'/api/users/{user.pk}/', {'email': 'new@example.com'}, format='json'),
+            self.user_with_orders
+        )
+
+    def test_user_detail_delete(self):
+        self.assertRouteBudget(
+            'user-detail DELETE', lambda user: self.client.delete(f'/api/users/{user.pk}/'), self.user_with_orders
+        )
+
+    def test_user_register_post(self):
+        self.assertRouteBudget('user-register POST', lambda client: client.post('/api/users/register/', {
+            'username': self.unique('user'), 'email': 'user@example.com',
+            'password': 'a-Strong-passw0rd', 'password2': 'a-Strong-passw0rd'
+        }, format='json'), self.guest_client)
+
+    def test_user_login_api_post(self):
+        self.assertRouteBudget(
+            'user-login-api POST',
+            lambda client: client.post('/api/users/login_api/', {'username': 'buyer', 'password': 'pass'}, format='json'),
+            self.guest_client
+        )
+
+    def test_user_logout_post(self):
+        def populate(n):
+            client = APIClient()
+            client.force_login(self.user)
+            return client
+        self.assertRouteBudget('user-logout POST', lambda client: client.post('/api/users/logout/'), populate)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_get(self):
+        self.assertRouteBudget(
+            'metrics GET', lambda _: self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret'),
+            lambda n: WebhookEvent.objects.bulk_create([
+                WebhookEvent(event_id=self.unique('evt_'), event_type='payment_intent.succeeded', payload={})
+                for _ in range(n)
+            ])
+        )
@@ -19,7 +19,9 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 from rest_framework.routers import DefaultRouter
+from ec_shop import performance
 from users.views import UserViewSet
+from products.images import VARIANT_DIR, serve_variant
 from products.views import ProductViewSet, CategoryViewSet
 
 router = DefaultRouter()
@@ -32,4 +34,9 @@ urlpatterns = [
     path('api/', include(router.urls)),
     path('api/carts/', include('carts.urls')),
     path('api/orders/', include('orders.urls')),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    path('metrics', performance.metrics, name='metrics'),  # Prometheus形式の計測値
+] + static(
+    # 商品画像の縮小版はファイル名に内容のハッシュを含むので長期キャッシュさせる
+    f'{settings.MEDIA_URL}{VARIANT_DIR}/', view=serve_variant,
+    document_root=f'{settings.MEDIA_ROOT}/{VARIANT_DIR}'
+) + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -1,28 +1,36 @@
 from django.contrib import admin
-from .models import Order, OrderItem, Payment
+from ec_shop.pagination import EstimatedCountAdminMixin
+from . import webhooks
+from .models import Order, OrderItem, Payment, WebhookEvent
 
 class OrderItemInline(admin.TabularInline):
     model = OrderItem
     extra = 0
     readonly_fields = ['product', 'quantity', 'price']
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('product')
+
 class PaymentInline(admin.TabularInline):
     model = Payment
     extra = 0
-    readonly_fields = ['payment_method', 'amount', 'status', 'stripe_payment_intent_id', 'created_at']
+    readonly_fields = ['payment_method', 'amount', 'status', 'stripe_payment_intent_id', 'stripe_checkout_session_id', 'created_at']
     can_delete = False
 
 @admin.register(Order)
-class OrderAdmin(admin.ModelAdmin):
+class OrderAdmin(EstimatedCountAdminMixin, admin.ModelAdmin):
     list_display = ['id', 'user', 'status', 'created_at', 'get_total', 'get_payment_status']
     list_filter = ['status', 'created_at']
     search_fields = ['id', 'user__email']
     readonly_fields = ['user', 'created_at', 'updated_at']
     inlines = [OrderItemInline, PaymentInline]
+    # 一覧は行ごとにクエリを発行しないよう、ユーザーと支払いを結合して取得する
+    list_select_related = ['user', 'payment']
     
     def get_total(self, obj):
-        return f'¥{obj.calculate_total():,}'
+        return f'¥{obj.total_price:,}'  # 注文時に確定した合計金額
     get_total.short_description = '合計金額'
+    get_total.admin_order_field = 'total_price'
     
     def get_payment_status(self, obj):
         if hasattr(obj, 'payment'):
@@ -31,11 +39,29 @@ class OrderAdmin(admin.ModelAdmin):
     get_payment_status.short_description = '支払い状態'
 
 @admin.register(Payment)
-class PaymentAdmin(admin.ModelAdmin):
+class PaymentAdmin(EstimatedCountAdminMixin, admin.ModelAdmin):
     list_display = ['id', 'order', 'amount', 'payment_method', 'status', 'created_at']
     list_filter = ['status', 'payment_method', 'created_at']
-    search_fields = ['order__id', 'stripe_payment_intent_id']
-    readonly_fields = ['order', 'amount', 'payment_method', 'stripe_payment_intent_id', 'created_at', 'updated_at']
+    search_fields = ['order__id', 'stripe_payment_intent_id', 'stripe_checkout_session_id']
+    readonly_fields = [
+        'order', 'amount', 'payment_method', 'stripe_payment_intent_id', 'stripe_checkout_session_id', 'created_at', 'updated_at'
+    ]
+    list_select_related = ['order__user']  # Order.__str__ がユーザー名を使うため
     
     def has_add_permission(self, request):
         return False  # 手動での追加を禁止
+
+@admin.register(WebhookEvent)
+class WebhookEventAdmin(EstimatedCountAdminMixin, admin.ModelAdmin):
+    list_display = ['event_id', 'event_type', 'status', 'attempts', 'received_at', 'processed_at']
+    list_filter = ['status', 'event_type']
+    search_fields = ['event_id']
+    readonly_fields = ['event_id', 'event_type', 'payload', 'status', 'attempts', 'last_error', 'received_at', 'processed_at']
+    actions = ['replay_events']
+
+    @admin.action(description='選択したイベントを再処理する')
+    def replay_events(self, request, queryset):
+        self.message_user(request, f'{webhooks.replay(queryset)}件を未処理に戻しました')
+
+    def has_add_permission(self, request):
+        return False  # 手動での追加を禁止
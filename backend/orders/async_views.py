@@ -0,0 +1,90 @@
+"""支払い・webhookの非同期(ASGI)版ビュー
+
+ec_shop.asgi:application(uvicornなど)で動かすと、Stripeの応答を待つ間もワーカーが他のリクエストを処理できる。
+認証・権限・注文の取得・入力チェックと、orders/payments.py の短いトランザクションは
+同期版の OrderViewSet と同じ処理を sync_to_async で実行する。
+決済サービスの呼び出し(同期クライアント)は専用のスレッドプールに渡し、応答を並行して待つ。
+イベントループの既定のスレッドプールは min(32, CPU数+4) スレッドしかなく、
+CPUの少ないサーバーでは同時に数件しか待てないため使わない。
+
+設定(settings.py):
+    PAYMENT_PROVIDER_MAX_WORKERS  決済サービスの応答を同時に待てる数(既定 200)
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import stripe
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from ec_shop.performance import timer
+
+from . import payments, webhooks
+from .views import OrderViewSet
+
+# 応答を待つだけのスレッドなのでCPU数より多くてよい
+executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'PAYMENT_PROVIDER_MAX_WORKERS', 200),
+    thread_name_prefix='payment-provider'
+)
+
+
+def start_payment(request, pk):
+    """OrderViewSet と同じ処理で注文を取得し、支払いを「処理中」にする
+
+    認証・権限クラスやCSRFの確認も同期版と同じ(DRFの Request で行う)。
+    (応答, None) か (None, (決済サービス, Payment, create_payment に渡す引数)) を返す。
+    応答は認証・入力のエラーなど、決済サービスを呼ばずにそのまま返すもの。
+    """
+    view = OrderViewSet(
+        action_map={'post': 'process_payment'}, args=(), kwargs={'pk': pk}, format_kwarg=None, headers={}
+    )
+    view.request = view.initialize_request(request)
+    try:
+        view.initial(view.request)
+        return None, view.start_payment()
+    except payments.PaymentError as e:
+        return JsonResponse({'error': e.message}, status=e.status_code), None
+    except Exception as e:
+        # 401/403/404/400 などは同期版と同じ応答にする(それ以外の例外はそのまま送出される)
+        return view.finalize_response(view.request, view.handle_exception(e)).render(), None
+
+
+@csrf_exempt  # CSRFはセッション認証の場合にDRFが確認する(同期版と同じ)
+@require_POST
+async def process_payment(request, pk):
+    """注文の支払い処理を行う(OrderViewSet.process_payment の非同期版)"""
+    response, started = await sync_to_async(start_payment)(request, pk)
+    if response is not None:
+        return response
+    provider, payment, options = started
+
+    try:
+        with timer('payment'):
+            result = await asyncio.get_running_loop().run_in_executor(
+                executor, functools.partial(provider.create_payment, payment, **options)
+            )
+        error = None
+    except Exception as e:
+        result, error = None, e
+
+    status_code, data = await sync_to_async(payments.finish_payment)(payment, result, error)
+    return JsonResponse(data, status=status_code)
+
+
+@csrf_exempt
+@require_POST
+async def stripe_webhook(request):
+    """Stripeからのwebhookを処理する(stripe_webhook の非同期版)"""
+    try:
+        # イベントの検証
+        event = webhooks.construct_event(request.body, request.META.get('HTTP_STRIPE_SIGNATURE'))
+    except (ValueError, stripe.error.SignatureVerificationError):
+        return JsonResponse({}, status=400)
+
+    # 受信箱に保存してすぐに応答する(反映はワーカーが行う)
+    await sync_to_async(webhooks.enqueue_event)(event, request.body)
+    return JsonResponse({})
@@ -0,0 +1,194 @@
+import json
+import logging
+import random
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.middleware.csrf import CSRF_ALLOWED_CHARS, CSRF_SECRET_LENGTH
+from django.test.utils import override_settings
+from django.utils.crypto import get_random_string
+
+from orders.seed import USERNAME_PREFIX
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class Session:
+    """1人の利用者としてHTTPでAPIを呼び出す(Cookie・CSRFトークンを引き継ぐ)"""
+
+    def __init__(self, base_url, results, timeout):
+        self.base_url = base_url
+        self.results = results
+        self.timeout = timeout
+        # CSRFトークンは利用者側で決めてCookieとヘッダーの両方に送る(ログイン時に差し替えられる)
+        self.cookies = {settings.CSRF_COOKIE_NAME: get_random_string(CSRF_SECRET_LENGTH, CSRF_ALLOWED_CHARS)}
+
+    def request(self, method, path, data=None, label=None):
+        """リクエストを送り、(ステータス, JSON) を返す。所要時間は label(既定はパス)ごとに記録する"""
+        request = urllib.request.Request(
+            self.base_url + path,
+            method=method,
+            data=json.dumps(data).encode() if data is not None else None,
+            headers={
+                'Content-Type': 'application/json',
+                'Cookie': '; '.join(f'{name}={value}' for name, value in self.cookies.items()),
+                'X-CSRFToken': self.cookies[settings.CSRF_COOKIE_NAME],
+            }
+        )
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                status, body, headers = response.status, response.read(), response.headers
+        except urllib.error.HTTPError as e:
+            status, body, headers = e.code, e.read(), e.headers
+        except OSError:
+            status, body, headers = 0, b'', None  # 接続エラー・タイムアウト
+        self.results[label or f'{method} {path}'].append((time.perf_counter() - start, status))
+
+        for header in headers.get_all('Set-Cookie', []) if headers else []:
+            for name, morsel in SimpleCookie(header).items():
+                self.cookies[name] = morsel.value
+        try:
+            return status, json.loads(body) if body else None
+        except ValueError:
+            return status, None
+
+
+class Command(BaseCommand):
+    help = 'ブラウズ→カート追加→注文→支払いのシナリオをHTTPで同時に実行し、エンドポイントごとのレイテンシとスループットを計測する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='計測するサーバーのURL(省略時はこのプロセスでサーバーを起動し、偽の決済サービスを使う)')
+        parser.add_argument('--concurrency', type=int, default=20, help='同時に操作する利用者の数(seed_shopで作成したユーザーを使う)')
+        parser.add_argument('--iterations', type=int, default=5, help='1人あたりのシナリオの実行回数')
+        parser.add_argument('--password', default='password', help='seed_shopで作成したユーザーのパスワード')
+        parser.add_argument('--latency', type=int, default=200, help='偽の決済サービスの応答遅延(ミリ秒、--url省略時のみ)')
+        parser.add_argument('--timeout', type=float, default=30, help='1リクエストのタイムアウト(秒)')
+        parser.add_argument('--seed', type=int, default=0, help='商品選択の乱数のシード')
+        parser.add_argument('--output', help='結果をJSONで保存するファイル')
+        parser.add_argument('--baseline', help='比較する前回の結果(--outputで保存したJSON)')
+
+    def handle(self, *args, **options):
+        if options['url']:
+            elapsed, results = self.run(options['url'].rstrip('/'), options)
+        else:
+            # 支払いは偽の決済サービスで行う(外部への通信は発生しない)
+            with override_settings(
+                ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, '127.0.0.1'],
+                PAYMENT_PROVIDER='fake',
+                PAYMENT_FAKE_PROVIDER={'latency': options['latency'] / 1000},
+            ):
+                # 失敗は集計して表示するので、サーバー側のエラーログは出さない
+                logging.getLogger('django.request').disabled = True
+                server = ThreadedWSGIServer(('127.0.0.1', 0), QuietRequestHandler, allow_reuse_address=False)
+                server.set_app(WSGIHandler())
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+                try:
+                    elapsed, results = self.run(f'http://127.0.0.1:{server.server_port}', options)
+                finally:
+                    server.shutdown()
+                    server.server_close()
+                    logging.getLogger('django.request').disabled = False
+
+        report = {label: summarize(samples, elapsed) for label, samples in results.items()}
+        report['合計'] = summarize([sample for samples in results.values() for sample in samples], elapsed)
+        baseline = {}
+        if options['baseline']:
+            with open(options['baseline'], encoding='utf-8') as f:
+                baseline = json.load(f)['endpoints']
+
+        self.stdout.write(f"利用者{options['concurrency']}人 × {options['iterations']}回 / 合計 {elapsed:.2f} 秒")
+        for label, summary in report.items():
+            line = (
+                f"{label:<48} {summary['count']:>6}件 失敗 {summary['failures']:>4}件 "
+                f"{summary['throughput']:>8.1f} req/s  p50 {summary['p50']:>7.1f} ms  "
+                f"p95 {summary['p95']:>7.1f} ms  p99 {summary['p99']:>7.1f} ms"
+            )
+            if label in baseline and baseline[label]['p95']:
+                line += f"  (p95 前回比 {(summary['p95'] / baseline[label]['p95'] - 1) * 100:+.0f}%)"
+            self.stdout.write(line)
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump({'elapsed': elapsed, 'options': {
+                    key: options[key] for key in ('url', 'concurrency', 'iterations', 'latency')
+                }, 'endpoints': report}, f, ensure_ascii=False, indent=2)
+
+    def run(self, base_url, options):
+        """利用者ごとにスレッドでシナリオを実行し、(経過秒, {ラベル: [(秒, ステータス)]}) を返す"""
+        # ログインして前回の実行で残ったカートを空にしておく(計測には含めない)
+        sessions = [Session(base_url, defaultdict(list), options['timeout']) for _ in range(options['concurrency'])]
+        for index, session in enumerate(sessions):
+            status, _ = session.request('POST', '/api/users/login_api/', {
+                'username': f'{USERNAME_PREFIX}{index}', 'password': options['password']
+            })
+            if status != 200:
+                raise CommandError(
+                    f'{USERNAME_PREFIX}{index} でログインできません(先に seed_shop --users {options["concurrency"]} を実行してください)'
+                )
+            _, cart = session.request('GET', '/api/carts/')
+            if cart and cart['items']:
+                session.request('POST', '/api/carts/batch/', {'operations': [
+                    {'action': 'remove', 'product_id': item['product']['id']} for item in cart['items']
+                ]})
+
+        results = defaultdict(list)
+        for session in sessions:
+            session.results = results
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            list(executor.map(
+                lambda args: self.scenario(*args, options['iterations']),
+                [(session, random.Random(options['seed'] + index)) for index, session in enumerate(sessions)]
+            ))
+        return time.perf_counter() - start, results
+
+    def scenario(self, session, rng, iterations):
+        for _ in range(iterations):
+            # ブラウズ: 在庫のある商品の一覧から1つ選んで詳細を見る
+            status, page = session.request('GET', '/api/products/?in_stock=true')
+            if status != 200 or not page['results']:
+                continue
+            product = rng.choice(page['results'])
+            session.request('GET', f"/api/products/{product['id']}/", label='GET /api/products/{id}/')
+
+            status, _ = session.request('POST', '/api/carts/add_item/', {'product_id': product['id'], 'quantity': 1})
+            if status != 200:
+                continue
+            status, order = session.request('POST', '/api/orders/orders/', {'shipping_address': '東京都千代田区千代田1-1'})
+            if status != 201:
+                continue
+            session.request(
+                'POST', f"/api/orders/orders/{order['id']}/process_payment/",
+                {'payment_method': 'card', 'payment_method_id': 'pm_card_visa'},
+                label='POST /api/orders/orders/{id}/process_payment/'
+            )
+
+
+def summarize(samples, elapsed):
+    """[(秒, ステータス)] から件数・失敗数(ステータス別)・スループット・p50/p95/p99(ミリ秒)を求める"""
+    failures = Counter(str(status) for _, status in samples if not 200 <= status < 400)
+    latencies = sorted(latency * 1000 for latency, _ in samples)
+    quantiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    return {
+        'count': len(samples),
+        'failures': sum(failures.values()),
+        'failure_statuses': dict(failures),  # 0 は接続エラー・タイムアウト
+        'throughput': len(samples) / elapsed if elapsed else 0,
+        'p50': quantiles[49] if quantiles else 0,
+        'p95': quantiles[94] if quantiles else 0,
+        'p99': quantiles[98] if quantiles else 0,
+    }
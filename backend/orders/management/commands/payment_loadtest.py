@@ -0,0 +1,91 @@
+import asyncio
+import statistics
+import time
+
+import stripe
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient
+from django.test.utils import override_settings
+
+from orders.models import Order, OrderItem
+from orders.stripe_stub import start_stub
+from products.models import Product
+
+
+class Command(BaseCommand):
+    help = 'ローカルのStripeスタブ(または偽の決済サービス)に対して非同期版の支払いAPIを同時に呼び出し、スループットとレイテンシを計測する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=200, help='支払う注文の数')
+        parser.add_argument('--concurrency', type=int, default=100, help='同時リクエスト数')
+        parser.add_argument('--latency', type=int, default=200, help='決済サービスの応答遅延(ミリ秒)')
+        parser.add_argument('--fake', action='store_true', help='Stripeスタブの代わりにプロセス内の偽の決済サービスを使う')
+
+    def handle(self, *args, **options):
+        if options['fake']:
+            stub = None
+            provider_settings = {
+                'PAYMENT_PROVIDER': 'fake',
+                'PAYMENT_FAKE_PROVIDER': {'latency': options['latency'] / 1000},
+            }
+        else:
+            stub = start_stub(latency=options['latency'] / 1000)
+            stripe.api_base = stub.url
+            provider_settings = {'PAYMENT_PROVIDER': 'stripe'}
+
+        user, _ = get_user_model().objects.get_or_create(username='payment-loadtest')
+        product = Product.objects.create(name='負荷試験用商品', description='', price=1000, stock=0)
+        orders = Order.objects.bulk_create([
+            Order(user=user, shipping_address='負荷試験', total_price=1000)
+            for _ in range(options['orders'])
+        ])
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, quantity=1, price=1000) for order in orders
+        ])
+
+        # 同期版のAPIはこのプロセス内では1つのスレッドで順に実行されるため計測しない
+        # (同期版との比較は実際のWSGI/ASGIサーバーで起動して行う)
+        path = '/api/orders/async/orders/{}/process_payment/'
+
+        try:
+            with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'], **provider_settings):
+                elapsed, results = asyncio.run(
+                    self.run(user, [order.pk for order in orders], path, options['concurrency'])
+                )
+        finally:
+            Order.objects.filter(pk__in=[order.pk for order in orders]).delete()
+            product.delete()
+            if stub:
+                stub.shutdown()
+
+        latencies = sorted(latency for latency, _ in results)
+        failures = sum(1 for _, status_code in results if status_code != 200)
+        quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+        self.stdout.write(f'非同期API: {len(results)}件 / 失敗 {failures}件')
+        self.stdout.write(f'スループット: {len(results) / elapsed:.1f} req/s (合計 {elapsed:.2f} 秒)')
+        self.stdout.write(
+            f'レイテンシ: p50 {quantiles[49] * 1000:.0f} ms / p95 {quantiles[94] * 1000:.0f} ms / '
+            f'p99 {quantiles[98] * 1000:.0f} ms'
+        )
+
+    async def run(self, user, order_ids, path, concurrency):
+        client = AsyncClient(raise_request_exception=False)
+        await client.aforce_login(user)
+        semaphore = asyncio.Semaphore(concurrency)
+        results = []
+
+        async def pay(order_id):
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post(
+                    path.format(order_id),
+                    {'payment_method': 'card', 'payment_method_id': 'pm_card_visa'},
+                    content_type='application/json'
+                )
+                results.append((time.perf_counter() - start, response.status_code))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(pay(order_id) for order_id in order_ids))
+        return time.perf_counter() - start, results
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from orders import webhooks
+
+
+class Command(BaseCommand):
+    help = '受信箱に保存されたwebhookイベントを古い順にまとめて支払い・注文へ反映する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='1回のトランザクションで反映するイベント数')
+        parser.add_argument('--loop', action='store_true', help='終了せずに受信箱を監視し続ける')
+        parser.add_argument('--interval', type=float, default=1.0, help='--loop時、未処理がないときの待機秒数')
+
+    def handle(self, *args, **options):
+        while True:
+            total = 0
+            while True:
+                count = webhooks.process_batch(options['batch_size'])
+                total += count
+                if count < options['batch_size']:
+                    break
+
+            if total:
+                metrics = webhooks.get_metrics()
+                self.stdout.write(
+                    f"{total}件処理 (未処理 {metrics['pending']}件 / 失敗 {metrics['failed']}件 / "
+                    f"遅延 {metrics['lag_seconds']:.1f}秒)"
+                )
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
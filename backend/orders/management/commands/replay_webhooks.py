@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from orders import webhooks
+from orders.models import WebhookEvent
+
+
+class Command(BaseCommand):
+    help = 'webhookイベントを未処理に戻し、process_webhooks で再処理させる'
+
+    def add_arguments(self, parser):
+        parser.add_argument('event_ids', nargs='*', help='再処理するイベントID')
+        parser.add_argument('--failed', action='store_true', help='処理に失敗したイベントをすべて再処理する')
+        parser.add_argument('--since', help='この日時(ISO 8601)以降に受信したイベントを再処理する')
+
+    def handle(self, *args, **options):
+        if not (options['event_ids'] or options['failed'] or options['since']):
+            raise CommandError('イベントID、--failed、--since のいずれかを指定してください')
+
+        events = WebhookEvent.objects.all()
+        if options['event_ids']:
+            events = events.filter(event_id__in=options['event_ids'])
+        if options['failed']:
+            events = events.filter(status='failed')
+        if options['since']:
+            since = parse_datetime(options['since'])
+            if since is None:
+                raise CommandError('--since の日時の形式が不正です')
+            events = events.filter(received_at__gte=since)
+
+        self.stdout.write(f'{webhooks.replay(events)}件を未処理に戻しました')
@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from orders.seed import seed_shop, seed_users
+from products.seed import seed_catalog
+
+
+class Command(BaseCommand):
+    help = '負荷試験用にカテゴリー・商品・ユーザー・カート・注文をまとめて作成する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--categories', type=int, default=20, help='作成するカテゴリー数')
+        parser.add_argument('--products', type=int, default=10000, help='作成する商品数')
+        parser.add_argument('--users', type=int, default=100, help='作成するユーザー数')
+        parser.add_argument('--carts', type=int, default=50, help='カートを持たせるユーザー数(--users以下)')
+        parser.add_argument('--orders', type=int, default=1000, help='作成する注文数')
+        parser.add_argument('--password', default='password', help='作成するユーザーのパスワード(loadtestで使う)')
+        parser.add_argument('--seed', type=int, default=0, help='乱数のシード')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        with transaction.atomic():
+            seed_catalog(categories=options['categories'], products=options['products'], seed=options['seed'])
+            users = seed_users(options['users'], password=options['password'])
+            seed_shop(users, carts=options['carts'], orders=options['orders'], seed=options['seed'])
+        self.stdout.write(self.style.SUCCESS(
+            f"カテゴリー{options['categories']}件・商品{options['products']}件・ユーザー{options['users']}人・"
+            f"カート{min(options['carts'], options['users'])}件・注文{options['orders']}件を作成しました"
+            f'({time.perf_counter() - start:.1f} 秒)'
+        ))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from orders import webhooks
+
+
+class Command(BaseCommand):
+    help = 'webhook受信箱の件数と処理の遅延を表示する'
+
+    def handle(self, *args, **options):
+        metrics = webhooks.get_metrics()
+        self.stdout.write(
+            f"未処理 {metrics['pending']}件 / 処理済み {metrics['processed']}件 / 失敗 {metrics['failed']}件 / "
+            f"遅延 {metrics['lag_seconds']:.1f}秒"
+        )
@@ -0,0 +1,69 @@
+# Generated by Django 5.2 on 2026-10-17 17:19
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Payment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.IntegerField(verbose_name='支払い金額')),
+                ('payment_method', models.CharField(choices=[('card', 'クレジットカード'), ('konbini', 'コンビニ決済'), ('bank_transfer', '銀行振込'), ('google_pay', 'Google Pay'), ('apple_pay', 'Apple Pay'), ('paypay', 'PayPay')], max_length=20, verbose_name='支払い方法')),
+                ('status', models.CharField(choices=[('pending', '支払い待ち'), ('processing', '処理中'), ('completed', '支払い完了'), ('failed', '支払い失敗'), ('cancelled', 'キャンセル済'), ('refunded', '返金済み')], default='pending', max_length=20, verbose_name='支払い状態')),
+                ('stripe_payment_intent_id', models.CharField(blank=True, max_length=100, null=True, verbose_name='Stripe Payment Intent ID')),
+                ('stripe_checkout_session_id', models.CharField(blank=True, max_length=255, null=True, verbose_name='Stripe Checkout Session ID')),
+                ('idempotency_key', models.CharField(blank=True, default='', max_length=64, verbose_name='冪等キー')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='作成日時')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新日時')),
+            ],
+            options={
+                'verbose_name': '支払い情報',
+                'verbose_name_plural': '支払い情報',
+            },
+        ),
+        migrations.CreateModel(
+            name='WebhookEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(max_length=255, unique=True, verbose_name='イベントID')),
+                ('event_type', models.CharField(max_length=100, verbose_name='イベント種別')),
+                ('payload', models.JSONField(verbose_name='内容')),
+                ('status', models.CharField(choices=[('pending', '未処理'), ('processed', '処理済み'), ('failed', '処理失敗')], default='pending', max_length=20, verbose_name='処理状態')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='処理回数')),
+                ('last_error', models.TextField(blank=True, verbose_name='エラー内容')),
+                ('received_at', models.DateTimeField(auto_now_add=True, verbose_name='受信日時')),
+                ('processed_at', models.DateTimeField(blank=True, null=True, verbose_name='処理日時')),
+            ],
+            options={
+                'verbose_name': 'Webhookイベント',
+                'verbose_name_plural': 'Webhookイベント',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', '-created_at', '-id'], name='order_user_created_idx'),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='order',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='payment', to='orders.order'),
+        ),
+        migrations.AddIndex(
+            model_name='webhookevent',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['received_at', 'id'], name='webhook_pending_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='payment',
+            constraint=models.UniqueConstraint(condition=models.Q(('stripe_payment_intent_id__isnull', False)), fields=('stripe_payment_intent_id',), name='payment_intent_id_unique'),
+        ),
+    ]
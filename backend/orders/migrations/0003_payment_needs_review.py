@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-17 17:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0002_payment_webhookevent'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='payment',
+            name='status',
+            field=models.CharField(choices=[('pending', '支払い待ち'), ('processing', '処理中'), ('completed', '支払い完了'), ('failed', '支払い失敗'), ('cancelled', 'キャンセル済'), ('refunded', '返金済み'), ('needs_review', '要確認')], default='pending', max_length=20, verbose_name='支払い状態'),
+        ),
+    ]
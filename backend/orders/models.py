@@ -1,6 +1,51 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Prefetch, Sum, prefetch_related_objects
 from django.conf import settings
-from products.models import Product
+from django.utils import timezone
+from products.inventory import release_stock
+from products.models import PRODUCT_LIST_COLUMNS, Product
+
+class OrderQuerySet(models.QuerySet):
+    def with_items(self):
+        """注文商品を商品・カテゴリーごと必要なカラムだけまとめて取得"""
+        return self.prefetch_related(items_prefetch())
+
+    def cancel(self):
+        """キャンセル可能な注文をまとめてキャンセルし、在庫を戻す
+
+        キャンセルした注文IDのリストを返す。
+        """
+        with transaction.atomic():
+            # 同じ注文の二重キャンセルを防ぐため注文行をロックしてから状態を確認する
+            order_ids = list(
+                self.prefetch_related(None)
+                .select_for_update()
+                .exclude(status__in=Order.UNCANCELLABLE_STATUSES)
+                .order_by('pk')
+                .values_list('pk', flat=True)
+            )
+            # 支払い中・支払い済みの注文はキャンセルしない(決済サービスの呼び出し中に在庫を戻すと、
+            # 支払いが完了したときに売れた在庫を再び売ってしまう)。支払いの開始は注文行をロックして
+            # から行うため、ロックを取った後に確認すれば支払いの開始と入れ違いにならない
+            paying = set(
+                Payment.objects.filter(order_id__in=order_ids, status__in=Payment.ACTIVE_STATUSES)
+                .values_list('order_id', flat=True)
+            )
+            order_ids = [order_id for order_id in order_ids if order_id not in paying]
+            if not order_ids:
+                return []
+
+            # 商品ごとに戻す数量を集計し、1回のUPDATEで在庫を戻す
+            quantities = dict(
+                OrderItem.objects.filter(order_id__in=order_ids)
+                .values('product')
+                .annotate(total=Sum('quantity'))
+                .values_list('product', 'total')
+            )
+            release_stock(quantities)
+
+            Order.objects.filter(pk__in=order_ids).update(status='cancelled', updated_at=timezone.now())
+        return order_ids
 
 class Order(models.Model):
     STATUS_CHOICES = [  # 注文状態の選択肢
@@ -11,6 +56,7 @@ class Order(models.Model):
         ('delivered', '配達済み'),
         ('cancelled', 'キャンセル済み'),
     ]
+    UNCANCELLABLE_STATUSES = ['cancelled', 'shipped', 'delivered']  # キャンセルできない注文状態
     # ユーザーとの関連付け、djangoのユーザーモデルを使用
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,  
@@ -29,14 +75,25 @@ class Order(models.Model):
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='注文日時')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='更新日時')
 
+    objects = OrderQuerySet.as_manager()
+
     class Meta:
         verbose_name = '注文'
         verbose_name_plural = '注文'
         ordering = ['-created_at']
+        indexes = [
+            # ユーザーごとの注文履歴(新着順)
+            models.Index(fields=['user', '-created_at', '-id'], name='order_user_created_idx'),
+        ]
 
     def __str__(self):
         return f"Order {self.id} by {self.user.username}"
 
+    def prefetch_items(self):
+        """注文商品を1クエリで読み込む(作成した注文を読み直さずにシリアライズする)"""
+        prefetch_related_objects([self], items_prefetch())
+        return self
+
     def calculate_total(self):
         """注文内の商品の合計金額を計算"""
         return sum(item.get_subtotal() for item in self.items.all())
@@ -84,8 +141,11 @@ class Payment(models.Model):
         ('completed', '支払い完了'),
         ('failed', '支払い失敗'),
         ('cancelled', 'キャンセル済'),
-        ('refunded', '返金済み')
+        ('refunded', '返金済み'),
+        ('needs_review', '要確認')  # 支払い完了時に注文がキャンセル済みなどで、返金の要否を確認する
     ]
+    ACTIVE_STATUSES = ['processing', 'completed']  # この状態の支払いがある注文はキャンセルできない
+    UNSETTLED_STATUSES = ['pending', 'processing', 'failed']  # webhookで完了にできる状態
 
     order = models.OneToOneField(
         'Order', 
@@ -110,9 +170,66 @@ class Payment(models.Model):
         blank=True,
         null=True
     )
+    # コンビニ・銀行振込の支払いページ(Checkout Session)のID。完了はwebhookのmetadataの注文IDで反映する
+    stripe_checkout_session_id = models.CharField(
+        'Stripe Checkout Session ID',
+        max_length=255,
+        blank=True,
+        null=True
+    )
+    idempotency_key = models.CharField(
+        '冪等キー',
+        max_length=64,
+        blank=True,
+        default=''
+    )  # 決済サービスへの同じ支払いの再送を重複させないためのキー
     created_at = models.DateTimeField('作成日時', auto_now_add=True)
     updated_at = models.DateTimeField('更新日時', auto_now=True)
 
     class Meta:
         verbose_name = '支払い情報'
         verbose_name_plural = '支払い情報'
+        constraints = [
+            # webhookでのPayment Intent IDからの検索用(未設定の行は対象外)
+            models.UniqueConstraint(
+                fields=['stripe_payment_intent_id'],
+                condition=models.Q(stripe_payment_intent_id__isnull=False),
+                name='payment_intent_id_unique'
+            ),
+        ]
+
+class WebhookEvent(models.Model):
+    """受信したwebhookイベント(イベントIDで重複排除し、ワーカーがまとめて反映する)"""
+    STATUS_CHOICES = [
+        ('pending', '未処理'),
+        ('processed', '処理済み'),
+        ('failed', '処理失敗'),
+    ]
+
+    event_id = models.CharField('イベントID', max_length=255, unique=True)
+    event_type = models.CharField('イベント種別', max_length=100)
+    payload = models.JSONField('内容')
+    status = models.CharField('処理状態', max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField('処理回数', default=0)
+    last_error = models.TextField('エラー内容', blank=True)
+    received_at = models.DateTimeField('受信日時', auto_now_add=True)
+    processed_at = models.DateTimeField('処理日時', null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Webhookイベント'
+        verbose_name_plural = 'Webhookイベント'
+        indexes = [
+            # ワーカーが未処理のイベントを古い順に取り出す
+            models.Index(fields=['received_at', 'id'], condition=models.Q(status='pending'), name='webhook_pending_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.event_type} ({self.event_id})"
+
+
+def items_prefetch():
+    """注文商品を商品・カテゴリーごと必要なカラムだけ読み込む Prefetch"""
+    items = OrderItem.objects.select_related('product__category').only(
+        'id', 'order', 'quantity', 'price', *[f'product__{column}' for column in PRODUCT_LIST_COLUMNS]
+    )
+    return Prefetch('items', queryset=items)
@@ -0,0 +1,155 @@
+"""支払い処理
+
+決済サービスへの通信中にDB接続やロックを保持しないよう、次の3段階で処理する。
+
+1. start_payment / begin_payment: 短いトランザクションで Payment を「処理中」として確定する
+2. 決済サービス呼び出し: トランザクションの外で、冪等キーを付けて呼ぶ(orders/providers)
+3. finish_payment(apply_result / mark_failed): 結果を短いトランザクションで反映する
+
+同期版(OrderViewSet.process_payment)と非同期版(async_views.process_payment)のビューは
+どちらもこの順に呼び出し、2. の呼び出し方だけが異なる。
+
+通信エラーで結果が分からない場合は Payment を「処理中」のまま残す。
+同じ支払い方法で再試行すると同じ冪等キーが使われるため、決済サービス側で二重決済にならない。
+処理中の支払いの支払い方法は、webhookなどで結果が確定するまで変更できない
+(新しい冪等キーで別の支払いを作ると、前回の支払いが成功していた場合に二重決済になるため)。
+"""
+import logging
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Order, Payment
+from .providers import PaymentDeclined, ProviderUnavailable, get_provider
+from .serializers import PaymentSerializer
+
+logger = logging.getLogger(__name__)
+
+class PaymentError(Exception):
+    """支払いを始められない場合に送出される(message と status_code をそのまま応答に使う)"""
+    message = '支払いを開始できません'
+    status_code = 400
+
+
+class PaymentAlreadyCompleted(PaymentError):
+    """支払い済みの注文に再度支払おうとした場合に送出される"""
+    message = '既に支払い済みです'
+
+
+class PaymentInProgress(PaymentError):
+    """結果が確定していない支払いを別の支払い方法でやり直そうとした場合に送出される"""
+    message = '前回の支払いを処理中です。しばらくしてから再度お試しください'
+    status_code = 409
+
+
+class OrderNotPayable(PaymentError):
+    """支払い待ちでない注文(キャンセル済みなど)に支払おうとした場合に送出される"""
+    message = 'この注文は支払いできません'
+
+
+class PaymentMethodNotSupported(PaymentError):
+    """設定された決済サービスが対応していない支払い方法の場合に送出される"""
+    message = 'この支払い方法は現在対応していません'
+
+
+def start_payment(order, payment_method):
+    """決済サービスを選び、注文の Payment を「処理中」にして (決済サービス, Payment) を返す"""
+    provider = get_provider()
+    if payment_method not in provider.supported_methods:
+        raise PaymentMethodNotSupported()
+    return provider, begin_payment(order, payment_method)
+
+
+def begin_payment(order, payment_method):
+    """注文の Payment を「処理中」にして返す(トランザクション1)"""
+    with transaction.atomic():
+        order = Order.objects.select_for_update().get(pk=order.pk)
+        payment = Payment.objects.filter(order=order).first()
+        if payment is not None and payment.status == 'completed':
+            raise PaymentAlreadyCompleted()
+        if order.status != 'pending':
+            raise OrderNotPayable()
+
+        if payment is not None and payment.status == 'processing':
+            if payment.payment_method != payment_method:
+                raise PaymentInProgress()
+            # 前回の処理が完了していない(タイムアウトなど)場合は同じ冪等キーで再試行する
+            return payment
+
+        if payment is None:
+            payment = Payment(order=order)
+        payment.amount = order.total_price  # 注文時に確定した合計金額
+        payment.payment_method = payment_method
+        payment.status = 'processing'
+        payment.idempotency_key = uuid.uuid4().hex
+        payment.save()
+    return payment
+
+
+def apply_result(payment, result):
+    """決済サービスの結果(PaymentResult)を反映する(トランザクション2)"""
+    with transaction.atomic():
+        payment = Payment.objects.select_for_update().get(pk=payment.pk)
+        # Stripe以外(偽の決済サービスなど)のIDは保存しない(webhookのPayment Intent IDと照合されるため)
+        if result.payment_intent_id:
+            payment.stripe_payment_intent_id = result.payment_intent_id
+        if result.checkout_session_id:
+            payment.stripe_checkout_session_id = result.checkout_session_id
+        if result.status == 'redirect':
+            pass  # 支払いの完了はwebhookで反映する
+        elif result.status == 'completed':
+            payment.status = 'completed'
+            # 注文ステータスも更新(支払い待ちの注文だけ)
+            if not mark_order_paid(payment):
+                payment.status = 'needs_review'
+        elif payment.status != 'completed':  # webhookで先に完了していれば上書きしない
+            payment.status = 'failed'
+        payment.save()
+    return payment
+
+
+def mark_order_paid(payment):
+    """支払い待ちの注文を支払い済みにし、できたかどうかを返す(トランザクション内で呼ぶ)
+
+    キャンセル済みなど支払い待ちでない注文は変更せず、返金の要否を確認できるようログに残す。
+    """
+    if Order.objects.filter(pk=payment.order_id, status='pending').update(status='paid', updated_at=timezone.now()):
+        return True
+    logger.error('支払い %s が完了しましたが、注文 %s が支払い待ちではありません(返金の要否を確認してください)',
+                 payment.pk, payment.order_id)
+    return False
+
+
+def mark_failed(payment):
+    """処理中の支払いを失敗にする"""
+    Payment.objects.filter(pk=payment.pk, status='processing').update(status='failed', updated_at=timezone.now())
+    payment.status = 'failed'
+    return payment
+
+
+def finish_payment(payment, result=None, error=None):
+    """決済サービスの呼び出し結果を反映し、(HTTPステータス, レスポンスの内容) を返す
+
+    呼び出しが例外で終わった場合は result の代わりに error にその例外を渡す。
+    """
+    error_messages = settings.PAYMENT_SETTINGS['error_messages']
+    if error is None:
+        payment = apply_result(payment, result)
+        if result.status == 'redirect':
+            # コンビニ・銀行振込などは支払いページに誘導する
+            return 200, {'session_id': result.transaction_id, 'session_url': result.redirect_url}
+        return 200, PaymentSerializer(payment).data
+
+    if isinstance(error, PaymentDeclined):
+        # カードエラーの場合
+        mark_failed(payment)
+        return 400, {'error': error_messages['card_error']}
+    if isinstance(error, ProviderUnavailable):
+        # タイムアウトなどで結果が不明な場合は処理中のまま残す(再試行時は同じ冪等キーを使う)
+        return 503, {'error': error_messages['system_error']}
+    # その他のエラー(APIキーの誤りなど、再試行しても成功しないもの)
+    logger.error('支払い %s の決済サービスの呼び出しに失敗しました', payment.pk, exc_info=error)
+    mark_failed(payment)
+    return 500, {'error': error_messages['system_error']}
@@ -0,0 +1,21 @@
+"""決済サービス(プロバイダー)
+
+settings.PAYMENT_PROVIDER で使うプロバイダーを切り替える(未設定なら 'stripe')。
+'fake' はネットワークを使わないプロセス内の偽プロバイダーで、負荷試験・開発用。
+新しい支払い方法はプロバイダー側に追加すれば、ビューを変更せずに使える。
+"""
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .base import PaymentDeclined, PaymentProvider, PaymentResult, ProviderUnavailable
+
+PROVIDERS = {
+    'stripe': 'orders.providers.stripe_provider.StripeProvider',
+    'fake': 'orders.providers.fake.FakeProvider',
+}
+
+
+def get_provider():
+    """設定されたプロバイダーを返す"""
+    name = getattr(settings, 'PAYMENT_PROVIDER', 'stripe')
+    return import_string(PROVIDERS.get(name, name))()
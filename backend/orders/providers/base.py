@@ -0,0 +1,39 @@
+class PaymentDeclined(Exception):
+    """カードの拒否など、支払いが受け付けられなかった場合に送出される"""
+
+
+class ProviderUnavailable(Exception):
+    """タイムアウトなどで結果が分からない場合に送出される(同じ冪等キーで再試行できる)"""
+
+
+class PaymentResult:
+    """プロバイダーでの支払い結果
+
+    status:
+        'completed'  支払い完了
+        'failed'     支払い失敗
+        'redirect'   利用者を redirect_url に誘導して支払ってもらう(完了はwebhookで通知される)
+    """
+
+    def __init__(self, status, transaction_id=None, redirect_url=None, payment_intent_id=None, checkout_session_id=None):
+        self.status = status
+        self.transaction_id = transaction_id  # プロバイダー側の支払いID(StripeならPaymentIntent/Checkout SessionのID)
+        self.redirect_url = redirect_url
+        # Stripeの場合のIDの種類ごとの値(Payment の同名の列に保存する。webhookとの照合に使う)
+        self.payment_intent_id = payment_intent_id
+        self.checkout_session_id = checkout_session_id
+
+
+class PaymentProvider:
+    """決済サービスのインターフェース"""
+
+    # 対応している支払い方法(Payment.PAYMENT_METHODS の値)
+    supported_methods = set()
+
+    def create_payment(self, payment, *, payment_method_id=None, user_id=None, success_url=None, cancel_url=None):
+        """支払いを実行して PaymentResult を返す
+
+        payment.idempotency_key を冪等キーとして使い、同じキーでの再送で二重に支払われないようにすること。
+        トランザクションの外から呼ばれる。
+        """
+        raise NotImplementedError
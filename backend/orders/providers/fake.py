@@ -0,0 +1,41 @@
+import random
+import time
+import uuid
+
+from django.conf import settings
+
+from orders.models import Payment
+from .base import PaymentDeclined, PaymentProvider, PaymentResult, ProviderUnavailable
+
+
+class FakeProvider(PaymentProvider):
+    """ネットワークを使わない偽の決済サービス(負荷試験・開発用)
+
+    settings.PAYMENT_FAKE_PROVIDER で動作を調整できる。
+        latency       応答までの秒数(既定 0.2)
+        decline_rate  カード拒否(PaymentDeclined)になる割合(既定 0)
+        failure_rate  タイムアウト(ProviderUnavailable)になる割合(既定 0)
+    """
+
+    supported_methods = {method for method, _ in Payment.PAYMENT_METHODS}
+    redirect_methods = {'konbini', 'bank_transfer'}
+
+    def __init__(self):
+        options = getattr(settings, 'PAYMENT_FAKE_PROVIDER', {})
+        self.latency = options.get('latency', 0.2)
+        self.decline_rate = options.get('decline_rate', 0.0)
+        self.failure_rate = options.get('failure_rate', 0.0)
+
+    def create_payment(self, payment, *, payment_method_id=None, user_id=None, success_url=None, cancel_url=None):
+        time.sleep(self.latency)
+        roll = random.random()
+        if roll < self.failure_rate:
+            raise ProviderUnavailable('fake provider timeout')
+        if roll < self.failure_rate + self.decline_rate:
+            raise PaymentDeclined('fake provider declined')
+
+        # 冪等キーから支払いIDを作るので、同じキーでの再送は同じ支払いになる
+        transaction_id = f'fake_{uuid.uuid5(uuid.NAMESPACE_OID, payment.idempotency_key).hex}'
+        if payment.payment_method in self.redirect_methods:
+            return PaymentResult('redirect', transaction_id=transaction_id, redirect_url=f'https://fake-pay.invalid/{transaction_id}')
+        return PaymentResult('completed', transaction_id=transaction_id)
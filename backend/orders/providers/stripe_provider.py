@@ -0,0 +1,68 @@
+import stripe
+from django.conf import settings
+
+from .base import PaymentDeclined, PaymentProvider, PaymentResult, ProviderUnavailable
+
+# Stripe設定
+stripe.api_key = settings.STRIPE_SECRET_KEY
+stripe.max_network_retries = getattr(settings, 'STRIPE_MAX_NETWORK_RETRIES', 2)  # 再試行時も冪等キーで重複しない
+stripe.default_http_client = stripe.http_client.new_default_http_client(
+    timeout=getattr(settings, 'STRIPE_TIMEOUT', 10)
+)
+
+
+class StripeProvider(PaymentProvider):
+    supported_methods = {'card', 'konbini', 'bank_transfer'}
+
+    def create_payment(self, payment, *, payment_method_id=None, user_id=None, success_url=None, cancel_url=None):
+        metadata = {
+            'order_id': payment.order_id,
+            'user_id': user_id
+        }
+        try:
+            if payment.payment_method == 'card':
+                # Stripeの支払いIntentを作成
+                intent = stripe.PaymentIntent.create(
+                    amount=payment.amount,
+                    currency='jpy',
+                    payment_method=payment_method_id,
+                    confirm=True,  # 即時決済
+                    metadata=metadata,
+                    idempotency_key=payment.idempotency_key
+                )
+                status = 'completed' if intent.status == 'succeeded' else 'failed'
+                return PaymentResult(status, transaction_id=intent.id, payment_intent_id=intent.id)
+
+            # コンビニ・銀行振込の場合はStripeの支払いリンクを作成
+            session = stripe.checkout.Session.create(
+                payment_method_types=[payment.payment_method],
+                line_items=[{
+                    'price_data': {
+                        'currency': 'jpy',
+                        'product_data': {
+                            'name': f'注文 #{payment.order_id}',
+                        },
+                        'unit_amount': payment.amount,
+                    },
+                    'quantity': 1,
+                }],
+                mode='payment',
+                success_url=success_url,
+                cancel_url=cancel_url,
+                metadata=metadata,
+                # 支払いで作られるPaymentIntentのwebhookも注文IDで照合できるようにする
+                payment_intent_data={'metadata': metadata},
+                idempotency_key=payment.idempotency_key
+            )
+            return PaymentResult(
+                'redirect', transaction_id=session.id, redirect_url=session.url, checkout_session_id=session.id
+            )
+
+        except stripe.error.CardError as e:
+            raise PaymentDeclined(str(e)) from e
+        except (stripe.error.APIConnectionError, stripe.error.RateLimitError, stripe.error.APIError) as e:
+            # 通信エラー・レート制限・Stripe側の障害は結果が分からないため
+            # 失敗にせず処理中のままにする(同じ冪等キーでやり直せる)
+            raise ProviderUnavailable(str(e)) from e
+        # APIキーの誤り(AuthenticationError)や不正なリクエスト(InvalidRequestError)などは
+        # 再試行しても成功しないため、そのまま送出して支払いを失敗にする
@@ -0,0 +1,76 @@
+"""ベンチマーク・負荷試験用のユーザー・カート・注文データ生成(商品は products/seed.py)"""
+import random
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+
+from carts.models import Cart, CartItem
+from products.models import Product
+from .models import Order, OrderItem, Payment
+
+USERNAME_PREFIX = 'shopper'
+PAID_STATUSES = ['paid', 'preparing', 'shipped', 'delivered']
+
+
+def seed_users(users=100, password='password', batch_size=5000):
+    """ログインできるユーザーをbulk_createでまとめて作成する(パスワードのハッシュ化は1回だけ)"""
+    User = get_user_model()
+    offset = User.objects.filter(username__startswith=USERNAME_PREFIX).count()
+    hashed = make_password(password)
+    return User.objects.bulk_create([
+        User(username=f'{USERNAME_PREFIX}{offset + i}', email=f'{USERNAME_PREFIX}{offset + i}@example.com', password=hashed)
+        for i in range(users)
+    ], batch_size=batch_size)
+
+
+def seed_shop(users, carts=0, orders=0, max_items=3, batch_size=5000, seed=0):
+    """users のうち carts 人にカートを、ランダムなユーザーに orders 件の注文を作成する
+
+    在庫のある商品から選ぶ(在庫は減らさない)。支払い済み以降の状態の注文には完了した支払いを付ける。
+    """
+    rng = random.Random(seed)
+    prices = dict(Product.objects.filter(stock__gt=0).values_list('pk', 'price'))
+    if not prices or not users:
+        return
+    product_ids = list(prices)
+
+    def pick_items():
+        chosen = rng.sample(product_ids, min(len(product_ids), rng.randint(1, max_items)))
+        return [(product_id, rng.randint(1, 3)) for product_id in chosen]
+
+    # カート(ユーザーごとに1つ)
+    created_carts = Cart.objects.bulk_create(
+        [Cart(user=user) for user in users[:carts]], batch_size=batch_size
+    )
+    CartItem.objects.bulk_create([
+        CartItem(cart=cart, product_id=product_id, quantity=quantity)
+        for cart in created_carts
+        for product_id, quantity in pick_items()
+    ], batch_size=batch_size)
+    Cart.objects.filter(pk__in=[cart.pk for cart in created_carts]).recalculate_totals()
+
+    # 注文と注文商品・支払い
+    order_items = [pick_items() for _ in range(orders)]
+    created_orders = Order.objects.bulk_create([
+        Order(
+            user=rng.choice(users),
+            status=rng.choice([status for status, _ in Order.STATUS_CHOICES]),
+            shipping_address='東京都千代田区千代田1-1',
+            total_price=sum(prices[product_id] * quantity for product_id, quantity in items)
+        )
+        for items in order_items
+    ], batch_size=batch_size)
+    OrderItem.objects.bulk_create([
+        OrderItem(order=order, product_id=product_id, quantity=quantity, price=prices[product_id])
+        for order, items in zip(created_orders, order_items)
+        for product_id, quantity in items
+    ], batch_size=batch_size)
+    Payment.objects.bulk_create([
+        Payment(
+            order=order,
+            amount=order.total_price,
+            payment_method=rng.choice(Payment.PAYMENT_METHODS)[0],
+            status='completed'
+        )
+        for order in created_orders if order.status in PAID_STATUSES
+    ], batch_size=batch_size)
@@ -1,9 +1,13 @@
+from django.db import transaction
 from rest_framework import serializers
+from ec_shop.performance import TimedSerializerMixin
 from .models import Order, OrderItem, Payment
-from products.serializers import ProductSerializer
+from carts.models import Cart, CartItem
+from products.inventory import InsufficientStock, reserve_stock
+from products.serializers import ProductListSerializer
 
-class OrderItemSerializer(serializers.ModelSerializer):
-    product = ProductSerializer(read_only=True)
+class OrderItemSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    product = ProductListSerializer(read_only=True)
     subtotal = serializers.SerializerMethodField()
 
     class Meta:
@@ -14,7 +18,7 @@ class OrderItemSerializer(serializers.ModelSerializer):
     def get_subtotal(self, obj):
         return obj.get_subtotal()
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     items = OrderItemSerializer(many=True, read_only=True)
     status_display = serializers.CharField(source='get_status_display', read_only=True)
 
@@ -32,43 +36,57 @@ class CreateOrderSerializer(serializers.ModelSerializer):
         user = self.context['request'].user
         cart = user.cart
 
-        # カートが空の場合はエラー
-        if not cart.items.exists():
-            raise serializers.ValidationError({'error': 'カートが空です'})
-
-        # 在庫チェック
-        for cart_item in cart.items.all():
-            if cart_item.quantity > cart_item.product.stock:
-                raise serializers.ValidationError({
-                    'error': f'{cart_item.product.name}の在庫が不足しています'
-                })
-
-        # 注文を作成
-        order = Order.objects.create(
-            user=user,
-            shipping_address=validated_data['shipping_address'],
-            total_price=cart.get_total_price()
-        )
-
-        # カートの商品を注文商品に変換
-        for cart_item in cart.items.all():
-            OrderItem.objects.create(
-                order=order,
-                product=cart_item.product,
-                quantity=cart_item.quantity,
-                price=cart_item.product.price
+        with transaction.atomic():
+            # カートをロックしてから商品を1クエリでまとめて取得し、以降はこの行だけを使う
+            # (カートの変更はロックで直列になるため、読んだ後に追加された商品を注文せずに消さない)
+            cart.lock()
+            cart_items = list(cart.items.select_related('product'))
+
+            # カートが空の場合はエラー
+            if not cart_items:
+                raise serializers.ValidationError({'error': 'カートが空です'})
+
+            # 在庫を引き当てる(商品行をロックして条件付きで減らす)
+            quantities = {}
+            for cart_item in cart_items:
+                quantities[cart_item.product_id] = quantities.get(cart_item.product_id, 0) + cart_item.quantity
+            try:
+                reserve_stock(quantities)
+            except InsufficientStock as e:
+                raise serializers.ValidationError({'error': str(e)})
+
+            # 注文を作成
+            order = Order.objects.create(
+                user=user,
+                shipping_address=validated_data['shipping_address'],
+                total_price=sum(cart_item.get_subtotal() for cart_item in cart_items)
             )
-            # 在庫を減らす
-            product = cart_item.product
-            product.stock -= cart_item.quantity
-            product.save()
 
-        # カートを空にする
-        cart.items.all().delete()
+            # カートの商品を注文商品に変換(一括INSERT)
+            OrderItem.objects.bulk_create([
+                OrderItem(
+                    order=order,
+                    product=cart_item.product,
+                    quantity=cart_item.quantity,
+                    price=cart_item.product.price
+                )
+                for cart_item in cart_items
+            ])
+
+            # 注文した商品だけをカートから消し、合計金額・点数を集計し直す
+            CartItem.objects.filter(pk__in=[cart_item.pk for cart_item in cart_items]).delete()
+            Cart.objects.filter(pk=cart.pk).recalculate_totals()
 
         return order
 
-class PaymentSerializer(serializers.ModelSerializer):
+class BulkCancelSerializer(serializers.Serializer):
+    order_ids = serializers.ListField(
+        child=serializers.IntegerField(),
+        allow_empty=False,
+        max_length=1000
+    )
+
+class PaymentSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Payment
         fields = [
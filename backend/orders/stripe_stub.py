@@ -0,0 +1,46 @@
+"""負荷試験用のローカルStripeスタブ
+
+PaymentIntent・Checkout Session の作成APIだけを、指定した遅延の後に成功として返す。
+stripe.api_base をこのサーバーに向けて使う。
+"""
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StripeStubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        time.sleep(self.server.latency)
+
+        if self.path.startswith('/v1/payment_intents'):
+            body = {'id': f'pi_stub_{uuid.uuid4().hex}', 'object': 'payment_intent', 'status': 'succeeded'}
+        elif self.path.startswith('/v1/checkout/sessions'):
+            session_id = f'cs_stub_{uuid.uuid4().hex}'
+            body = {'id': session_id, 'object': 'checkout.session', 'url': f'http://stripe.invalid/{session_id}'}
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass  # アクセスログは出さない
+
+
+def start_stub(latency=0.2, host='127.0.0.1', port=0):
+    """スタブをバックグラウンドで起動し、サーバーを返す(URLは server.url)"""
+    server = ThreadingHTTPServer((host, port), StripeStubHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.url = f'http://{host}:{server.server_address[1]}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -1,3 +1,721 @@
-from django.test import TestCase
+import base64
+import hashlib
+import hmac
+import io
+import json
+import time
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import stripe
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authentication import BasicAuthentication
+from rest_framework.test import APIClient
+
+from ec_shop.testing import RouteBudgetMixin
+
+from carts.models import Cart, CartItem
+from products.models import Product
+from . import serializers, webhooks
+from .admin import OrderAdmin
+from .models import Order, OrderItem, Payment, WebhookEvent
+from .views import OrderViewSet
+
+User = get_user_model()
+
+
+class CheckoutTests(TestCase):
+    """注文作成(チェックアウト)の動作とクエリ数を確認する"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.cart = Cart.objects.create(user=self.user)
+
+    def fill_cart(self, count, stock=10, quantity=2):
+        products = []
+        for i in range(count):
+            product = Product.objects.create(name=f'商品{i}', description='', price=100 + i, stock=stock)
+            CartItem.objects.create(cart=self.cart, product=product, quantity=quantity)
+            products.append(product)
+        Cart.objects.filter(pk=self.cart.pk).recalculate_totals()
+        return products
+
+    def checkout(self):
+        return self.client.post('/api/orders/orders/', {'shipping_address': '東京都'}, format='json')
+
+    def test_checkout_creates_items_and_decrements_stock(self):
+        products = self.fill_cart(3)
+        response = self.checkout()
+        self.assertEqual(response.status_code, 201)
+        order = Order.objects.get(pk=response.data['id'])
+        self.assertEqual(order.total_price, (100 + 101 + 102) * 2)
+        self.assertEqual(order.items.count(), 3)
+        for product in products:
+            product.refresh_from_db()
+            self.assertEqual(product.stock, 8)
+        self.assertFalse(self.cart.items.exists())
+        self.cart.refresh_from_db()
+        self.assertEqual((self.cart.total_price, self.cart.item_count), (0, 0))
+
+    def test_checkout_keeps_item_added_after_reading_cart(self):
+        products = self.fill_cart(1)
+        added = Product.objects.create(name='追加', description='', price=500, stock=10)
+
+        def reserve_stock(quantities):
+            # 注文するアイテムを読んだ後に、同じカートへ商品が追加された場合
+            CartItem.objects.create(cart=self.cart, product=added, quantity=1)
+            return original(quantities)
+
+        original = serializers.reserve_stock
+        with mock.patch.object(serializers, 'reserve_stock', reserve_stock):
+            response = self.checkout()
+        self.assertEqual(response.status_code, 201)
+        order = Order.objects.get(pk=response.data['id'])
+        self.assertEqual([item.product_id for item in order.items.all()], [products[0].pk])
+        self.assertEqual([item.product_id for item in self.cart.items.all()], [added.pk])
+        self.cart.refresh_from_db()
+        self.assertEqual((self.cart.total_price, self.cart.item_count), (500, 1))
+
+    def test_checkout_rejects_insufficient_stock(self):
+        products = self.fill_cart(2, stock=1)
+        response = self.checkout()
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Order.objects.exists())
+        products[0].refresh_from_db()
+        self.assertEqual(products[0].stock, 1)
+
+    def test_checkout_query_count_is_constant(self):
+        self.fill_cart(1)
+        with CaptureQueriesContext(connection) as small:
+            self.assertEqual(self.checkout().status_code, 201)
+        self.fill_cart(20)
+        with CaptureQueriesContext(connection) as large:
+            self.assertEqual(self.checkout().status_code, 201)
+        self.assertEqual(len(large.captured_queries), len(small.captured_queries))
+
+
+class CancelTests(TestCase):
+    """注文キャンセル時の在庫戻し"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.product = Product.objects.create(name='商品', description='', price=100, stock=0)
+
+    def create_order(self, quantity=2, status='pending', user=None):
+        order = Order.objects.create(
+            user=user or self.user, shipping_address='東京都', total_price=100 * quantity, status=status
+        )
+        OrderItem.objects.create(order=order, product=self.product, quantity=quantity, price=100)
+        return order
+
+    def test_cancel_restores_stock(self):
+        order = self.create_order()
+        response = self.client.post(f'/api/orders/orders/{order.pk}/cancel/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], 'cancelled')
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 2)
+
+        # 二重キャンセルでは在庫が増えない
+        response = self.client.post(f'/api/orders/orders/{order.pk}/cancel/')
+        self.assertEqual(response.status_code, 400)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 2)
+
+    def test_bulk_cancel(self):
+        first = self.create_order(quantity=1)
+        second = self.create_order(quantity=3)
+        shipped = self.create_order(quantity=5, status='shipped')
+        other_user = User.objects.create_user(username='other', password='pass')
+        others = self.create_order(quantity=7, user=other_user)
+
+        response = self.client.post(
+            '/api/orders/orders/bulk_cancel/',
+            {'order_ids': [first.pk, second.pk, shipped.pk, others.pk]},
+            format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(response.data['cancelled']), sorted([first.pk, second.pk]))
+        self.assertEqual(response.data['skipped'], sorted([shipped.pk, others.pk]))
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 4)
+        others.refresh_from_db()
+        self.assertEqual(others.status, 'pending')
+
+
+class OrderConditionalGetTests(TestCase):
+    """注文状態のポーリングで 304 を返す"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.order = Order.objects.create(user=self.user, shipping_address='東京都', total_price=100)
+
+    def test_status_change_invalidates_etag(self):
+        url = f'/api/orders/orders/{self.order.pk}/'
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.order.status = 'paid'
+        self.order.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], 'paid')
+
+    def test_list_if_modified_since(self):
+        last_modified = self.client.get('/api/orders/orders/')['Last-Modified']
+        response = self.client.get('/api/orders/orders/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+
+class ProcessPaymentTests(TestCase):
+    """支払い処理(Stripe呼び出しはトランザクション外)"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        product = Product.objects.create(name='商品', description='', price=500, stock=10)
+        self.order = Order.objects.create(user=self.user, shipping_address='東京都', total_price=1000)
+        OrderItem.objects.create(order=self.order, product=product, quantity=2, price=500)
+        self.url = f'/api/orders/orders/{self.order.pk}/process_payment/'
+
+    def pay(self):
+        return self.client.post(self.url, {'payment_method': 'card', 'payment_method_id': 'pm_card_visa'}, format='json')
+
+    def test_card_payment_calls_stripe_outside_transaction(self):
+        outer_atomic_blocks = len(connection.atomic_blocks)
+        calls = []
+
+        def create_intent(**kwargs):
+            # テスト自体のトランザクション以外は張られていないこと
+            calls.append(len(connection.atomic_blocks) - outer_atomic_blocks)
+            self.assertEqual(Payment.objects.get(order=self.order).status, 'processing')
+            return SimpleNamespace(id='pi_1', status='succeeded')
+
+        with mock.patch('stripe.PaymentIntent.create', side_effect=create_intent) as create:
+            response = self.pay()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(calls, [0])
+        self.assertEqual(create.call_args.kwargs['amount'], 1000)
+        self.assertTrue(create.call_args.kwargs['idempotency_key'])
+
+        payment = Payment.objects.get(order=self.order)
+        self.assertEqual((payment.status, payment.stripe_payment_intent_id), ('completed', 'pi_1'))
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'paid')
+
+        response = self.pay()
+        self.assertEqual(response.status_code, 400)
+
+    def test_retry_after_timeout_reuses_idempotency_key(self):
+        with mock.patch('stripe.PaymentIntent.create', side_effect=stripe.error.APIConnectionError('timeout')) as create:
+            response = self.pay()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(Payment.objects.get(order=self.order).status, 'processing')
+        first_key = create.call_args.kwargs['idempotency_key']
+
+        with mock.patch('stripe.PaymentIntent.create', return_value=SimpleNamespace(id='pi_1', status='succeeded')) as create:
+            response = self.pay()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(create.call_args.kwargs['idempotency_key'], first_key)
+
+    def test_retry_after_timeout_with_another_method_is_rejected(self):
+        with mock.patch('stripe.PaymentIntent.create', side_effect=stripe.error.APIConnectionError('timeout')):
+            self.assertEqual(self.pay().status_code, 503)
+
+        # 前回の支払いが成功しているかもしれないため、新しい冪等キーで別の支払いを作らない
+        with mock.patch('stripe.checkout.Session.create') as create:
+            response = self.client.post(self.url, {'payment_method': 'konbini'}, format='json')
+        self.assertEqual(response.status_code, 409)
+        create.assert_not_called()
+        payment = Payment.objects.get(order=self.order)
+        self.assertEqual((payment.status, payment.payment_method), ('processing', 'card'))
+
+    def test_cancel_during_payment_is_refused(self):
+        cancel_responses = []
+
+        def create_intent(**kwargs):
+            # 決済サービスの応答を待つ間にキャンセルされても在庫を戻さない
+            cancel_responses.append(self.client.post(f'/api/orders/orders/{self.order.pk}/cancel/').status_code)
+            return SimpleNamespace(id='pi_1', status='succeeded')
+
+        with mock.patch('stripe.PaymentIntent.create', side_effect=create_intent):
+            response = self.pay()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(cancel_responses, [400])
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'paid')
+        self.assertEqual(Product.objects.get().stock, 10)
+
+        # 支払い済みの注文もキャンセルできない
+        self.assertEqual(self.client.post(f'/api/orders/orders/{self.order.pk}/cancel/').status_code, 400)
+
+    def test_payment_completed_for_cancelled_order_needs_review(self):
+        def create_intent(**kwargs):
+            # 管理画面などで支払い中に注文状態が変わった場合
+            Order.objects.filter(pk=self.order.pk).update(status='cancelled')
+            return SimpleNamespace(id='pi_1', status='succeeded')
+
+        with mock.patch('stripe.PaymentIntent.create', side_effect=create_intent), \
+                self.assertLogs('orders.payments', 'ERROR'):
+            response = self.pay()
+        self.assertEqual(response.json()['status'], 'needs_review')
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'cancelled')
+
+    def test_cancelled_order_is_not_charged(self):
+        Order.objects.filter(pk=self.order.pk).update(status='cancelled')
+        with mock.patch('stripe.PaymentIntent.create') as create:
+            response = self.pay()
+        self.assertEqual(response.status_code, 400)
+        create.assert_not_called()
+        self.assertFalse(Payment.objects.filter(order=self.order).exists())
+
+    def test_transient_stripe_errors_keep_payment_processing(self):
+        errors = [
+            stripe.error.RateLimitError('too many requests'),
+            stripe.error.APIError('internal error'),
+            stripe.error.APIConnectionError('timeout'),
+        ]
+        keys = []
+        for error in errors:
+            with self.subTest(error=type(error).__name__):
+                with mock.patch('stripe.PaymentIntent.create', side_effect=error) as create:
+                    response = self.pay()
+                self.assertEqual(response.status_code, 503)
+                self.assertEqual(Payment.objects.get(order=self.order).status, 'processing')
+                keys.append(create.call_args.kwargs['idempotency_key'])
+        self.assertEqual(len(set(keys)), 1)
+
+    def test_permanent_stripe_errors_mark_payment_failed(self):
+        errors = [
+            stripe.error.AuthenticationError('invalid api key'),
+            stripe.error.InvalidRequestError('no such payment method', 'payment_method'),
+            stripe.error.PermissionError('not allowed'),
+        ]
+        for error in errors:
+            with self.subTest(error=type(error).__name__):
+                Payment.objects.filter(order=self.order).delete()
+                with mock.patch('stripe.PaymentIntent.create', side_effect=error), \
+                        self.assertLogs('orders.payments', 'ERROR'):
+                    response = self.pay()
+                self.assertEqual(response.status_code, 500)
+                self.assertEqual(Payment.objects.get(order=self.order).status, 'failed')
+
+    def test_checkout_session_id_is_not_stored_as_payment_intent(self):
+        session = SimpleNamespace(id='cs_1', url='https://checkout.stripe.com/c/cs_1')
+        with mock.patch('stripe.checkout.Session.create', return_value=session):
+            response = self.client.post(self.url, {'payment_method': 'konbini'}, format='json')
+        self.assertEqual(response.json()['session_id'], 'cs_1')
+        payment = Payment.objects.get(order=self.order)
+        self.assertEqual(
+            (payment.status, payment.stripe_payment_intent_id, payment.stripe_checkout_session_id),
+            ('processing', None, 'cs_1')
+        )
+
+    def test_card_error_marks_payment_failed(self):
+        error = stripe.error.CardError('declined', None, 'card_declined')
+        with mock.patch('stripe.PaymentIntent.create', side_effect=error):
+            response = self.pay()
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Payment.objects.get(order=self.order).status, 'failed')
+
+
+@override_settings(PAYMENT_PROVIDER='fake', PAYMENT_FAKE_PROVIDER={'latency': 0})
+class FakeProviderTests(TestCase):
+    """偽の決済サービスでの支払い"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='pass')
+        self.order = Order.objects.create(user=self.user, shipping_address='東京都', total_price=1000)
+        self.client.force_login(self.user)
+
+    def pay(self, payment_method):
+        return self.client.post(
+            f'/api/orders/orders/{self.order.pk}/process_payment/',
+            {'payment_method': payment_method}, content_type='application/json'
+        )
+
+    def test_methods_not_supported_by_stripe(self):
+        response = self.pay('paypay')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], 'completed')
+        # 偽の決済サービスのIDはStripeの列に保存しない(webhookと照合されないように)
+        payment = Payment.objects.get(order=self.order)
+        self.assertEqual((payment.stripe_payment_intent_id, payment.stripe_checkout_session_id), (None, None))
+
+    def test_redirect_method_waits_for_webhook(self):
+        response = self.pay('konbini')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('session_url', response.json())
+        self.assertEqual(Payment.objects.get(order=self.order).status, 'processing')
+
+    @override_settings(PAYMENT_FAKE_PROVIDER={'latency': 0, 'decline_rate': 1})
+    def test_declined(self):
+        response = self.pay('card')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Payment.objects.get(order=self.order).status, 'failed')
+
+
+class AsyncProcessPaymentTests(TestCase):
+    """非同期版の支払いAPI"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='pass')
+        self.order = Order.objects.create(user=self.user, shipping_address='東京都', total_price=0)
+        self.url = f'/api/orders/async/orders/{self.order.pk}/process_payment/'
+
+    async def test_card_payment(self):
+        await self.async_client.aforce_login(self.user)
+        with mock.patch('stripe.PaymentIntent.create', return_value=SimpleNamespace(id='pi_1', status='succeeded')):
+            response = await self.async_client.post(
+                self.url, {'payment_method': 'card', 'payment_method_id': 'pm_card_visa'},
+                content_type='application/json'
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], 'completed')
+        order = await Order.objects.aget(pk=self.order.pk)
+        self.assertEqual(order.status, 'paid')
+
+    async def test_requires_login_like_sync_view(self):
+        response = await self.async_client.post(self.url, {'payment_method': 'card'}, content_type='application/json')
+        sync_response = await self.async_client.post(
+            f'/api/orders/orders/{self.order.pk}/process_payment/', {'payment_method': 'card'},
+            content_type='application/json'
+        )
+        self.assertIn(response.status_code, (401, 403))
+        self.assertEqual(response.status_code, sync_response.status_code)
+
+    async def test_uses_viewset_authentication_classes(self):
+        # セッション以外(トークンなど)の認証も同期版と同じく使える
+        credentials = base64.b64encode(b'buyer:pass').decode()
+        with mock.patch.object(OrderViewSet, 'authentication_classes', [BasicAuthentication]), \
+                mock.patch('stripe.PaymentIntent.create', return_value=SimpleNamespace(id='pi_1', status='succeeded')):
+            response = await self.async_client.post(
+                self.url, {'payment_method': 'card', 'payment_method_id': 'pm_card_visa'},
+                content_type='application/json', headers={'Authorization': f'Basic {credentials}'}
+            )
+        self.assertEqual(response.status_code, 200)
+
+    async def test_other_users_order_is_not_found(self):
+        other = await User.objects.acreate_user(username='other', password='pass')
+        await self.async_client.aforce_login(other)
+        response = await self.async_client.post(self.url, {'payment_method': 'card'}, content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET='whsec_test')
+class WebhookInboxTests(TestCase):
+    """webhookの受信箱への保存と、ワーカーによる反映"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='pass')
+        self.order = Order.objects.create(user=self.user, shipping_address='東京都', total_price=1000)
+        self.payment = Payment.objects.create(
+            order=self.order, amount=1000, payment_method='card',
+            status='processing', stripe_payment_intent_id='pi_1'
+        )
+
+    def post_event(self, event_id, event_type, obj, url='/api/orders/webhook/stripe/'):
+        payload = json.dumps({
+            'id': event_id, 'object': 'event', 'type': event_type, 'data': {'object': obj}
+        })
+        timestamp = int(time.time())
+        signature = hmac.new(b'whsec_test', f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+        return self.client.post(
+            url, payload, content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=f't={timestamp},v1={signature}'
+        )
+
+    def test_retried_events_are_stored_once_and_applied_by_worker(self):
+        for _ in range(3):
+            response = self.post_event('evt_1', 'payment_intent.succeeded', {'id': 'pi_1', 'object': 'payment_intent'})
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+        # 受信時点ではまだ反映されない
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'processing')
+
+        call_command('process_webhooks', stdout=mock.MagicMock())
+        self.payment.refresh_from_db()
+        self.order.refresh_from_db()
+        self.assertEqual((self.payment.status, self.order.status), ('completed', 'paid'))
+        self.assertEqual(WebhookEvent.objects.get().status, 'processed')
+
+    def test_checkout_session_event(self):
+        self.post_event('evt_2', 'checkout.session.completed', {
+            'id': 'cs_1', 'object': 'checkout.session', 'metadata': {'order_id': str(self.order.pk)}
+        }, url='/api/orders/async/webhook/stripe/')
+        webhooks.process_batch()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'paid')
+
+    def test_checkout_intent_event_before_session_event(self):
+        # Checkoutの支払いはPaymentIntent IDを保存していないので、metadataの注文IDで反映する
+        Payment.objects.filter(pk=self.payment.pk).update(
+            payment_method='konbini', stripe_payment_intent_id=None, stripe_checkout_session_id='cs_1'
+        )
+        self.post_event('evt_4', 'payment_intent.succeeded', {
+            'id': 'pi_2', 'object': 'payment_intent', 'metadata': {'order_id': str(self.order.pk)}
+        })
+        webhooks.process_batch()
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'completed')
+        self.assertEqual(WebhookEvent.objects.get().status, 'processed')
+
+        self.post_event('evt_5', 'checkout.session.completed', {
+            'id': 'cs_1', 'object': 'checkout.session', 'metadata': {'order_id': str(self.order.pk)}
+        })
+        webhooks.process_batch()
+        self.assertEqual(WebhookEvent.objects.filter(status='processed').count(), 2)
+
+    def test_replay_after_shipping_keeps_order_status(self):
+        self.post_event('evt_6', 'payment_intent.succeeded', {'id': 'pi_1', 'object': 'payment_intent'})
+        webhooks.process_batch()
+        Order.objects.filter(pk=self.order.pk).update(status='shipped')
+
+        call_command('replay_webhooks', '--since', '2000-01-01T00:00:00+00:00', stdout=mock.MagicMock())
+        webhooks.process_batch()
+        self.order.refresh_from_db()
+        self.payment.refresh_from_db()
+        self.assertEqual((self.order.status, self.payment.status), ('shipped', 'completed'))
+        self.assertEqual(WebhookEvent.objects.get().status, 'processed')
+
+    def test_late_event_for_cancelled_order_needs_review(self):
+        Order.objects.filter(pk=self.order.pk).update(status='cancelled')
+        self.post_event('evt_7', 'payment_intent.succeeded', {'id': 'pi_1', 'object': 'payment_intent'})
+        with self.assertLogs('orders.webhooks', 'ERROR'):
+            webhooks.process_batch()
+        self.order.refresh_from_db()
+        self.payment.refresh_from_db()
+        self.assertEqual((self.order.status, self.payment.status), ('cancelled', 'needs_review'))
+
+    def test_invalid_signature_is_rejected(self):
+        response = self.client.post(
+            '/api/orders/webhook/stripe/', '{}', content_type='application/json',
+            HTTP_STRIPE_SIGNATURE='t=1,v1=invalid'
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+    @override_settings(WEBHOOK_MAX_ATTEMPTS=3, WEBHOOK_RETRY_DELAY=0)
+    def test_unknown_payment_is_retried_then_failed_and_replayable(self):
+        self.post_event('evt_3', 'payment_intent.succeeded', {'id': 'pi_unknown', 'object': 'payment_intent'})
+        for _ in range(3):
+            webhooks.process_batch()
+        event = WebhookEvent.objects.get()
+        self.assertEqual((event.status, event.attempts), ('failed', 3))
+        self.assertEqual(webhooks.get_metrics()['failed'], 1)
+
+        Payment.objects.filter(pk=self.payment.pk).update(stripe_payment_intent_id='pi_unknown')
+        call_command('replay_webhooks', '--failed', stdout=mock.MagicMock())
+        webhooks.process_batch()
+        self.assertEqual(WebhookEvent.objects.get().status, 'processed')
+
+
+class AdminChangelistTests(TestCase):
+    """管理画面の注文・支払い一覧が行数に比例したクエリを発行しないことを確認する"""
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username='admin', password='pass', email='admin@example.com')
+        self.client.force_login(self.admin)
+
+    def add_orders(self, count):
+        for _ in range(count):
+            user = User.objects.create_user(username=f'buyer{User.objects.count()}', password='pass')
+            order = Order.objects.create(user=user, shipping_address='東京都', total_price=1000)
+            Payment.objects.create(order=order, amount=1000, payment_method='card', status='completed')
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def test_query_count_is_constant(self):
+        for url in ['/admin/orders/order/', '/admin/orders/payment/']:
+            with self.subTest(url=url):
+                self.add_orders(1)
+                small = self.count_queries(url)
+                self.add_orders(20)
+                self.assertEqual(self.count_queries(url), small)
+
+    @override_settings(ADMIN_COUNT_LIMIT=5)
+    @mock.patch.object(OrderAdmin, 'list_per_page', 2)
+    def test_count_stops_at_limit(self):
+        self.add_orders(8)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/admin/orders/order/')
+        self.assertEqual(response.context['cl'].result_count, 7)  # 上限 + 1ページ分
+        self.assertFalse(any('COUNT(*)' in query['sql'] and 'LIMIT' not in query['sql'] for query in ctx.captured_queries))
+
+    @override_settings(ADMIN_COUNT_LIMIT=5)
+    @mock.patch.object(OrderAdmin, 'list_per_page', 2)
+    def test_pages_past_limit_can_be_opened(self):
+        self.add_orders(8)
+        # 開いたページの末尾まで上限が広がる(3ページ目: 6件まで数えて、まだあるので +1ページ分)
+        response = self.client.get('/admin/orders/order/?p=3')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cl'].result_count, 8)
+        self.assertEqual(len(response.context['cl'].result_list), 2)
+
+        response = self.client.get('/admin/orders/order/?p=4')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cl'].result_count, 8)  # すべて数え切れたので実際の件数
+        self.assertEqual(len(response.context['cl'].result_list), 2)
+
+
+class SeedShopTests(TestCase):
+    """負荷試験用データの作成"""
+
+    def test_seed_shop_creates_consistent_data(self):
+        call_command('seed_shop', categories=2, products=50, users=5, carts=3, orders=20, stdout=io.StringIO())
+        self.assertEqual(User.objects.filter(username__startswith='shopper').count(), 5)
+        self.assertTrue(User.objects.get(username='shopper0').check_password('password'))
+        self.assertEqual(Cart.objects.count(), 3)
+        for cart in Cart.objects.with_computed_totals():
+            self.assertEqual(cart.total_price, cart.computed_total_price)
+            self.assertGreater(cart.item_count, 0)
+        self.assertEqual(Order.objects.count(), 20)
+        for order in Order.objects.prefetch_related('items'):
+            self.assertEqual(order.total_price, order.calculate_total())
+        self.assertEqual(
+            Payment.objects.count(),
+            Order.objects.filter(status__in=['paid', 'preparing', 'shipped', 'delivered']).count()
+        )
+
+
+# ルートごとのクエリ数の予算(「URL名 メソッド」: 上限)。数え方は ec_shop/tests.py を参照。
+QUERY_BUDGETS = {
+    'order-list GET': 3,
+    # カートのロック・アイテム 2、在庫の引き当て(ロック・更新・キャッシュを無効にするカテゴリー)3、
+    # 注文・注文商品の作成 2、カートを空に 2、レスポンスの注文商品 1、入れ子の atomic 3つの SAVEPOINT / RELEASE 6
+    'order-list POST': 16,
+    'order-detail GET': 3,
+    'order-detail PUT': 5,
+    'order-detail PATCH': 5,
+    'order-detail DELETE': 5,
+    # 取得 1、注文のロック・注文商品の集計 2、在庫を戻す(ロック・更新・キャッシュを無効にするカテゴリー)3、
+    # 状態の更新 1、SAVEPOINT / RELEASE 4、レスポンスの注文・注文商品 2
+    'order-cancel POST': 13,
+    # order-cancel POST から取得とレスポンスを除いたもの(注文の件数によらない)
+    'order-bulk-cancel POST': 10,
+    'order-payment-status POST': 2,
+    # 取得 1、決済サービスの呼び出し前後の短いトランザクション(注文・支払いのロックと作成・更新)3 + 3、
+    # SAVEPOINT / RELEASE 4
+    'order-process-payment POST': 11,
+    # order-process-payment POST にセッションでの認証 2 を加えたもの
+    'async-process-payment POST': 13,
+    'stripe-webhook POST': 1,
+    'async-stripe-webhook POST': 1,
+}
+
+
+@override_settings(
+    PAYMENT_PROVIDER='fake', PAYMENT_FAKE_PROVIDER={'latency': 0}, STRIPE_WEBHOOK_SECRET='whsec_test'
+)
+class QueryBudgetTests(RouteBudgetMixin, TestCase):
+    """注文・支払いのAPIのクエリ数がデータ量によらず一定で、予算以内であることを確認する"""
+
+    query_budgets = QUERY_BUDGETS
+
+    def signed_event(self):
+        payload = json.dumps({
+            'id': self.unique('evt_'), 'object': 'event', 'type': 'payment_intent.succeeded',
+            'data': {'object': {'id': 'pi_unknown', 'object': 'payment_intent'}}
+        })
+        timestamp = int(time.time())
+        signature = hmac.new(b'whsec_test', f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+        return {'data': payload, 'content_type': 'application/json', 'HTTP_STRIPE_SIGNATURE': f't={timestamp},v1={signature}'}
+
+
+    def test_order_list_get(self):
+        self.assertRouteBudget(
+            'order-list GET', lambda _: self.client.get('/api/orders/orders/'),
+            lambda n: [self.make_order(2) for _ in range(n)]
+        )
+
+    def test_order_list_post(self):
+        self.assertRouteBudget('order-list POST', lambda _: self.client.post(
+            '/api/orders/orders/', {'shipping_address': '東京都'}, format='json'
+        ), self.fill_cart)
+
+    def test_order_detail_get(self):
+        self.assertRouteBudget(
+            'order-detail GET', lambda order: self.client.get(f'/api/orders/orders/{order.pk}/'), self.make_order
+        )
+
+    def test_order_detail_put(self):
+        self.assertRouteBudget('order-detail PUT', lambda order: self.client.put(
+            f'/api/orders/orders/{order.pk}/', {'shipping_address': '大阪府', 'status': 'pending'}, format='json'
+        ), self.make_order)
+
+    def test_order_detail_patch(self):
+        self.assertRouteBudget('order-detail PATCH', lambda order: self.client.patch(
+            f'/api/orders/orders/{order.pk}/', {'shipping_address': '大阪府'}, format='json'
+        ), self.make_order)
+
+    def test_order_detail_delete(self):
+        self.assertRouteBudget(
+            'order-detail DELETE', lambda order: self.client.delete(f'/api/orders/orders/{order.pk}/'), self.make_order
+        )
+
+    def test_order_cancel_post(self):
+        self.assertRouteBudget(
+            'order-cancel POST', lambda order: self.client.post(f'/api/orders/orders/{order.pk}/cancel/'), self.make_order
+        )
+
+    def test_order_bulk_cancel_post(self):
+        self.assertRouteBudget('order-bulk-cancel POST', lambda orders: self.client.post(
+            '/api/orders/orders/bulk_cancel/', {'order_ids': [order.pk for order in orders]}, format='json'
+        ), lambda n: [self.make_order(2) for _ in range(n)])
+
+    def test_order_payment_status_post(self):
+        def populate(n):
+            order = self.make_order(n)
+            Payment.objects.create(order=order, amount=order.total_price, payment_method='card')
+            return order
+        self.assertRouteBudget(
+            'order-payment-status POST', lambda order: self.client.post(f'/api/orders/orders/{order.pk}/payment_status/'),
+            populate
+        )
+
+    def test_order_process_payment_post(self):
+        self.assertRouteBudget('order-process-payment POST', lambda order: self.client.post(
+            f'/api/orders/orders/{order.pk}/process_payment/',
+            {'payment_method': 'card', 'payment_method_id': 'pm_card_visa'}, format='json'
+        ), self.make_order)
+
+    def test_async_process_payment_post(self):
+        def populate(n):
+            order = self.make_order(n)
+            client = APIClient()
+            client.force_login(self.user)  # 非同期版はセッションで認証する
+            return client, order
+        self.assertRouteBudget('async-process-payment POST', lambda state: state[0].post(
+            f'/api/orders/async/orders/{state[1].pk}/process_payment/',
+            {'payment_method': 'card', 'payment_method_id': 'pm_card_visa'}, format='json'
+        ), populate)
+
+    def test_stripe_webhook_post(self):
+        self.assertRouteBudget(
+            'stripe-webhook POST', lambda _: self.client.post('/api/orders/webhook/stripe/', **self.signed_event()),
+            lambda n: [self.client.post('/api/orders/webhook/stripe/', **self.signed_event()) for _ in range(n)]
+        )
+
+    def test_async_stripe_webhook_post(self):
+        self.assertRouteBudget(
+            'async-stripe-webhook POST',
+            lambda _: self.client.post('/api/orders/async/webhook/stripe/', **self.signed_event()),
+            lambda n: [self.client.post('/api/orders/async/webhook/stripe/', **self.signed_event()) for _ in range(n)]
+        )
@@ -1,11 +1,15 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
+from . import async_views
 from .views import OrderViewSet, stripe_webhook
 
 router = DefaultRouter()
-router.register('orders', OrderViewSet)
+router.register('orders', OrderViewSet, basename='order')
 
 urlpatterns = [
     path('', include(router.urls)),
     path('webhook/stripe/', stripe_webhook, name='stripe-webhook'),
+    # ASGIで動かす非同期版
+    path('async/orders/<int:pk>/process_payment/', async_views.process_payment, name='async-process-payment'),
+    path('async/webhook/stripe/', async_views.stripe_webhook, name='async-stripe-webhook'),
 ] 
\ No newline at end of file
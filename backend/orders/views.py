@@ -4,22 +4,28 @@ from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from django.db import transaction
-from django.conf import settings
 import stripe
 from django.views.decorators.csrf import csrf_exempt
+from ec_shop.conditional import ConditionalGetMixin
+from ec_shop.pagination import CreatedAtCursorPagination
+from ec_shop.performance import timer
 
-from .models import Order, Payment
-from .serializers import OrderSerializer, CreateOrderSerializer, PaymentSerializer, CreatePaymentSerializer
+from . import payments, webhooks
+from .models import Order
+from .serializers import OrderSerializer, CreateOrderSerializer, PaymentSerializer, CreatePaymentSerializer, BulkCancelSerializer
 
-# Stripe設定
-stripe.api_key = settings.STRIPE_SECRET_KEY
-
-class OrderViewSet(viewsets.ModelViewSet):
+class OrderViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
     serializer_class = OrderSerializer
+    pagination_class = CreatedAtCursorPagination
+    # 注文商品として現在の商品・カテゴリー情報も返すため、それらの更新日時も含める
+    conditional_timestamp_fields = ['updated_at', 'items__product__updated_at', 'items__product__category__updated_at']
 
     def get_queryset(self):
-        return Order.objects.filter(user=self.request.user)
+        queryset = Order.objects.filter(user=self.request.user)
+        if self.action in ('cancel', 'process_payment', 'payment_status'):
+            return queryset  # 対象の注文を取得するだけで、注文商品は返さない
+        return queryset.with_items()
 
     def get_serializer_class(self):
         if self.action == 'create':
@@ -32,9 +38,14 @@ class OrderViewSet(viewsets.ModelViewSet):
         serializer.is_valid(raise_exception=True)
         order = serializer.save()
         
-        response_serializer = OrderSerializer(order)
+        response_serializer = OrderSerializer(order.prefetch_items())
         return Response(response_serializer.data, status=status.HTTP_201_CREATED)
 
+    def perform_update(self, serializer):
+        serializer.save()
+        # 保存後は注文商品のprefetchが破棄されるため、まとめて読み直してからシリアライズする
+        serializer.instance = self.get_queryset().get(pk=serializer.instance.pk)
+
     @action(detail=True, methods=['post'])
     def cancel(self, request, pk=None):
         """注文をキャンセルする"""
@@ -54,129 +65,73 @@ class OrderViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        # 在庫を戻す
-        for item in order.items.all():
-            product = item.product
-            product.stock += item.quantity
-            product.save()
-
-        # 注文をキャンセル
-        order.status = 'cancelled'
-        order.save()
+        # 在庫を戻して注文をキャンセル
+        if not Order.objects.filter(pk=order.pk).cancel():
+            # 他のリクエストが先にキャンセル・発送した場合
+            return Response(
+                {'error': 'この注文はキャンセルできません'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
-        serializer = self.get_serializer(order)
+        serializer = self.get_serializer(Order.objects.with_items().get(pk=order.pk))
         return Response(serializer.data)
 
+    @action(detail=False, methods=['post'])
+    def bulk_cancel(self, request):
+        """複数の注文を1トランザクションでまとめてキャンセルする"""
+        serializer = BulkCancelSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        order_ids = serializer.validated_data['order_ids']
+
+        # スタッフは全ユーザーの注文を、一般ユーザーは自分の注文のみキャンセルできる
+        orders = Order.objects.all() if request.user.is_staff else self.get_queryset()
+        cancelled = orders.filter(pk__in=order_ids).cancel()
+
+        return Response({
+            'cancelled': cancelled,
+            'skipped': sorted(set(order_ids) - set(cancelled))
+        })
+
     @action(detail=True, methods=['post'])
-    @transaction.atomic
     def process_payment(self, request, pk=None):
-        """注文の支払い処理を行う"""
+        """注文の支払い処理を行う
+
+        決済サービスとの通信中はトランザクションを張らない(詳細は orders/payments.py)。
+        """
+        try:
+            provider, payment, options = self.start_payment()
+        except payments.PaymentError as e:
+            return Response({'error': e.message}, status=e.status_code)
+
+        try:
+            with timer('payment'):
+                result, error = provider.create_payment(payment, **options), None
+        except Exception as e:
+            result, error = None, e
+
+        status_code, data = payments.finish_payment(payment, result, error)
+        return Response(data, status=status_code)
+
+    def start_payment(self):
+        """支払う注文と支払い方法を確認し、支払いを「処理中」にする(非同期版と共有)
+
+        (決済サービス, Payment, 決済サービスの create_payment に渡す引数) を返す。
+        """
         order = self.get_object()
-        
-        # 既に支払い済みの場合
-        if hasattr(order, 'payment') and order.payment.status == 'completed':
-            return Response(
-                {'error': '既に支払い済みです'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
+
         # シリアライザでバリデーション
-        serializer = CreatePaymentSerializer(data=request.data)
+        serializer = CreatePaymentSerializer(data=self.request.data)
         serializer.is_valid(raise_exception=True)
-        payment_method = serializer.validated_data['payment_method']
-        
-        try:
-            # 支払い情報を作成
-            payment = Payment.objects.create(
-                order=order,
-                amount=order.calculate_total(),
-                payment_method=payment_method,
-                status='processing'
-            )
-            
-            # 支払い方法に応じた処理
-            if payment_method == 'card':
-                # Stripeの支払いIntentを作成
-                intent = stripe.PaymentIntent.create(
-                    amount=payment.amount,
-                    currency='jpy',
-                    payment_method=request.data.get('payment_method_id'),
-                    confirm=True,  # 即時決済
-                    metadata={
-                        'order_id': order.id,
-                        'user_id': request.user.id
-                    }
-                )
-                
-                # 支払いIDを保存
-                payment.stripe_payment_intent_id = intent.id
-                
-                if intent.status == 'succeeded':
-                    payment.status = 'completed'
-                    order.status = 'paid'  # 注文ステータスも更新
-                else:
-                    payment.status = 'failed'
-                
-                payment.save()
-                order.save()
-                
-            elif payment_method in ['konbini', 'bank_transfer']:
-                # コンビニ・銀行振込の場合はStripeの支払いリンクを作成
-                session = stripe.checkout.Session.create(
-                    payment_method_types=[payment_method],
-                    line_items=[{
-                        'price_data': {
-                            'currency': 'jpy',
-                            'product_data': {
-                                'name': f'注文 #{order.id}',
-                            },
-                            'unit_amount': payment.amount,
-                        },
-                        'quantity': 1,
-                    }],
-                    mode='payment',
-                    success_url=request.build_absolute_uri(f'/orders/{order.id}/success'),
-                    cancel_url=request.build_absolute_uri(f'/orders/{order.id}/cancel'),
-                    metadata={
-                        'order_id': order.id,
-                        'user_id': request.user.id
-                    }
-                )
-                
-                return Response({
-                    'session_id': session.id,
-                    'session_url': session.url
-                })
-                
-            else:
-                # その他の支払い方法（PayPayなど）は今後実装
-                return Response(
-                    {'error': 'この支払い方法は現在対応していません'},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-            
-            # レスポンスを返す
-            serializer = PaymentSerializer(payment)
-            return Response(serializer.data)
-            
-        except stripe.error.CardError as e:
-            # カードエラーの場合
-            payment.status = 'failed'
-            payment.save()
-            return Response(
-                {'error': settings.PAYMENT_SETTINGS['error_messages']['card_error']},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-            
-        except Exception as e:
-            # その他のエラー
-            if 'payment' in locals():
-                payment.status = 'failed'
-                payment.save()
-            return Response(
-                {'error': settings.PAYMENT_SETTINGS['error_messages']['system_error']},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
+
+        # 支払い情報を「処理中」で確定する
+        provider, payment = payments.start_payment(order, serializer.validated_data['payment_method'])
+        options = {
+            'payment_method_id': self.request.data.get('payment_method_id'),
+            'user_id': self.request.user.id,
+            'success_url': self.request.build_absolute_uri(f'/orders/{order.id}/success'),
+            'cancel_url': self.request.build_absolute_uri(f'/orders/{order.id}/cancel'),
+        }
+        return provider, payment, options
 
     @action(detail=True, methods=['post'])
     def payment_status(self, request, pk=None):
@@ -202,53 +157,13 @@ def stripe_webhook(request):
 
     try:
         # イベントの検証
-        event = stripe.Webhook.construct_event(
-            payload, sig_header, settings.STRIPE_WEBHOOK_SECRET
-        )
+        event = webhooks.construct_event(payload, sig_header)
     except ValueError as e:
         return Response(status=status.HTTP_400_BAD_REQUEST)
     except stripe.error.SignatureVerificationError as e:
         return Response(status=status.HTTP_400_BAD_REQUEST)
 
-    # イベントタイプに応じた処理
-    if event.type == 'payment_intent.succeeded':
-        payment_intent = event.data.object
-        
-        try:
-            # 支払い情報を更新
-            payment = Payment.objects.get(
-                stripe_payment_intent_id=payment_intent.id
-            )
-            with transaction.atomic():
-                payment.status = 'completed'
-                payment.save()
-                
-                # 注文ステータスも更新
-                order = payment.order
-                order.status = 'paid'
-                order.save()
-                
-        except Payment.DoesNotExist:
-            return Response(status=status.HTTP_404_NOT_FOUND)
-            
-    elif event.type == 'checkout.session.completed':
-        session = event.data.object
-        
-        try:
-            # 注文IDをメタデータから取得
-            order_id = session.metadata.get('order_id')
-            order = Order.objects.get(id=order_id)
-            
-            # 支払い情報を更新
-            payment = order.payment
-            payment.status = 'completed'
-            payment.save()
-            
-            # 注文ステータスも更新
-            order.status = 'paid'
-            order.save()
-            
-        except (Order.DoesNotExist, Payment.DoesNotExist):
-            return Response(status=status.HTTP_404_NOT_FOUND)
+    # 受信箱に保存してすぐに応答する(反映はワーカーが行う)
+    webhooks.enqueue_event(event, payload)
 
     return Response(status=status.HTTP_200_OK)
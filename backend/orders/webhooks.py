@@ -0,0 +1,158 @@
+"""Stripe webhookの受信箱(inbox)
+
+webhookは署名を検証したら WebhookEvent にイベントIDで重複排除して保存し、すぐに200を返す。
+支払い・注文への反映はワーカー(manage.py process_webhooks)が古い順にまとめて行う。
+Stripeの再送で同じイベントが何度届いても、保存・反映されるのは1回だけになる。
+"""
+import json
+import logging
+from collections import defaultdict
+from datetime import timedelta
+
+import stripe
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Min, Q
+from django.utils import timezone
+
+from .models import Order, Payment, WebhookEvent
+
+logger = logging.getLogger(__name__)
+
+
+def get_max_attempts():
+    """反映先の支払いが見つからないイベントを再試行する回数
+
+    (webhookが支払いAPIの結果保存より先に届くことがあるため)
+    """
+    return getattr(settings, 'WEBHOOK_MAX_ATTEMPTS', 5)
+
+
+def get_retry_delay():
+    """上記の再試行の間隔"""
+    return timedelta(seconds=getattr(settings, 'WEBHOOK_RETRY_DELAY', 30))
+
+
+def construct_event(payload, sig_header):
+    """署名を検証してイベントを返す(不正な場合は ValueError / SignatureVerificationError)"""
+    return stripe.Webhook.construct_event(
+        payload, sig_header, settings.STRIPE_WEBHOOK_SECRET
+    )
+
+
+def enqueue_event(event, payload):
+    """検証済みのイベントを受信箱に保存する(同じイベントIDは無視される)"""
+    WebhookEvent.objects.bulk_create(
+        [WebhookEvent(event_id=event.id, event_type=event.type, payload=json.loads(payload))],
+        ignore_conflicts=True
+    )
+
+
+def apply_events(events):
+    """イベントをまとめて支払い・注文に反映し、反映先が見つかったイベントIDの集合を返す"""
+    intent_events = defaultdict(list)  # PaymentIntent ID -> イベントID
+    order_events = defaultdict(list)  # 注文ID(metadata.order_id) -> イベントID
+    applied = set()
+    for event in events:
+        obj = event.payload['data']['object']
+        order_id = str((obj.get('metadata') or {}).get('order_id'))
+        if event.event_type == 'payment_intent.succeeded':
+            intent_events[obj['id']].append(event.event_id)
+            # Checkout(コンビニ・銀行振込)の支払いはPaymentIntent IDを保存していないため、
+            # checkout.session.completed より先に届いても反映できるよう注文IDでも照合する
+            order_events[order_id].append(event.event_id)
+        elif event.event_type == 'checkout.session.completed':
+            order_events[order_id].append(event.event_id)
+        else:
+            applied.add(event.event_id)  # 対象外のイベントは何もせず処理済みにする
+
+    payments = Payment.objects.filter(
+        Q(stripe_payment_intent_id__in=intent_events)
+        | Q(order_id__in=[order_id for order_id in order_events if order_id.isdigit()])
+    ).values_list('pk', 'order_id', 'stripe_payment_intent_id')
+
+    payment_ids = []
+    for payment_id, order_id, intent_id in payments:
+        event_ids = intent_events.get(intent_id, []) + order_events.get(str(order_id), [])
+        if event_ids:
+            payment_ids.append(payment_id)
+            applied.update(event_ids)
+
+    # 完了・返金済みなどの支払いと、支払い待ちでない注文(発送済み・キャンセル済みなど)は変更しない
+    # (再送・再処理されたイベントで状態を戻さないため)
+    unsettled = dict(
+        Payment.objects.filter(pk__in=payment_ids, status__in=Payment.UNSETTLED_STATUSES)
+        .values_list('pk', 'order_id')
+    )
+    pending_orders = set(
+        Order.objects.select_for_update()
+        .filter(pk__in=unsettled.values(), status='pending')
+        .order_by('pk')
+        .values_list('pk', flat=True)
+    )
+    completed = [payment_id for payment_id, order_id in unsettled.items() if order_id in pending_orders]
+    needs_review = [payment_id for payment_id, order_id in unsettled.items() if order_id not in pending_orders]
+
+    now = timezone.now()
+    Payment.objects.filter(pk__in=completed).update(status='completed', updated_at=now)
+    Order.objects.filter(pk__in=pending_orders).update(status='paid', updated_at=now)
+    if needs_review:
+        # 支払いは完了したが注文がキャンセル済みなどの場合は、返金の要否を確認できるようにする
+        Payment.objects.filter(pk__in=needs_review).update(status='needs_review', updated_at=now)
+        logger.error('支払い待ちでない注文の支払いが完了しました(返金の要否を確認してください): 支払い %s', needs_review)
+    return applied
+
+
+def process_batch(batch_size=100):
+    """未処理のイベントを古い順に最大 batch_size 件反映し、取り出した件数を返す"""
+    with transaction.atomic():
+        # 複数のワーカーが同じイベントを取り合わないよう、ロック中の行は飛ばす
+        events = list(
+            WebhookEvent.objects.select_for_update(skip_locked=True)
+            .filter(status='pending')
+            .filter(Q(processed_at__isnull=True) | Q(processed_at__lte=timezone.now() - get_retry_delay()))
+            .order_by('received_at', 'id')[:batch_size]
+        )
+        if not events:
+            return 0
+
+        now = timezone.now()
+        max_attempts = get_max_attempts()
+        try:
+            with transaction.atomic():
+                applied = apply_events(events)
+            error = '反映先の支払いが見つかりません'
+        except Exception as e:
+            applied = set()
+            error = repr(e)
+
+        for event in events:
+            event.attempts += 1
+            event.processed_at = now
+            if event.event_id in applied:
+                event.status = 'processed'
+                event.last_error = ''
+            else:
+                event.last_error = error
+                if event.attempts >= max_attempts:
+                    event.status = 'failed'
+        WebhookEvent.objects.bulk_update(events, ['status', 'attempts', 'last_error', 'processed_at'])
+    return len(events)
+
+
+def replay(queryset):
+    """イベントを未処理に戻して再処理させ、件数を返す"""
+    return queryset.update(status='pending', attempts=0, last_error='', processed_at=None)
+
+
+def get_metrics():
+    """受信箱の状態(件数と未処理イベントの遅延秒数)を返す"""
+    stats = WebhookEvent.objects.aggregate(
+        pending=Count('pk', filter=Q(status='pending')),
+        failed=Count('pk', filter=Q(status='failed')),
+        processed=Count('pk', filter=Q(status='processed')),
+        oldest_pending=Min('received_at', filter=Q(status='pending')),
+    )
+    oldest = stats.pop('oldest_pending')
+    stats['lag_seconds'] = (timezone.now() - oldest).total_seconds() if oldest else 0.0
+    return stats
@@ -1,5 +1,39 @@
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponseBadRequest
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path
 from .models import Product
+from .search import search_products
+from .transfer import FORMATS, detect_format, export_response, import_products, read_rows
+
+# 取り込み後に画面に出すエラーの数
+ADMIN_IMPORT_ERRORS_SHOWN = 20
+
+
+class ProductImportForm(forms.Form):
+    file = forms.FileField(label='ファイル')
+    file_format = forms.ChoiceField(
+        label='形式', required=False,
+        choices=[('', '拡張子から判定'), *((file_format, file_format.upper()) for file_format in FORMATS)]
+    )
+    update_stock = forms.BooleanField(
+        label='既存の商品の在庫数も更新する', required=False,
+        help_text='書き出した後の注文で減った在庫を上書きするため、棚卸しの結果を反映するときだけ選んでください'
+    )
+    dry_run = forms.BooleanField(label='確認のみ(保存しない)', required=False)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        upload = cleaned_data.get('file')
+        if upload and not cleaned_data.get('file_format'):
+            cleaned_data['file_format'] = detect_format(upload.name)
+            if cleaned_data['file_format'] is None:
+                raise forms.ValidationError('拡張子から形式が分からないため、形式を選んでください')
+        return cleaned_data
+
 
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
@@ -7,3 +41,60 @@ class ProductAdmin(admin.ModelAdmin):
     list_filter = ('created_at', 'stock')
     search_fields = ('name', 'description')
     ordering = ('-created_at',)
+
+    def get_search_results(self, request, queryset, search_term):
+        # 全文検索インデックスを使う(順序は一覧の並び順に従う)
+        if not search_term:
+            return queryset, False
+        return search_products(queryset, search_term), False
+
+    def get_urls(self):
+        return [
+            path('import/', self.admin_site.admin_view(self.import_view), name='products_product_import'),
+            path('export/', self.admin_site.admin_view(self.export_view), name='products_product_export'),
+            *super().get_urls(),
+        ]
+
+    def import_view(self, request):
+        """CSV・JSONLファイルで商品をまとめて作成・更新する(products/transfer.py)"""
+        if not (self.has_add_permission(request) and self.has_change_permission(request)):
+            raise PermissionDenied
+        form = ProductImportForm(request.POST or None, request.FILES or None)
+        if request.method == 'POST' and form.is_valid():
+            # 大きなファイルは一時ファイルに保存されているので、そこから少しずつ読む
+            result = import_products(
+                read_rows(form.cleaned_data['file'].file, form.cleaned_data['file_format']),
+                dry_run=form.cleaned_data['dry_run'],
+                update_stock=form.cleaned_data['update_stock']
+            )
+            prefix = '確認のみ: ' if form.cleaned_data['dry_run'] else ''
+            self.message_user(
+                request,
+                f'{prefix}{result.created}件を作成、{result.updated}件を更新しました'
+                f'(変更なし {result.unchanged}件、新しいカテゴリー {result.categories_created}件、エラー {result.error_count}件)',
+                messages.WARNING if result.error_count else messages.SUCCESS
+            )
+            for line_number, error in result.errors[:ADMIN_IMPORT_ERRORS_SHOWN]:
+                self.message_user(request, f'{line_number}行目: {error}', messages.ERROR)
+            if result.error_count > ADMIN_IMPORT_ERRORS_SHOWN:
+                self.message_user(request, f'ほか {result.error_count - ADMIN_IMPORT_ERRORS_SHOWN}件のエラー', messages.ERROR)
+            if form.cleaned_data['dry_run']:
+                return redirect('admin:products_product_import')
+            return redirect('admin:products_product_changelist')
+
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': '商品のインポート',
+            'form': form,
+        }
+        return TemplateResponse(request, 'admin/products/product/import_form.html', context)
+
+    def export_view(self, request):
+        """全商品をCSV・JSONLファイルとしてダウンロードさせる"""
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        file_format = request.GET.get('file_format', 'csv')
+        if file_format not in FORMATS:
+            return HttpResponseBadRequest()
+        return export_response(file_format)
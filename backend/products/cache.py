@@ -0,0 +1,152 @@
+"""商品カタログAPIのキャッシュ
+
+キャッシュキーに「スコープごとのバージョン番号」を含め、
+商品・カテゴリーが変更されたらバージョンを1つ進めるだけで古いキャッシュを無効化する(O(1))。
+
+スコープ:
+    products       全商品一覧(商品・カテゴリーのどれかが変わると進む)
+    categories     カテゴリー情報(カテゴリーが変わると進む)
+    category:<id>  カテゴリー内の商品一覧
+    product:<id>   商品詳細
+
+注文による在庫数の変化(invalidate_stock)では商品詳細のスコープだけを進め、一覧は無効化しない
+(注文のたびにカタログ全体のキャッシュとETagが無効になるのを防ぐ)。在庫切れ・再入荷では
+「在庫あり」の絞り込みが変わるため一覧も進める。一覧・ファセットは有効期限ごとの時間区切り(stock_period)
+もキャッシュキーとETagに含めるので、在庫数が古いまま返る(304を含む)のは最大で有効期限の間だけになる。
+
+使用するキャッシュは settings.CATALOG_CACHE_ALIAS(未設定なら 'default'、Djangoの既定はローカルメモリ)、
+有効期限は settings.CATALOG_CACHE_TIMEOUT 秒(未設定なら300秒)。
+"""
+import hashlib
+import time
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework.response import Response
+
+from ec_shop.conditional import ConditionalGetMixin, make_etag
+
+
+def get_cache():
+    return caches[getattr(settings, 'CATALOG_CACHE_ALIAS', 'default')]
+
+
+def get_timeout():
+    return getattr(settings, 'CATALOG_CACHE_TIMEOUT', 300)
+
+
+def stock_period():
+    """有効期限ごとに変わる番号(在庫数の変化で無効化しないスコープのキャッシュキー・ETagに含める)"""
+    return int(time.time() // get_timeout())
+
+
+def lags_stock(scope):
+    """在庫数だけの変化(invalidate_stock)ではバージョンが進まないスコープか"""
+    return scope == 'products' or scope.startswith('category:')
+
+
+def _version_key(scope):
+    return f'catalog:version:{scope}'
+
+
+def get_versions(scopes):
+    """スコープごとの現在のバージョンを返す(未登録のスコープは新しく採番する)"""
+    cache = get_cache()
+    keys = [_version_key(scope) for scope in scopes]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # 追い出された後に古いバージョン番号が再利用されないよう、時刻から採番する
+            cache.add(key, time.time_ns(), None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def bump(*scopes):
+    """スコープのバージョンを進め、そのスコープのキャッシュを無効化する"""
+    cache = get_cache()
+    for scope in set(scopes):
+        try:
+            cache.incr(_version_key(scope))
+        except ValueError:
+            cache.set(_version_key(scope), time.time_ns(), None)
+
+
+def bump_on_commit(*scopes):
+    """トランザクション確定後にバージョンを進める(確定前のデータが再キャッシュされるのを防ぐ)"""
+    transaction.on_commit(lambda: bump(*scopes))
+
+
+def product_scopes(product_id, *category_ids):
+    """商品の変更で無効化すべきスコープ"""
+    scopes = ['products', f'product:{product_id}']
+    scopes += [f'category:{category_id}' for category_id in category_ids if category_id is not None]
+    return scopes
+
+
+def invalidate_products(product_ids):
+    """QuerySet.update()などシグナルが飛ばない一括更新の後に呼ぶ"""
+    from .models import Product
+
+    product_ids = list(product_ids)
+    category_ids = set(
+        Product.objects.filter(pk__in=product_ids).values_list('category_id', flat=True)
+    )
+    scopes = ['products']
+    scopes += [f'product:{product_id}' for product_id in product_ids]
+    scopes += [f'category:{category_id}' for category_id in category_ids if category_id is not None]
+    bump_on_commit(*scopes)
+
+
+def invalidate_stock(product_ids, availability_changed=()):
+    """在庫数だけを変えた後に呼ぶ(availability_changed は在庫切れ・再入荷になった商品ID)"""
+    availability_changed = set(availability_changed)
+    if availability_changed:
+        invalidate_products(availability_changed)
+    bump_on_commit(*[f'product:{product_id}' for product_id in product_ids if product_id not in availability_changed])
+
+
+class CatalogCacheMixin(ConditionalGetMixin):
+    """レスポンスデータをカタログのバージョン付きでキャッシュするビューセット用Mixin
+
+    ETag もスコープのバージョン番号から作るので、照合にデータベースを使わない
+    (Last-Modified は付けない)。スコープはアクションごとに get_cache_scopes() で決める。
+    """
+
+    def get_cache_scopes(self, request):
+        raise NotImplementedError
+
+    def get_catalog_versions(self, request):
+        # ETag とキャッシュキーで同じ番号を使う(ビューセットはリクエストごとに作られる)
+        if not hasattr(self, '_catalog_versions'):
+            scopes = self.get_cache_scopes(request)
+            self._catalog_versions = get_versions(scopes)
+            if any(lags_stock(scope) for scope in scopes):
+                self._catalog_versions.append(f'p{stock_period()}')
+        return self._catalog_versions
+
+    def get_validators(self, request):
+        return make_etag(request, *self.get_catalog_versions(request)), None
+
+    def build_response(self, request, build):
+        return super().build_response(request, lambda: self.cached_response(request, build))
+
+    def cached_response(self, request, build):
+        """キャッシュがあればそれを返し、なければ build() のレスポンスをキャッシュして返す"""
+        cache = get_cache()
+        versions = self.get_catalog_versions(request)
+        # クエリパラメータの順序が違うだけのリクエストは同じキーにする
+        query = urlencode(sorted(request.query_params.lists()), doseq=True)
+        digest = hashlib.sha256(f'{request.build_absolute_uri(request.path)}?{query}'.encode()).hexdigest()
+        key = f'catalog:response:{self.basename}:{self.action}:{digest}:' + ':'.join(map(str, versions))
+
+        data = cache.get(key)
+        if data is not None:
+            return Response(data)
+
+        response = build()
+        if response.status_code == 200:
+            cache.set(key, response.data, get_timeout())
+        return response
@@ -0,0 +1,53 @@
+"""商品一覧の絞り込み用の集計(ファセット)
+
+カテゴリー × 価格帯ごとの件数・在庫あり件数を1回のGROUP BYで集計し、
+カテゴリー別・価格帯別・全体の件数にまとめる。
+
+価格帯の区切りは settings.CATALOG_PRICE_BUCKETS(未設定なら [1000, 3000, 5000, 10000])。
+"""
+from django.conf import settings
+from django.db.models import Case, Count, IntegerField, Q, Value, When
+
+DEFAULT_PRICE_BUCKETS = [1000, 3000, 5000, 10000]
+
+
+def get_price_bounds():
+    """価格帯ごとの (下限, 上限) を返す(上限は含まない。最後の価格帯は上限なし)"""
+    bounds = sorted(getattr(settings, 'CATALOG_PRICE_BUCKETS', DEFAULT_PRICE_BUCKETS))
+    return list(zip([0, *bounds], [*bounds, None]))
+
+
+def get_facets(queryset):
+    """絞り込み済みの商品クエリセットから、カテゴリー別・価格帯別の件数を集計する(1クエリ)"""
+    bounds = get_price_bounds()
+    price_bucket = Case(
+        *[When(price__lt=upper, then=Value(i)) for i, (_, upper) in enumerate(bounds) if upper is not None],
+        default=Value(len(bounds) - 1),
+        output_field=IntegerField()
+    )
+    rows = (
+        queryset.order_by()
+        .annotate(price_bucket=price_bucket)
+        .values('category_id', 'category__name', 'price_bucket')
+        .annotate(count=Count('pk'), in_stock=Count('pk', filter=Q(stock__gt=0)))
+    )
+
+    categories = {}
+    price_ranges = [{'min': lower, 'max': upper, 'count': 0, 'in_stock': 0} for lower, upper in bounds]
+    total = {'count': 0, 'in_stock': 0}
+    for row in rows:
+        category = categories.setdefault(
+            row['category_id'],
+            {'id': row['category_id'], 'name': row['category__name'], 'count': 0, 'in_stock': 0}
+        )
+        for counts in (category, price_ranges[row['price_bucket']], total):
+            counts['count'] += row['count']
+            counts['in_stock'] += row['in_stock']
+
+    return {
+        'count': total['count'],
+        'in_stock': total['in_stock'],
+        # 件数の多い順(カテゴリーなしは id / name が null)
+        'categories': sorted(categories.values(), key=lambda category: (-category['count'], category['id'] or 0)),
+        'price_ranges': price_ranges,
+    }
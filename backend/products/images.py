@@ -0,0 +1,164 @@
+"""商品画像の派生ファイル(幅ごとに縮小したWebP)
+
+アップロードされた元画像から幅ごとの縮小画像をWebPで作り、Product.image_variants に
+{"source": 元画像のパス, "widths": {"320": パス, ...}} として保存する。
+ファイル名に内容のハッシュを含めるので、同じ名前のファイルの内容は変わらない(長期キャッシュできる)。
+
+生成は画像の保存後(トランザクション確定後)にバックグラウンドのスレッドで1回だけ行う。
+既存の商品は manage.py generate_image_variants で生成する(--all で幅や品質を変えたときに作り直す)。
+作り直したときや画像を外したときは、使われなくなった派生ファイルを消す。
+
+設定(任意):
+    PRODUCT_IMAGE_WIDTHS       生成する幅(既定 [320, 640, 1280]。元画像より大きい幅は作らない)
+    PRODUCT_IMAGE_QUALITY      WebPの品質(既定 80)
+    PRODUCT_IMAGE_WORKERS      生成に使うスレッド数(既定 2)
+    PRODUCT_IMAGE_BACKGROUND   False にすると保存時に同期で生成する(既定 True)
+"""
+import hashlib
+import io
+import logging
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.views.static import serve
+from PIL import Image, ImageOps
+
+from .cache import invalidate_products
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+VARIANT_DIR = 'products/variants'
+
+executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'PRODUCT_IMAGE_WORKERS', 2),
+    thread_name_prefix='product-image'
+)
+
+
+def get_widths():
+    return sorted(getattr(settings, 'PRODUCT_IMAGE_WIDTHS', [320, 640, 1280]))
+
+
+def render_variants(image_file):
+    """元画像から {幅: WebPのバイト列} を作る"""
+    quality = getattr(settings, 'PRODUCT_IMAGE_QUALITY', 80)
+    with Image.open(image_file) as original:
+        original = ImageOps.exif_transpose(original)  # スマートフォンの写真の向きを反映
+        if original.mode not in ('RGB', 'RGBA'):
+            original = original.convert('RGBA' if 'transparency' in original.info else 'RGB')
+        # 元画像より大きい幅は作らない(元画像が最小の幅より小さければその大きさで1つだけ作る)
+        widths = [width for width in get_widths() if width <= original.width] or [original.width]
+        variants = {}
+        for width in widths:
+            height = max(1, round(original.height * width / original.width))
+            resized = original.resize((width, height), Image.Resampling.LANCZOS) if width != original.width else original
+            buffer = io.BytesIO()
+            resized.save(buffer, 'WEBP', quality=quality, method=4)
+            variants[width] = buffer.getvalue()
+    return variants
+
+
+def generate_variants(product_id, force=False):
+    """商品画像の派生ファイルを作って保存する(作ったら True)
+
+    force のときは生成済みでも作り直す(設定を変えたときなど)。どちらの場合も前の派生ファイルは消す。
+    """
+    product = Product.objects.filter(pk=product_id).only('pk', 'image', 'image_variants').first()
+    if product is None or not product.image:
+        return False
+    source = product.image.name
+    previous = product.image_variants or {}
+    if previous.get('source') == source and not force:
+        return False  # 生成済み
+
+    storage = product.image.storage
+    with storage.open(source, 'rb') as image_file:
+        rendered = render_variants(image_file)
+
+    widths = {}
+    for width, content in rendered.items():
+        digest = hashlib.sha256(content).hexdigest()[:16]
+        name = posixpath.join(VARIANT_DIR, f'{product.pk}-{width}w-{digest}.webp')
+        if not storage.exists(name):
+            name = storage.save(name, ContentFile(content))
+        widths[str(width)] = name
+
+    # 生成中に画像が差し替えられていたら保存しない(新しい画像の生成に任せる)
+    updated = Product.objects.filter(pk=product.pk, image=source).update(
+        image_variants={'source': source, 'widths': widths},
+        updated_at=timezone.now()  # 条件付きGETで古い一覧が返らないようにする
+    )
+    if not updated:
+        return False
+    invalidate_products([product.pk])
+
+    # 前の画像の派生ファイルを消す(内容が同じファイルは名前も同じなので残す)
+    for name in set((previous.get('widths') or {}).values()) - set(widths.values()):
+        storage.delete(name)
+    return True
+
+
+def delete_variants(product_id):
+    """画像を外した商品の派生ファイルを消す(消したら True)"""
+    product = Product.objects.filter(pk=product_id).only('pk', 'image', 'image_variants').first()
+    if product is None or product.image or not product.image_variants:
+        return False
+    # その間に新しい画像が付けられていたら消さない(新しい画像の生成で消される)
+    updated = Product.objects.filter(
+        Q(image='') | Q(image__isnull=True), pk=product.pk
+    ).update(image_variants=None)
+    if not updated:
+        return False
+    for name in (product.image_variants.get('widths') or {}).values():
+        product.image.storage.delete(name)
+    return True
+
+
+def generate_in_background(product_id, force=False):
+    """スレッドプールから呼ぶ generate_variants(失敗はログに出して False を返す)"""
+    try:
+        return generate_variants(product_id, force)
+    except Exception:
+        logger.exception('商品画像の派生ファイルを作れませんでした: product_id=%s', product_id)
+        return False
+    finally:
+        connections.close_all()  # このスレッドのDB接続を閉じる
+
+
+def schedule_variants(product_id):
+    """トランザクション確定後に派生ファイルを作る"""
+    if getattr(settings, 'PRODUCT_IMAGE_BACKGROUND', True):
+        transaction.on_commit(lambda: executor.submit(generate_in_background, product_id))
+    else:
+        transaction.on_commit(lambda: generate_variants(product_id))
+
+
+def schedule_deletion(product_id):
+    """トランザクション確定後に派生ファイルを消す(ファイルの削除だけなので同期で行う)"""
+    transaction.on_commit(lambda: delete_variants(product_id))
+
+
+def variant_urls(product, request=None):
+    """{幅: URL} を返す(未生成なら空)"""
+    variants = product.image_variants or {}
+    if not product.image or variants.get('source') != product.image.name:
+        return {}
+    storage = product.image.storage
+    urls = {}
+    for width, name in variants['widths'].items():
+        url = storage.url(name)
+        urls[width] = request.build_absolute_uri(url) if request is not None else url
+    return urls
+
+
+def serve_variant(request, path, document_root=None):
+    """開発用: 派生ファイルを長期キャッシュ可能として配信する(ファイル名に内容のハッシュを含むため)"""
+    response = serve(request, path, document_root=document_root)
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
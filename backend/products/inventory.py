@@ -0,0 +1,74 @@
+"""在庫の引当・戻し処理
+
+同じ商品に同時に注文が入っても在庫がマイナスにならないよう、
+商品行を常にPK順でロックしてから(デッドロック防止)、
+F()式による条件付きUPDATEで在庫をまとめて増減する。
+"""
+from django.db import transaction
+from django.db.models import Case, F, Q, When
+from django.utils import timezone
+
+from .cache import invalidate_stock
+from .models import Product
+
+
+class InsufficientStock(Exception):
+    """在庫が足りない商品があるときに送出される"""
+
+    def __init__(self, products):
+        self.products = products  # 在庫が不足している商品のリスト
+        names = '、'.join(product.name for product in products)
+        super().__init__(f'{names}の在庫が不足しています')
+
+
+def _lock_products(product_ids):
+    """商品行をPK順にロックして {ID: 商品} を返す"""
+    products = (
+        Product.objects.select_for_update()
+        .filter(pk__in=product_ids)
+        .order_by('pk')
+        .only('pk', 'name', 'stock')
+    )
+    return {product.pk: product for product in products}
+
+
+def reserve_stock(quantities):
+    """{商品ID: 数量} の在庫をまとめて引き当てる
+
+    1つでも在庫が足りなければ何も変更せずに InsufficientStock を送出する。
+    """
+    if not quantities:
+        return
+    with transaction.atomic():
+        locked = _lock_products(quantities)
+        short = [
+            product for pk, product in locked.items()
+            if product.stock < quantities[pk]
+        ]
+        if short or len(locked) != len(quantities):
+            raise InsufficientStock(short)
+
+        # ロック済みだが、念のため在庫が足りる行だけを更新する
+        in_stock = Q()
+        for pk, quantity in quantities.items():
+            in_stock |= Q(pk=pk, stock__gte=quantity)
+        updated = Product.objects.filter(in_stock).update(
+            stock=Case(*[When(pk=pk, then=F('stock') - quantity) for pk, quantity in quantities.items()]),
+            updated_at=timezone.now()
+        )
+        if updated != len(quantities):
+            raise InsufficientStock(list(locked.values()))
+        invalidate_stock(quantities, [pk for pk, product in locked.items() if product.stock == quantities[pk]])
+
+
+def release_stock(quantities):
+    """{商品ID: 数量} の在庫をまとめて戻す"""
+    if not quantities:
+        return
+    with transaction.atomic():
+        locked = _lock_products(quantities)
+        Product.objects.filter(pk__in=quantities).update(
+            stock=Case(*[When(pk=pk, then=F('stock') + quantity) for pk, quantity in quantities.items()]),
+            updated_at=timezone.now()
+        )
+        invalidate_stock(quantities, [pk for pk, product in locked.items() if product.stock == 0])
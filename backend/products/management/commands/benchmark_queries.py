@@ -0,0 +1,70 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from orders.models import Order, Payment
+from products.models import Category, Product
+from products.seed import seed_catalog
+
+
+class Command(BaseCommand):
+    help = '一覧・検索で使う主要なクエリの実行計画と実行時間を、インデックスあり/なしで比較する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0, help='計測前に作成する商品数')
+        parser.add_argument('--categories', type=int, default=50, help='--seed時に作成するカテゴリー数')
+        parser.add_argument('--repeat', type=int, default=20, help='各クエリの実行回数')
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            self.stdout.write(f"商品を{options['seed']}件作成しています...")
+            seed_catalog(categories=options['categories'], products=options['seed'])
+
+        category = Category.objects.order_by('pk').first()
+        user = get_user_model().objects.order_by('pk').first()
+        queries = {
+            '商品一覧(新着順)': Product.objects.order_by('-created_at', '-id')[:20],
+            'カテゴリー別一覧': Product.objects.filter(category=category).order_by('-created_at', '-id')[:20],
+            '在庫ありのみ': Product.objects.filter(stock__gt=0).order_by('-created_at', '-id')[:20],
+            '在庫あり×カテゴリー×価格帯': Product.objects.filter(
+                category=category, stock__gt=0, price__gte=1000, price__lte=5000
+            ).order_by('-created_at', '-id')[:20],
+            'ユーザーの注文履歴': Order.objects.filter(user=user).order_by('-created_at', '-id')[:20],
+            'Payment Intent IDで検索': Payment.objects.filter(stripe_payment_intent_id='pi_benchmark'),
+        }
+
+        # インデックスを削除した状態を計測し、最後にロールバックして元に戻す
+        # (キャッシュされた実行計画を使わないよう、計測ごとに接続を張り直す)
+        connection.close()
+        with transaction.atomic():
+            self.drop_indexes()
+            without_indexes = self.measure(queries, options['repeat'])
+            transaction.set_rollback(True)
+        connection.close()
+        with_indexes = self.measure(queries, options['repeat'])
+
+        for name in queries:
+            self.stdout.write(self.style.MIGRATE_HEADING(f'\n== {name}'))
+            for label, results in (('インデックスなし', without_indexes), ('インデックスあり', with_indexes)):
+                plan, elapsed = results[name]
+                self.stdout.write(f'-- {label}: {elapsed:.3f} ms/回')
+                self.stdout.write(plan)
+
+    def measure(self, queries, repeat):
+        results = {}
+        for name, queryset in queries.items():
+            plan = queryset.explain()
+            start = time.perf_counter()
+            for _ in range(repeat):
+                list(queryset.all())
+            results[name] = (plan, (time.perf_counter() - start) * 1000 / repeat)
+        return results
+
+    def drop_indexes(self):
+        names = [index.name for model in (Product, Order) for index in model._meta.indexes]
+        names += [constraint.name for constraint in Payment._meta.constraints]
+        with connection.cursor() as cursor:
+            for name in names:
+                cursor.execute(f'DROP INDEX {connection.ops.quote_name(name)}')
@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from products.models import Product
+from products.search import search_products
+from products.seed import seed_catalog
+
+
+class Command(BaseCommand):
+    help = '商品検索(?q=)の実行時間を、全文検索インデックスと部分一致(icontains)で比較する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0, help='計測前に作成する商品数(例: 500000)')
+        parser.add_argument('--repeat', type=int, default=10, help='各クエリの実行回数')
+        parser.add_argument('queries', nargs='*', default=['チョコレート', '北海道産 りんご', 'イヤホン 9999', '存在しない商品'])
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            self.stdout.write(f"商品を{options['seed']}件作成しています...")
+            seed_catalog(products=options['seed'])
+        self.stdout.write(f'商品数: {Product.objects.count()}件')
+
+        for q in options['queries']:
+            indexed = search_products(Product.objects.all(), q).order_by('search_rank', 'id')[:20]
+            scan = Product.objects.all()
+            for term in q.split():
+                scan = scan.filter(Q(name__icontains=term) | Q(description__icontains=term))
+            scan = scan.order_by('-created_at', '-id')[:20]
+
+            self.stdout.write(self.style.MIGRATE_HEADING(f'\n== {q}'))
+            for label, queryset in (('全文検索インデックス', indexed), ('icontains', scan)):
+                start = time.perf_counter()
+                for _ in range(options['repeat']):
+                    results = list(queryset.all())
+                elapsed = (time.perf_counter() - start) * 1000 / options['repeat']
+                self.stdout.write(f'-- {label}: {elapsed:.2f} ms/回 ({len(results)}件)')
+            for product in indexed[:3]:
+                self.stdout.write(f'   {product.name} (rank {product.search_rank:.3f})')
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from products.transfer import EXPORT_CHUNK_SIZE, FORMATS, export_products
+
+
+class Command(BaseCommand):
+    help = '全商品をCSV・JSONLで書き出す(少しずつ読みながら書くので、商品数によらずメモリを使わない)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', '-o', help='書き出すファイル(省略時は標準出力)')
+        parser.add_argument('--format', choices=FORMATS, default='csv', help='ファイルの形式')
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE, help='1回にまとめて読む件数')
+
+    def handle(self, *args, **options):
+        chunks = export_products(options['format'], options['chunk_size'])
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as f:
+                f.writelines(chunks)
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
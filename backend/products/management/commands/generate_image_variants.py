@@ -0,0 +1,31 @@
+from functools import partial
+
+from django.core.management.base import BaseCommand
+from django.db.models import F, Q
+
+from products.images import executor, generate_in_background
+from products.models import Product
+
+
+class Command(BaseCommand):
+    help = '商品画像の縮小版(WebP)がない・古い商品について生成する'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', action='store_true', help='生成済みの商品も作り直す(幅や品質を変えたとき。古い縮小版は消す)'
+        )
+
+    def handle(self, *args, **options):
+        products = Product.objects.exclude(image='').exclude(image__isnull=True)
+        # --all でも image_variants は空にしない(作り直すまで今の縮小版を返し、作り直した後に古いファイルを消す)
+        if not options['all']:
+            # 縮小版がない、または元画像が差し替えられている商品だけ
+            products = products.filter(
+                Q(image_variants__isnull=True) | ~Q(image_variants__source=F('image'))
+            )
+
+        # IDを先に読み切ってから、スレッドプールで並行に生成する
+        product_ids = list(products.order_by('pk').values_list('pk', flat=True))
+        self.stdout.write(f'{len(product_ids)}件の商品画像を処理します')
+        created = sum(executor.map(partial(generate_in_background, force=options['all']), product_ids))
+        self.stdout.write(self.style.SUCCESS(f'{created}件の商品画像の縮小版を作成しました'))
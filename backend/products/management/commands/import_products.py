@@ -0,0 +1,50 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from products.transfer import FORMATS, IMPORT_CHUNK_SIZE, detect_format, import_products, read_rows
+
+
+class Command(BaseCommand):
+    help = 'CSV・JSONLファイルから商品をまとめて作成・更新する(id のある行は更新、ない行は作成)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='取り込むファイル(- で標準入力)')
+        parser.add_argument('--format', choices=FORMATS, help='ファイルの形式(省略時は拡張子から判定)')
+        parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE, help='1回にまとめて検証・保存する行数')
+        parser.add_argument('--dry-run', action='store_true', help='検証と件数の確認だけ行い、保存しない')
+        parser.add_argument(
+            '--update-stock', action='store_true',
+            help='既存の商品の在庫数もファイルの値にする(省略時は新しい商品にだけ使う。書き出した後の注文で減った在庫を上書きしないため)'
+        )
+
+    def handle(self, *args, **options):
+        file_format = options['format'] or detect_format(options['path'])
+        if file_format is None:
+            raise CommandError('拡張子から形式が分からないため、--format を指定してください')
+
+        if options['path'] == '-':
+            result = self.run(sys.stdin.buffer, file_format, options)
+        else:
+            try:
+                with open(options['path'], 'rb') as f:
+                    result = self.run(f, file_format, options)
+            except FileNotFoundError:
+                raise CommandError(f'ファイルが見つかりません: {options["path"]}')
+
+        for line_number, error in result.errors:
+            self.stderr.write(f'{line_number}行目: {error}')
+        if result.error_count > len(result.errors):
+            self.stderr.write(f'ほか {result.error_count - len(result.errors)}件のエラー')
+
+        prefix = '確認のみ: ' if options['dry_run'] else ''
+        summary = (
+            f'{prefix}{result.created}件を作成、{result.updated}件を更新しました'
+            f'(変更なし {result.unchanged}件、新しいカテゴリー {result.categories_created}件、エラー {result.error_count}件)'
+        )
+        self.stdout.write(self.style.WARNING(summary) if result.error_count else self.style.SUCCESS(summary))
+
+    def run(self, file, file_format, options):
+        return import_products(
+            read_rows(file, file_format), options['chunk_size'], options['dry_run'], options['update_stock']
+        )
@@ -0,0 +1,90 @@
+"""商品検索用の全文検索インデックス(products/search.py)
+
+SQLite: FTS5(trigram)の外部コンテンツテーブルと、商品の追加・更新・削除に追従するトリガー
+PostgreSQL: pg_trgm による name / description の GIN インデックス
+それ以外のデータベースでは何もしない(検索は icontains で行われる)。
+"""
+from django.db import migrations, models
+import django.db.models.deletion
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE products_product_fts USING fts5(
+        name, description, content='products_product', content_rowid='id', tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER products_product_fts_insert AFTER INSERT ON products_product BEGIN
+        INSERT INTO products_product_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END
+    """,
+    """
+    CREATE TRIGGER products_product_fts_delete AFTER DELETE ON products_product BEGIN
+        INSERT INTO products_product_fts(products_product_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+    END
+    """,
+    # 在庫・価格だけの更新ではインデックスを書き換えない
+    """
+    CREATE TRIGGER products_product_fts_update AFTER UPDATE OF name, description ON products_product BEGIN
+        INSERT INTO products_product_fts(products_product_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO products_product_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END
+    """,
+    # rank列の関連度は商品名の一致を説明文の10倍重視する
+    "INSERT INTO products_product_fts(products_product_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0)')",
+    "INSERT INTO products_product_fts(products_product_fts) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARD = [
+    'DROP TRIGGER IF EXISTS products_product_fts_update',
+    'DROP TRIGGER IF EXISTS products_product_fts_delete',
+    'DROP TRIGGER IF EXISTS products_product_fts_insert',
+    'DROP TABLE IF EXISTS products_product_fts',
+]
+
+# icontains は UPPER(列::text) LIKE UPPER(%s) になるため、同じ式にインデックスを張る
+POSTGRESQL_FORWARD = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX product_name_trgm_idx ON products_product USING gin (UPPER(name::text) gin_trgm_ops)',
+    'CREATE INDEX product_desc_trgm_idx ON products_product USING gin (UPPER(description::text) gin_trgm_ops)',
+]
+
+POSTGRESQL_BACKWARD = [
+    'DROP INDEX IF EXISTS product_desc_trgm_idx',
+    'DROP INDEX IF EXISTS product_name_trgm_idx',
+]
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        for sql in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(sql)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0003_product_product_created_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSearchIndex',
+            fields=[
+                ('product', models.OneToOneField(db_column='rowid', db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='search_index', serialize=False, to='products.product')),
+                ('match', models.TextField(db_column='products_product_fts')),
+                ('rank', models.FloatField()),
+            ],
+            options={
+                'db_table': 'products_product_fts',
+                'managed': False,
+            },
+        ),
+        migrations.RunPython(
+            run({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRESQL_FORWARD}),
+            run({'sqlite': SQLITE_BACKWARD, 'postgresql': POSTGRESQL_BACKWARD}),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-17 15:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0004_product_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='image_variants',
+            field=models.JSONField(blank=True, editable=False, null=True, verbose_name='商品画像(縮小版)'),
+        ),
+    ]
@@ -2,6 +2,18 @@ from django.db import models
 from django.core.validators import MinValueValidator
 from django.contrib.auth.models import User
 
+# 一覧・ネスト表示(ProductListSerializer)で使うカラム。created_at はカーソルページネーションに必要
+PRODUCT_LIST_COLUMNS = ['id', 'name', 'price', 'stock', 'image', 'image_variants', 'category', 'category__name', 'created_at']
+
+class ProductQuerySet(models.QuerySet):
+    def with_category(self):
+        """カテゴリーをJOINで取得し、一覧表示でのN+1クエリを防ぐ"""
+        return self.select_related('category')
+
+    def for_list(self):
+        """一覧表示に必要なカラムだけを取得"""
+        return self.with_category().only(*PRODUCT_LIST_COLUMNS)
+
 class Category(models.Model):
     name = models.CharField(max_length=100, unique=True)
     description = models.TextField(blank=True)
@@ -22,17 +34,55 @@ class Product(models.Model):
     price = models.PositiveIntegerField(verbose_name='価格', validators=[MinValueValidator(1)])
     stock = models.PositiveIntegerField(verbose_name='在庫数', default=0)
     image = models.ImageField(upload_to='products/', verbose_name='商品画像', null=True, blank=True)
+    # 縮小したWebPのパス(products/images.py が生成する)
+    # null可にしておくと、SQLiteでもテーブルを作り直さずに列を追加できる(全文検索のトリガーが消えない)
+    image_variants = models.JSONField(verbose_name='商品画像(縮小版)', null=True, blank=True, editable=False)
     category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, blank=True, related_name='products') # カテゴリーとの関連付け
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='作成日時')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='更新日時')
 
+    objects = ProductQuerySet.as_manager()
+
     class Meta:
         verbose_name = '商品'
         verbose_name_plural = '商品'
         ordering = ['-created_at']
+        indexes = [
+            # 商品一覧(新着順・カーソルページネーション)
+            models.Index(fields=['-created_at', '-id'], name='product_created_idx'),
+            # カテゴリー別の新着順一覧
+            models.Index(fields=['category', '-created_at', '-id'], name='product_cat_created_idx'),
+            # 在庫ありのみの新着順一覧(?in_stock=true)
+            models.Index(fields=['-created_at', '-id'], condition=models.Q(stock__gt=0), name='product_instock_created_idx'),
+            # 在庫ありの商品をカテゴリー・価格帯で絞り込む
+            models.Index(fields=['category', 'price'], condition=models.Q(stock__gt=0), name='product_instock_cat_price_idx'),
+        ]
 
     def __str__(self):
         return self.name
 
     def is_in_stock(self):
         return self.stock > 0
+
+class ProductSearchIndex(models.Model):
+    """SQLiteの全文検索インデックス(FTS5仮想テーブル)を結合して検索するための読み取り専用モデル
+
+    テーブルは migrations/0004_product_search で作成し、トリガーで Product に追従させる。
+    PostgreSQLなどには存在しないため、products/search.py からSQLiteのときだけ使う。
+    """
+    product = models.OneToOneField(
+        Product,
+        on_delete=models.DO_NOTHING,  # 削除はトリガーが行う
+        primary_key=True,
+        db_column='rowid',
+        db_constraint=False,
+        related_name='search_index'
+    )
+    # テーブル名と同じ隠し列に対する一致(=)がFTS5の全文検索(MATCH)になる
+    match = models.TextField(db_column='products_product_fts')
+    # 関連度(bm25、小さいほど上位)
+    rank = models.FloatField()
+
+    class Meta:
+        managed = False
+        db_table = 'products_product_fts'
@@ -0,0 +1,57 @@
+"""商品の全文検索(?q=)
+
+SQLite: FTS5のtrigramトークナイザーによる全文検索インデックス(ProductSearchIndex)を結合して検索し、bm25で順位付けする。
+PostgreSQL: pg_trgmのGINインデックスで部分一致を検索し、商品名との類似度で順位付けする
+(日本語の商品名を扱うため、データベースのロケールは C 以外(ja_JP.UTF-8 など)にすること)。
+どちらもn-gramなので、分かち書きのない日本語の商品名でも部分一致で検索できる。
+インデックスは migrations/0004_product_search で作成する。
+
+空白で区切った語はすべて含む商品を返す(AND検索)。trigramは3文字未満の語を検索できないため、
+短い語は通常の部分一致(icontains)で絞り込む。
+"""
+from django.db import connections
+from django.db.models import Case, F, FloatField, Q, Value, When
+
+from ec_shop.pagination import CreatedAtCursorPagination
+
+MIN_TERM_LENGTH = 3
+
+
+def search_products(queryset, q):
+    """q を含む商品に絞り込み、関連度(小さいほど上位)を search_rank として付与する"""
+    terms = q.split()
+    if not terms:
+        return queryset
+
+    vendor = connections[queryset.db].vendor
+    indexed_terms = [term for term in terms if len(term) >= MIN_TERM_LENGTH] if vendor in ('sqlite', 'postgresql') else []
+    for term in terms:
+        if vendor != 'sqlite' or term not in indexed_terms:
+            queryset = queryset.filter(Q(name__icontains=term) | Q(description__icontains=term))
+
+    if vendor == 'sqlite' and indexed_terms:
+        # 各語をフレーズとして渡し、FTS5の構文として解釈されないようにする
+        match = ' AND '.join('"{}"'.format(term.replace('"', '""')) for term in indexed_terms)
+        # 全文検索インデックスを結合するので、一致した行の関連度は1回ずつしか計算しない
+        queryset = queryset.filter(search_index__match=match)
+        rank = F('search_index__rank')
+    elif vendor == 'postgresql' and indexed_terms:
+        from django.contrib.postgres.search import TrigramWordSimilarity
+        rank = -TrigramWordSimilarity(Value(' '.join(terms)), 'name')
+    else:
+        # 商品名に含まれるものを先にする
+        rank = Case(
+            When(Q(*[Q(name__icontains=term) for term in terms]), then=Value(-1.0)),
+            default=Value(0.0),
+            output_field=FloatField()
+        )
+    return queryset.annotate(search_rank=rank)
+
+
+class SearchCursorPagination(CreatedAtCursorPagination):
+    """検索時(search_rank 付き)は関連度順、それ以外は新着順"""
+
+    def get_ordering(self, request, queryset, view):
+        if 'search_rank' in queryset.query.annotations:
+            return ('search_rank', 'id')
+        return super().get_ordering(request, queryset, view)
@@ -0,0 +1,43 @@
+"""ベンチマーク・負荷試験用のカタログデータ生成"""
+import random
+
+from .models import Category, Product
+
+# 検索のベンチマークで現実的な商品名になるよう、組み合わせて商品名を作る
+NAME_PREFIXES = ['国産', '有機', '北海道産', '無添加', '特選', '業務用', '手作り', '訳あり', '限定', '贈答用']
+NAME_WORDS = [
+    'りんご', 'みかん', '緑茶', 'コーヒー豆', 'はちみつ', '醤油', '味噌', 'お米', 'チョコレート', 'クッキー',
+    'タオル', 'マグカップ', 'ノート', 'ボールペン', 'Tシャツ', 'スニーカー', 'リュック', '腕時計', 'イヤホン', '充電器',
+]
+
+
+def seed_catalog(categories=20, products=10000, batch_size=5000, seed=0):
+    """カテゴリーと商品をbulk_createでまとめて作成し、作成したカテゴリーを返す
+
+    約2割の商品は在庫切れ(stock=0)になる。
+    """
+    rng = random.Random(seed)
+    offset = Category.objects.count()
+    created_categories = Category.objects.bulk_create(
+        [Category(name=f'カテゴリー{offset + i}') for i in range(categories)],
+        batch_size=batch_size
+    )
+
+    offset = Product.objects.count()
+    batch = []
+    for i in range(products):
+        name = f'{rng.choice(NAME_PREFIXES)}{rng.choice(NAME_WORDS)} {offset + i}'
+        batch.append(Product(
+            name=name,
+            description=f'{name}の説明。{rng.choice(NAME_WORDS)}と一緒にどうぞ。',
+            price=rng.randint(1, 500) * 100,
+            stock=0 if rng.random() < 0.2 else rng.randint(1, 100),
+            category=rng.choice(created_categories) if created_categories else None,
+        ))
+        if len(batch) >= batch_size:
+            Product.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        Product.objects.bulk_create(batch)
+
+    return created_categories
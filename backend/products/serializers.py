@@ -1,13 +1,34 @@
 from rest_framework import serializers
+from ec_shop.performance import TimedSerializerMixin
+from .images import variant_urls
 from .models import Product, Category
 
-class CategorySerializer(serializers.ModelSerializer):
+class SparseFieldsetMixin:
+    """?fields=id,name のように指定されたフィールドだけを返す(トップレベルのシリアライザーのみ)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        fields = request.query_params.get('fields') if request else None
+        if fields:
+            requested = set(fields.split(','))
+            for name in set(self.fields) - requested:
+                self.fields.pop(name)
+
+class CategorySerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Category
         fields = ['id', 'name', 'description', 'created_at', 'updated_at']
         read_only_fields = ['created_at', 'updated_at']
 
-class ProductSerializer(serializers.ModelSerializer):
+class ImageVariantsMixin(serializers.Serializer):
+    """縮小版の画像URLを {幅: URL} で返す(未生成なら空。imgタグのsrcsetに使う)"""
+    image_variants = serializers.SerializerMethodField()
+
+    def get_image_variants(self, obj):
+        return variant_urls(obj, self.context.get('request'))
+
+class ProductSerializer(TimedSerializerMixin, SparseFieldsetMixin, ImageVariantsMixin, serializers.ModelSerializer):
     category = CategorySerializer(read_only=True) 
     category_id = serializers.PrimaryKeyRelatedField(
         queryset=Category.objects.all(),
@@ -18,5 +39,25 @@ class ProductSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Product
-        fields = ['id', 'name', 'description', 'price', 'stock', 'image', 'category', 'category_id', 'created_at', 'updated_at']
-        read_only_fields = ['created_at', 'updated_at'] 
\ No newline at end of file
+        fields = ['id', 'name', 'description', 'price', 'stock', 'image', 'image_variants', 'category', 'category_id', 'created_at', 'updated_at']
+        read_only_fields = ['created_at', 'updated_at'] 
+
+class ProductListSerializer(TimedSerializerMixin, SparseFieldsetMixin, ImageVariantsMixin, serializers.ModelSerializer):
+    """一覧・ネスト表示用の軽量な商品シリアライザー(説明文やタイムスタンプを含まない)"""
+    category_id = serializers.IntegerField(read_only=True, allow_null=True)
+    category_name = serializers.CharField(source='category.name', read_only=True, default=None)
+
+    class Meta:
+        model = Product
+        fields = ['id', 'name', 'price', 'stock', 'image', 'image_variants', 'category_id', 'category_name']
+        read_only_fields = fields
+
+class ProductImportSerializer(serializers.Serializer):
+    """一括インポート(products/transfer.py)の1行分の検証。id があれば更新、なければ作成する"""
+    id = serializers.IntegerField(min_value=1, required=False)
+    name = serializers.CharField(max_length=100)
+    description = serializers.CharField()
+    price = serializers.IntegerField(min_value=1)
+    stock = serializers.IntegerField(min_value=0, required=False)
+    # カテゴリー名(なければ作成する。空・nullならカテゴリーなし)
+    category = serializers.CharField(max_length=100, allow_blank=True, allow_null=True, required=False)
@@ -0,0 +1,50 @@
+"""商品・カテゴリーの変更時にカタログキャッシュを無効化し、商品画像の縮小版を作る"""
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import Signal, receiver
+
+from .cache import bump_on_commit, product_scopes
+from .images import schedule_deletion, schedule_variants
+from .models import Category, Product
+
+# bulk_update など post_save が飛ばない一括更新で価格が変わったときに送る(引数 product_ids)
+prices_changed = Signal()
+
+
+@receiver(pre_save, sender=Product)
+def remember_previous_values(sender, instance, **kwargs):
+    """保存前のカテゴリー・価格・画像を控えておく
+
+    カテゴリー変更時は移動元のカテゴリーも無効化し、価格変更時はカートの合計金額を集計し直す(carts.signals)。
+    画像が変わったら保存後に縮小版を作り直し、画像を外したら縮小版を消す
+    (古い縮小版は元画像のパスが違うので返されない)。
+    """
+    previous = None
+    if instance.pk is not None:
+        previous = Product.objects.filter(pk=instance.pk).values_list('category_id', 'price', 'image').first()
+    instance._previous_category_id, instance._previous_price, previous_image = previous or (None, None, '')
+    instance._image_changed = (instance.image.name or '') != (previous_image or '')
+
+
+@receiver(post_save, sender=Product)
+def generate_image_variants(sender, instance, **kwargs):
+    if not getattr(instance, '_image_changed', False):
+        return
+    if instance.image:
+        schedule_variants(instance.pk)
+    else:
+        schedule_deletion(instance.pk)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product(sender, instance, **kwargs):
+    bump_on_commit(*product_scopes(
+        instance.pk, instance.category_id, getattr(instance, '_previous_category_id', None)
+    ))
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category(sender, instance, **kwargs):
+    # 商品のレスポンスにはカテゴリー情報が含まれるため、一覧もまとめて無効化する
+    bump_on_commit('products', 'categories', f'category:{instance.pk}')
@@ -1,3 +1,778 @@
-from django.test import TestCase
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, connections
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
+from rest_framework.test import APIClient
+
+from ec_shop.testing import RouteBudgetMixin, retry_on_lock
+
+from carts.models import Cart, CartItem
+from .cache import get_cache
+from .images import generate_variants
+from . import inventory
+from .inventory import InsufficientStock, release_stock, reserve_stock
+from .models import Category, Product
+from .transfer import export_products, import_products, read_rows
+
+User = get_user_model()
+
+
+class ProductQueryCountTests(TestCase):
+    """商品・カテゴリー一覧のクエリ数が件数に比例しないことを確認する"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.category = Category.objects.create(name='食品')
+
+    def create_products(self, count):
+        for i in range(count):
+            category = Category.objects.create(name=f'カテゴリー{Category.objects.count()}')
+            Product.objects.create(name=f'商品{i}', description='', price=100, stock=1, category=category)
+            Product.objects.create(name=f'同カテゴリー商品{i}', description='', price=100, stock=1, category=self.category)
+
+    def count_queries(self, url):
+        get_cache().clear()  # キャッシュを使わない場合のクエリ数を測る
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def test_product_list_query_count_is_constant(self):
+        self.create_products(1)
+        small = self.count_queries('/api/products/')
+        self.create_products(10)
+        self.assertEqual(self.count_queries('/api/products/'), small)
+
+    def test_category_products_query_count_is_constant(self):
+        url = f'/api/categories/{self.category.pk}/products/'
+        self.create_products(1)
+        small = self.count_queries(url)
+        self.create_products(10)
+        self.assertEqual(self.count_queries(url), small)
+
+
+class ProductPaginationTests(TestCase):
+    """商品一覧のカーソル型ページネーション"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        for i in range(5):
+            Product.objects.create(name=f'商品{i}', description='', price=100, stock=1)
+        get_cache().clear()
+
+    def test_walks_every_product_once(self):
+        seen = []
+        url = '/api/products/?page_size=2'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data['results']), 2)
+            seen.extend(product['id'] for product in response.data['results'])
+            url = response.data['next']
+        expected = list(Product.objects.order_by('-created_at', '-id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+
+class ProductRepresentationTests(TestCase):
+    """一覧用の軽量表現と ?fields= による絞り込み"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        category = Category.objects.create(name='食品')
+        self.product = Product.objects.create(
+            name='りんご', description='長い説明文', price=100, stock=5, category=category
+        )
+        get_cache().clear()
+
+    def test_list_uses_slim_representation(self):
+        item = self.client.get('/api/products/').data['results'][0]
+        self.assertEqual(
+            set(item), {'id', 'name', 'price', 'stock', 'image', 'image_variants', 'category_id', 'category_name'}
+        )
+        self.assertEqual(item['category_name'], '食品')
+
+    def test_detail_keeps_full_representation(self):
+        data = self.client.get(f'/api/products/{self.product.pk}/').data
+        self.assertEqual(data['description'], '長い説明文')
+        self.assertEqual(data['category']['name'], '食品')
+
+    def test_sparse_fieldset(self):
+        item = self.client.get('/api/products/?fields=id,price').data['results'][0]
+        self.assertEqual(item, {'id': self.product.pk, 'price': 100})
+        data = self.client.get(f'/api/products/{self.product.pk}/?fields=name').data
+        self.assertEqual(data, {'name': 'りんご'})
+
+class CatalogCacheTests(TestCase):
+    """カタログAPIのキャッシュと無効化"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.category = Category.objects.create(name='食品')
+        self.product = Product.objects.create(
+            name='りんご', description='', price=100, stock=5, category=self.category
+        )
+        get_cache().clear()
+
+    def get(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.data, len(ctx.captured_queries)
+
+    def test_second_request_skips_database(self):
+        url = f'/api/products/{self.product.pk}/'
+        first, first_queries = self.get(url)
+        second, second_queries = self.get(url)
+        self.assertEqual(first, second)
+        self.assertLess(second_queries, first_queries)
+
+    def test_save_invalidates_list_and_detail(self):
+        self.get('/api/products/')
+        self.get(f'/api/products/{self.product.pk}/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.price = 150
+            self.product.save()
+        data, _ = self.get('/api/products/')
+        self.assertEqual(data['results'][0]['price'], 150)
+        data, _ = self.get(f'/api/products/{self.product.pk}/')
+        self.assertEqual(data['price'], 150)
+
+    def test_stock_reservation_keeps_lists_only_until_period_ends(self):
+        list_url = f'/api/categories/{self.category.pk}/products/'
+        detail_url = f'/api/products/{self.product.pk}/'
+        with mock.patch('products.cache.stock_period', return_value=1):
+            list_etag = self.client.get(list_url)['ETag']
+            self.get(detail_url)
+            with self.captureOnCommitCallbacks(execute=True):
+                reserve_stock({self.product.pk: 2})
+            # 注文のたびに一覧のキャッシュとETagを無効化しない
+            self.assertEqual(self.client.get(list_url, HTTP_IF_NONE_MATCH=list_etag).status_code, 304)
+            data, _ = self.get(detail_url)
+            self.assertEqual(data['stock'], 3)
+
+        # 有効期限の区切りを過ぎたら、古い在庫数の一覧は304でもキャッシュからも返さない
+        with mock.patch('products.cache.stock_period', return_value=2):
+            response = self.client.get(list_url, HTTP_IF_NONE_MATCH=list_etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([product['stock'] for product in response.json()['results']], [3])
+
+    def test_selling_out_and_restocking_invalidate_lists(self):
+        url = '/api/products/?in_stock=true'
+        self.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            reserve_stock({self.product.pk: 5})
+        data, _ = self.get(url)
+        self.assertEqual(data['results'], [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            release_stock({self.product.pk: 1})
+        data, _ = self.get(url)
+        self.assertEqual([product['stock'] for product in data['results']], [1])
+
+    def test_category_rename_invalidates_product_detail(self):
+        url = f'/api/products/{self.product.pk}/'
+        self.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category.name = '果物'
+            self.category.save()
+        data, _ = self.get(url)
+        self.assertEqual(data['category']['name'], '果物')
+
+class ConditionalGetTests(TestCase):
+    """ETag・Last-Modified による 304 Not Modified"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.category = Category.objects.create(name='食品')
+        self.product = Product.objects.create(
+            name='りんご', description='', price=100, stock=5, category=self.category
+        )
+        get_cache().clear()
+
+    def test_detail_returns_304_until_changed(self):
+        url = f'/api/products/{self.product.pk}/'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        self.assertNotIn('Last-Modified', response)  # カタログはバージョン番号のETagだけで照合する
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # 強いETagとして送られても弱い比較で一致する
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag.removeprefix('W/'))
+        self.assertEqual(response.status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.stock = 4
+            self.product.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_catalog_etag_needs_no_query(self):
+        for url in ['/api/products/', f'/api/products/{self.product.pk}/', '/api/products/facets/', '/api/categories/']:
+            with self.subTest(url=url):
+                etag = self.client.get(url)['ETag']
+                # 照合にもキャッシュにもデータベースを使わない
+                with self.assertNumQueries(0):
+                    self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+                    self.assertEqual(self.client.get(url)['ETag'], etag)
+
+    def test_category_change_changes_product_etag(self):
+        url = f'/api/categories/{self.category.pk}/products/'
+        etag = self.client.get(url)['ETag']
+        Category.objects.filter(pk=self.category.pk).update(name='果物', updated_at=self.category.updated_at.replace(year=2100))
+        get_cache().clear()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+class ProductSearchTests(TestCase):
+    """?q= による商品検索"""
+
+    def setUp(self):
+        get_cache().clear()
+        self.user = User.objects.create_user(username='buyer', password='pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.chocolate = Product.objects.create(name='北海道産ミルクチョコレート', description='濃厚な味わい', price=500, stock=3)
+        self.cookie = Product.objects.create(name='手作りクッキー', description='チョコレートチップ入り', price=300, stock=3)
+        self.tea = Product.objects.create(name='国産緑茶', description='深蒸し茶', price=800, stock=3)
+
+    def search(self, q, **params):
+        response = self.client.get('/api/products/', {'q': q, **params})
+        self.assertEqual(response.status_code, 200)
+        return [item['id'] for item in response.data['results']]
+
+    def test_japanese_substring_ranked_by_name_match(self):
+        self.assertEqual(self.search('チョコレート'), [self.chocolate.pk, self.cookie.pk])
+        self.assertEqual(self.search('北海道 チョコ'), [self.chocolate.pk])
+
+    def test_short_terms_and_updates(self):
+        self.assertEqual(self.search('緑茶'), [self.tea.pk])
+        self.tea.name = '国産ほうじ茶'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.tea.save()
+        self.assertEqual(self.search('緑茶'), [])
+        self.assertEqual(self.search('ほうじ茶'), [self.tea.pk])
+
+    def test_search_pages_with_cursor(self):
+        for i in range(5):
+            Product.objects.create(name=f'チョコレート詰め合わせ{i}', description='', price=100, stock=1)
+        first = self.client.get('/api/products/', {'q': 'チョコレート', 'page_size': 4}).data
+        second = self.client.get(first['next']).data
+        ids = [item['id'] for item in first['results'] + second['results']]
+        self.assertEqual(len(ids), 7)
+        self.assertEqual(len(set(ids)), 7)
+
+
+class FacetTests(TestCase):
+    """絞り込み用の件数集計"""
+
+    def setUp(self):
+        get_cache().clear()
+        self.user = User.objects.create_user(username='buyer', password='pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.food = Category.objects.create(name='食品')
+        self.goods = Category.objects.create(name='雑貨')
+        for price, stock, category in [
+            (500, 1, self.food), (800, 0, self.food), (2000, 5, self.food),
+            (4000, 2, self.goods), (20000, 0, self.goods), (1500, 3, None),
+        ]:
+            Product.objects.create(name='商品', description='', price=price, stock=stock, category=category)
+
+    def facets(self, **params):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/products/facets/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.data, len(ctx.captured_queries)
+
+    def test_counts_in_one_grouped_query(self):
+        data, queries = self.facets()
+        self.assertEqual((data['count'], data['in_stock']), (6, 4))
+        self.assertEqual(
+            [(category['name'], category['count'], category['in_stock']) for category in data['categories']],
+            [('食品', 3, 2), ('雑貨', 2, 1), (None, 1, 1)]
+        )
+        self.assertEqual(
+            [(bucket['min'], bucket['count'], bucket['in_stock']) for bucket in data['price_ranges']],
+            [(0, 2, 1), (1000, 2, 2), (3000, 1, 1), (5000, 0, 0), (10000, 1, 0)]
+        )
+        self.assertEqual(queries, 1)  # ファセットの集計だけ(ETagはキャッシュのバージョン番号から作る)
+
+        _, queries = self.facets()
+        self.assertEqual(queries, 0)  # キャッシュから返す
+
+    def test_follows_list_filters(self):
+        data, _ = self.facets(category=self.food.pk, in_stock='true')
+        self.assertEqual((data['count'], data['in_stock']), (2, 2))
+        self.assertEqual([category['name'] for category in data['categories']], ['食品'])
+
+
+class ImageVariantTests(TestCase):
+    """商品画像の縮小版(WebP)の生成"""
+
+    def setUp(self):
+        get_cache().clear()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings = override_settings(MEDIA_ROOT=self.media_root, PRODUCT_IMAGE_BACKGROUND=False)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def upload(self, width, height, color='red'):
+        buffer = io.BytesIO()
+        Image.new('RGB', (width, height), color).save(buffer, 'PNG')
+        return SimpleUploadedFile('photo.png', buffer.getvalue(), content_type='image/png')
+
+    def test_variants_generated_once_per_upload(self):
+        product = Product(name='りんご', description='', price=100, stock=1, image=self.upload(1000, 500))
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        product.refresh_from_db()
+        widths = product.image_variants['widths']
+        self.assertEqual(sorted(widths), ['320', '640'])  # 元画像より大きい幅は作らない
+        storage = product.image.storage
+        with storage.open(widths['320']) as variant, Image.open(variant) as image:
+            self.assertEqual((image.format, image.size), ('WEBP', (320, 160)))
+
+        # 画像以外の変更では作り直さない
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            product.stock = 5
+            product.save()
+        self.assertEqual(len(callbacks), 1)  # カタログキャッシュの無効化のみ
+
+        old_names = set(widths.values())
+        product.image = self.upload(400, 400, 'blue')
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        product.refresh_from_db()
+        self.assertEqual(sorted(product.image_variants['widths']), ['320'])
+        self.assertFalse(any(storage.exists(name) for name in old_names))
+
+    def save(self, product):
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        product.refresh_from_db()
+        return product
+
+    def test_force_regenerates_and_deletes_old_files(self):
+        product = self.save(Product(name='りんご', description='', price=100, stock=1, image=self.upload(1000, 500)))
+        storage = product.image.storage
+        old_names = set(product.image_variants['widths'].values())
+
+        # 設定が同じなら同じ名前のファイルになり、消されない
+        self.assertFalse(generate_variants(product.pk))
+        self.assertTrue(generate_variants(product.pk, force=True))
+        product.refresh_from_db()
+        self.assertEqual(set(product.image_variants['widths'].values()), old_names)
+        self.assertTrue(all(storage.exists(name) for name in old_names))
+
+        with override_settings(PRODUCT_IMAGE_WIDTHS=[200]):
+            self.assertFalse(generate_variants(product.pk))  # 生成済み
+            self.assertTrue(generate_variants(product.pk, force=True))
+        product.refresh_from_db()
+        self.assertEqual(sorted(product.image_variants['widths']), ['200'])
+        self.assertTrue(storage.exists(product.image_variants['widths']['200']))
+        self.assertFalse(any(storage.exists(name) for name in old_names))
+
+    def test_clearing_image_deletes_variants(self):
+        product = self.save(Product(name='りんご', description='', price=100, stock=1, image=self.upload(700, 700)))
+        storage = product.image.storage
+        names = set(product.image_variants['widths'].values())
+        self.assertTrue(all(storage.exists(name) for name in names))
+
+        product.image = None
+        product = self.save(product)
+        self.assertIsNone(product.image_variants)
+        self.assertFalse(any(storage.exists(name) for name in names))
+
+    def test_serializer_exposes_urls_only_for_current_image(self):
+        user = User.objects.create_user(username='buyer', password='pass')
+        self.client.force_login(user)
+        product = Product(name='りんご', description='', price=100, stock=1, image=self.upload(700, 700))
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        response = self.client.get('/api/products/')
+        variants = response.json()['results'][0]['image_variants']
+        self.assertEqual(sorted(variants), ['320', '640'])
+        self.assertTrue(variants['320'].startswith('http://testserver/media/products/variants/'))
+        self.assertTrue(variants['320'].endswith('.webp'))
+
+        Product.objects.filter(pk=product.pk).update(image='products/other.png')
+        get_cache().clear()
+        response = self.client.get(f'/api/products/{product.pk}/')
+        self.assertEqual(response.json()['image_variants'], {})
+
+
+class ProductTransferTests(TestCase):
+    """CSV・JSONLでの商品の一括インポート・エクスポート"""
+
+    def setUp(self):
+        get_cache().clear()
+        self.category = Category.objects.create(name='果物')
+        self.apple = Product.objects.create(name='りんご', description='赤い', price=100, stock=5, category=self.category)
+
+    def import_csv(self, text, **kwargs):
+        return import_products(read_rows(io.BytesIO(text.encode('utf-8-sig')), 'csv'), **kwargs)
+
+    def test_csv_import_creates_and_updates_in_chunks(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            result = self.import_csv(
+                'id,name,description,price,stock,category\n'
+                f'{self.apple.pk},りんご(大),赤くて大きい,150,,野菜\n'
+                ',みかん,甘い,80,10,果物\n'
+                ',キャベツ,丸い,200,3,野菜\n'
+                ',ぶどう,房,300,,\n',
+                chunk_size=2
+            )
+        self.assertEqual((result.created, result.updated, result.categories_created, result.error_count), (3, 1, 1, 0))
+
+        self.apple.refresh_from_db()
+        self.assertEqual((self.apple.name, self.apple.price, self.apple.stock), ('りんご(大)', 150, 5))  # 空欄の在庫は元のまま
+        self.assertEqual(self.apple.category.name, '野菜')
+        self.assertEqual(Product.objects.get(name='キャベツ').category, self.apple.category)
+        grape = Product.objects.get(name='ぶどう')
+        self.assertEqual((grape.stock, grape.category), (0, None))
+
+    def test_invalid_rows_are_reported_and_skipped(self):
+        result = self.import_csv(
+            'id,name,description,price,stock,category\n'
+            ',みかん,甘い,0,10,果物\n'
+            '999999,メロン,高い,1000,1,果物\n'
+            ',ぶどう,房,300,1,果物\n'
+        )
+        self.assertEqual((result.created, result.error_count), (1, 2))
+        self.assertEqual([line for line, _ in result.errors], [2, 3])
+        self.assertIn('price', result.errors[0][1])
+        self.assertTrue(Product.objects.filter(name='ぶどう').exists())
+
+        rows = read_rows(io.BytesIO('{"name": "メロン"\n\n{"name": "すいか"}\n'.encode()), 'jsonl')
+        result = import_products(rows)
+        self.assertEqual([line for line, _ in result.errors], [1, 3])
+        self.assertIn('JSON', result.errors[0][1])
+
+    def test_dry_run_does_not_save(self):
+        result = self.import_csv(
+            'id,name,description,price,stock,category\n'
+            f'{self.apple.pk},りんご,赤い,500,5,新カテゴリー\n'
+            ',みかん,甘い,80,10,果物\n',
+            dry_run=True
+        )
+        self.assertEqual((result.created, result.updated, result.categories_created), (1, 1, 1))
+        self.assertEqual(Product.objects.count(), 1)
+        self.assertFalse(Category.objects.filter(name='新カテゴリー').exists())
+        self.apple.refresh_from_db()
+        self.assertEqual(self.apple.price, 100)
+
+    def test_reimport_keeps_live_stock_unless_requested(self):
+        exported = ''.join(export_products('csv'))
+        reserve_stock({self.apple.pk: 2})  # 書き出した後に注文が入った
+        edited = exported.replace(',りんご,赤い,100,', ',りんご,赤い,120,')
+
+        result = self.import_csv(edited.removeprefix('\ufeff'))
+        self.assertEqual((result.updated, result.unchanged), (1, 0))
+        self.apple.refresh_from_db()
+        self.assertEqual((self.apple.price, self.apple.stock), (120, 3))  # 在庫は書き出した時点の値で上書きしない
+
+        result = self.import_csv(edited.removeprefix('\ufeff'), update_stock=True)
+        self.assertEqual(result.updated, 1)
+        self.apple.refresh_from_db()
+        self.assertEqual((self.apple.price, self.apple.stock), (120, 5))
+
+    def test_price_change_updates_cart_totals_and_cache(self):
+        user = User.objects.create_user(username='buyer', password='pass')
+        cart = Cart.objects.create(user=user)
+        CartItem.objects.create(cart=cart, product=self.apple, quantity=2)
+        Cart.objects.filter(pk=cart.pk).recalculate_totals()
+        client = APIClient()
+        client.force_authenticate(user)
+        client.get(f'/api/products/{self.apple.pk}/')  # キャッシュさせる
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.import_csv(f'id,name,description,price\n{self.apple.pk},りんご,赤い,120\n')
+        cart.refresh_from_db()
+        self.assertEqual(cart.total_price, 240)
+        self.assertEqual(client.get(f'/api/products/{self.apple.pk}/').json()['price'], 120)
+
+    def test_export_streams_csv_and_jsonl(self):
+        Product.objects.create(name='みかん, 大', description='甘い\n冬', price=80, stock=10)
+        staff = User.objects.create_user(username='staff', password='pass', is_staff=True)
+        client = APIClient()
+        client.force_authenticate(staff)
+
+        response = client.get('/api/products/export/')
+        self.assertTrue(response.streaming)
+        self.assertIn('attachment; filename="products-', response['Content-Disposition'])
+        content = b''.join(response.streaming_content)
+        self.assertTrue(content.startswith('\ufeffid,name,description,price,stock,category\r\n'.encode()))
+
+        response = client.get('/api/products/export/?file_format=jsonl')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(rows[0], {
+            'id': self.apple.pk, 'name': 'りんご', 'description': '赤い', 'price': 100, 'stock': 5, 'category': '果物'
+        })
+        self.assertIsNone(rows[1]['category'])
+
+        self.assertEqual(client.get('/api/products/export/?file_format=xml').status_code, 400)
+        client.force_authenticate(User.objects.create_user(username='buyer', password='pass'))
+        self.assertEqual(client.get('/api/products/export/').status_code, 403)
+
+    def test_commands_round_trip(self):
+        Product.objects.create(name='みかん, 大', description='甘い\n冬', price=80, stock=10)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for file_format in ('csv', 'jsonl'):
+            with self.subTest(file_format=file_format):
+                path = os.path.join(directory, f'products.{file_format}')
+                call_command('export_products', output=path, format=file_format, chunk_size=1)
+                out = io.StringIO()
+                call_command('import_products', path, stdout=out, stderr=io.StringIO())
+                self.assertIn('0件を作成、0件を更新しました(変更なし 2件', out.getvalue())  # 値が同じなら更新しない
+                self.assertEqual(
+                    list(Product.objects.order_by('pk').values_list('name', 'description', 'price', 'stock', 'category')),
+                    [('りんご', '赤い', 100, 5, self.category.pk), ('みかん, 大', '甘い\n冬', 80, 10, None)]
+                )
+
+    def test_admin_import_upload(self):
+        admin_user = User.objects.create_superuser(username='admin', password='pass')
+        self.client.force_login(admin_user)
+        self.assertContains(self.client.get('/admin/products/product/'), '/admin/products/product/import/')
+        self.assertEqual(self.client.get('/admin/products/product/import/').status_code, 200)
+        upload = SimpleUploadedFile('products.jsonl', '{"name": "みかん", "description": "甘い", "price": 80}\n'.encode())
+        response = self.client.post('/admin/products/product/import/', {'file': upload}, follow=True)
+        self.assertContains(response, '1件を作成、0件を更新しました')
+        self.assertTrue(Product.objects.filter(name='みかん').exists())
+
+
+class InventoryTests(TestCase):
+    """在庫の引当・戻し処理"""
+
+    def setUp(self):
+        self.apple = Product.objects.create(name='りんご', description='', price=100, stock=5)
+        self.pear = Product.objects.create(name='なし', description='', price=200, stock=1)
+
+    def test_reserve_and_release(self):
+        reserve_stock({self.apple.pk: 3, self.pear.pk: 1})
+        self.apple.refresh_from_db()
+        self.pear.refresh_from_db()
+        self.assertEqual((self.apple.stock, self.pear.stock), (2, 0))
+
+        release_stock({self.apple.pk: 3, self.pear.pk: 1})
+        self.apple.refresh_from_db()
+        self.pear.refresh_from_db()
+        self.assertEqual((self.apple.stock, self.pear.stock), (5, 1))
+
+    def test_reserve_is_all_or_nothing(self):
+        with self.assertRaises(InsufficientStock) as ctx:
+            reserve_stock({self.apple.pk: 1, self.pear.pk: 2})
+        self.assertEqual(ctx.exception.products, [self.pear])
+        self.apple.refresh_from_db()
+        self.assertEqual(self.apple.stock, 5)
+
+    def test_stock_sold_after_the_read_is_not_oversold(self):
+        # ロックが効かず、在庫を読んだ後に他の注文が売り切った場合でも条件付きUPDATEで止まる
+        # (SQLiteには行ロックがないため、どのDBでも確認できるよう割り込みを再現する)
+        lock_products = inventory._lock_products
+
+        def sold_out_after_read(product_ids):
+            locked = lock_products(product_ids)
+            Product.objects.filter(pk=self.apple.pk).update(stock=0)
+            return locked
+
+        with mock.patch.object(inventory, '_lock_products', sold_out_after_read):
+            with self.assertRaises(InsufficientStock):
+                reserve_stock({self.apple.pk: 1, self.pear.pk: 1})
+        # 割り込んだ更新も同じトランザクションのため、全体が巻き戻る
+        self.apple.refresh_from_db()
+        self.pear.refresh_from_db()
+        self.assertEqual((self.apple.stock, self.pear.stock), (5, 1))
+
+
+class ConcurrentReservationTests(TransactionTestCase):
+    """多数のスレッドが同じ商品を同時に購入しても売り越さないことを確認する"""
+
+    buyers = 100
+    stock = 30
+
+    def test_no_oversell_under_concurrency(self):
+        product = Product.objects.create(name='限定品', description='', price=1000, stock=self.stock)
+        other = Product.objects.create(name='おまけ', description='', price=10, stock=self.buyers)
+        barrier = threading.Barrier(self.buyers)
+        results = []
+
+        def buy(index):
+            try:
+                barrier.wait()
+                # PK順ロックの確認のため、商品の指定順をスレッドごとに変える
+                if index % 2:
+                    quantities = {product.pk: 1, other.pk: 1}
+                else:
+                    quantities = {other.pk: 1, product.pk: 1}
+                retry_on_lock(lambda: reserve_stock(quantities))
+                results.append(True)
+            except InsufficientStock:
+                results.append(False)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=buy, args=(i,)) for i in range(self.buyers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        product.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(results.count(True), self.stock)
+        self.assertEqual(product.stock, 0)
+        self.assertEqual(other.stock, self.buyers - self.stock)
+
+
+# ルートごとのクエリ数の予算(「URL名 メソッド」: 上限)。数え方は ec_shop/tests.py を参照。
+QUERY_BUDGETS = {
+    'category-list GET': 1,
+    'category-list POST': 2,
+    'category-detail GET': 1,
+    'category-detail PUT': 3,
+    'category-detail PATCH': 3,
+    'category-detail DELETE': 3,
+    'category-products GET': 2,
+    'product-list GET': 1,
+    'product-list POST': 2,
+    'product-facets GET': 1,
+    'product-export GET': 1,
+    'product-detail GET': 1,
+    'product-detail PUT': 4,
+    'product-detail PATCH': 4,
+    'product-detail DELETE': 6,
+}
+
+
+class QueryBudgetTests(RouteBudgetMixin, TestCase):
+    """カテゴリー・商品のAPIのクエリ数がデータ量によらず一定で、予算以内であることを確認する"""
+
+    query_budgets = QUERY_BUDGETS
+
+    def test_category_list_get(self):
+        self.assertRouteBudget(
+            'category-list GET', lambda _: self.client.get('/api/categories/'),
+            lambda n: [self.make_products(1) for _ in range(n)]
+        )
+
+    def test_category_list_post(self):
+        self.assertRouteBudget(
+            'category-list POST',
+            lambda _: self.client.post('/api/categories/', {'name': self.unique('カテゴリー')}, format='json')
+        )
+
+    def category_with_products(self, n):
+        category = Category.objects.create(name=self.unique('カテゴリー'))
+        self.make_products(n, category=category)
+        return category
+
+    def test_category_detail_get(self):
+        self.assertRouteBudget(
+            'category-detail GET', lambda category: self.client.get(f'/api/categories/{category.pk}/'),
+            self.category_with_products
+        )
+
+    def test_category_detail_put(self):
+        self.assertRouteBudget('category-detail PUT', lambda category: self.client.put(
+            f'/api/categories/{category.pk}/', {'name': self.unique('カテゴリー')}, format='json'
+        ), self.category_with_products)
+
+    def test_category_detail_patch(self):
+        self.assertRouteBudget('category-detail PATCH', lambda category: self.client.patch(
+            f'/api/categories/{category.pk}/', {'name': self.unique('カテゴリー')}, format='json'
+        ), self.category_with_products)
+
+    def test_category_detail_delete(self):
+        self.assertRouteBudget(
+            'category-detail DELETE', lambda category: self.client.delete(f'/api/categories/{category.pk}/'),
+            self.category_with_products
+        )
+
+    def test_category_products_get(self):
+        self.assertRouteBudget(
+            'category-products GET', lambda category: self.client.get(f'/api/categories/{category.pk}/products/'),
+            self.category_with_products
+        )
+
+    def test_product_list_get(self):
+        self.assertRouteBudget(
+            'product-list GET', lambda _: self.client.get('/api/products/'),
+            lambda n: [self.make_products(1) for _ in range(n)]  # カテゴリーも n 件
+        )
+
+    def test_product_list_post(self):
+        self.assertRouteBudget('product-list POST', lambda category: self.client.post('/api/products/', {
+            'name': self.unique('商品'), 'description': '説明', 'price': 100, 'stock': 1, 'category_id': category.pk
+        }, format='json'), self.category_with_products)
+
+    def test_product_facets_get(self):
+        self.assertRouteBudget(
+            'product-facets GET', lambda _: self.client.get('/api/products/facets/'),
+            lambda n: [self.make_products(2) for _ in range(n)]
+        )
+
+    def test_product_export_get(self):
+        self.user.is_staff = True
+        self.user.save()
+
+        def request(_):
+            response = self.client.get('/api/products/export/?file_format=jsonl')
+            b''.join(response.streaming_content)  # 送信しながら読むクエリも数える
+            return response
+        self.assertRouteBudget('product-export GET', request, lambda n: [self.make_products(1) for _ in range(n)])
+
+    def product_in_carts(self, n):
+        """n 人のカートに入っている商品(価格の変更・削除でカートの合計を更新する)"""
+        product = self.make_products(1)[0]
+        users = User.objects.bulk_create([User(username=self.unique('user')) for _ in range(n)])
+        carts = Cart.objects.bulk_create([Cart(user=user) for user in users])
+        CartItem.objects.bulk_create([CartItem(cart=cart, product=product, quantity=1) for cart in carts])
+        return product
+
+    def test_product_detail_get(self):
+        self.assertRouteBudget(
+            'product-detail GET', lambda product: self.client.get(f'/api/products/{product.pk}/'),
+            self.product_in_carts
+        )
+
+    def test_product_detail_put(self):
+        self.assertRouteBudget('product-detail PUT', lambda product: self.client.put(f'/api/products/{product.pk}/', {
+            'name': self.unique('商品'), 'description': '説明', 'price': 200, 'stock': 5
+        }, format='json'), self.product_in_carts)
+
+    def test_product_detail_patch(self):
+        self.assertRouteBudget('product-detail PATCH', lambda product: self.client.patch(
+            f'/api/products/{product.pk}/', {'price': 300}, format='json'
+        ), self.product_in_carts)
+
+    def test_product_detail_delete(self):
+        self.assertRouteBudget(
+            'product-detail DELETE', lambda product: self.client.delete(f'/api/products/{product.pk}/'),
+            self.product_in_carts
+        )
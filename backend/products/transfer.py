@@ -0,0 +1,245 @@
+"""商品の一括インポート・エクスポート(CSV / JSONL)
+
+列: id, name, description, price, stock, category(カテゴリー名)
+
+インポートはファイルを1行ずつ読み、chunk_size 行ごとに検証してカテゴリーと商品をまとめて
+作成・更新する(bulk_create / bulk_update。1チャンクのクエリ数は行数によらずほぼ一定)。
+メモリの使用量は chunk_size に比例し、ファイルの大きさにはよらない。
+    - id のある行は既存の商品を更新する(存在しない id はエラー)。ない行は新しく作成する。
+    - category を省略した更新では元の値を残す。category が空ならカテゴリーなしにする。
+    - 既存の商品の在庫数は update_stock を指定したときだけ更新する。書き出した後も注文で在庫は減り続けるため、
+      書き出したファイルを編集して取り込み直すと、古い在庫数で上書きして売り越してしまう。
+      指定したときも、ファイルの在庫数をそのまま設定する(棚卸しの結果の反映などに使う)。
+    - 値の変わらない行は更新しない(updated_at も変えない)。
+    - 存在しないカテゴリーは名前だけで作成する。
+    - エラーのある行は飛ばして残りを取り込む。チャンクごとにコミットするため、
+      途中で失敗してもそれより前のチャンクは取り込まれたままになる。
+
+一括操作では post_save が飛ばないため、カタログキャッシュの無効化と、価格が変わった商品の
+prices_changed(カートの合計金額の集計し直し)はここで行う。
+
+エクスポートは .iterator(chunk_size=...) で読みながら文字列を返すジェネレーターで、
+StreamingHttpResponse やファイルへの書き出しに使う(全件をメモリに載せない)。
+"""
+import csv
+import io
+import json
+from collections import defaultdict
+from itertools import islice
+
+from django.db import transaction
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from .cache import bump_on_commit, product_scopes
+from .models import Category, Product
+from .serializers import ProductImportSerializer
+from .signals import prices_changed
+
+FIELDS = ['id', 'name', 'description', 'price', 'stock', 'category']
+UPDATE_FIELDS = ['name', 'description', 'price', 'category_id']  # update_stock のときは stock も
+FORMATS = ['csv', 'jsonl']
+CONTENT_TYPES = {'csv': 'text/csv; charset=utf-8', 'jsonl': 'application/x-ndjson; charset=utf-8'}
+EXTENSIONS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+
+IMPORT_CHUNK_SIZE = 1000
+EXPORT_CHUNK_SIZE = 2000
+MAX_REPORTED_ERRORS = 100  # ImportResult.errors に残すエラーの数(件数は error_count にすべて数える)
+
+
+def detect_format(filename):
+    """拡張子から形式を返す(分からなければ None)"""
+    name = (filename or '').lower()
+    return next((file_format for extension, file_format in EXTENSIONS.items() if name.endswith(extension)), None)
+
+
+class ImportResult:
+    """インポートの結果(dry_run のときは作成・更新される予定の件数)"""
+
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0  # id があるが値が変わらなかった行
+        self.categories_created = 0
+        self.error_count = 0
+        self.errors = []  # [(行番号, エラー内容)]
+
+    def add_error(self, line_number, error):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line_number, error))
+
+
+def read_rows(file, file_format):
+    """バイナリモードのファイルから (行番号, 値の辞書) を1行ずつ返す
+
+    JSONとして読めない行は、値の辞書の代わりに ValueError を返す。
+    """
+    text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')  # Excelで保存したCSVのBOMを除く
+    if file_format == 'csv':
+        reader = csv.DictReader(text)
+        for row in reader:
+            # 空欄は省略として扱う(category だけは空欄でカテゴリーなし)
+            yield reader.line_num, {
+                key: value for key, value in row.items()
+                if key in FIELDS and value is not None and (value != '' or key == 'category')
+            }
+    elif file_format == 'jsonl':
+        for line_number, line in enumerate(text, 1):
+            if not line.strip():
+                continue
+            try:
+                yield line_number, json.loads(line)
+            except ValueError as e:
+                yield line_number, ValueError(f'JSONとして読めません({e})')
+    else:
+        raise ValueError(f'未対応の形式です: {file_format}')
+
+
+def describe_errors(errors):
+    """シリアライザーのエラーを1行の文字列にする"""
+    if isinstance(errors, dict):
+        return '; '.join(f'{field}: {" ".join(map(str, messages))}' for field, messages in errors.items())
+    return ' '.join(map(str, errors))
+
+
+def import_products(rows, chunk_size=IMPORT_CHUNK_SIZE, dry_run=False, update_stock=False):
+    """read_rows() の (行番号, 値) を chunk_size 行ずつ取り込み、ImportResult を返す
+
+    dry_run のときは検証と件数の集計だけ行い、データベースには反映しない。
+    update_stock のときは既存の商品の在庫数もファイルの値にする。
+    """
+    result = ImportResult()
+    rows = iter(rows)
+    while chunk := list(islice(rows, chunk_size)):
+        valid = []
+        for line_number, data in chunk:
+            if isinstance(data, Exception):
+                result.add_error(line_number, str(data))
+                continue
+            serializer = ProductImportSerializer(data=data)
+            if serializer.is_valid():
+                valid.append((line_number, serializer.validated_data))
+            else:
+                result.add_error(line_number, describe_errors(serializer.errors))
+
+        with transaction.atomic():
+            import_chunk(valid, result, dry_run, update_stock)
+            if dry_run:
+                transaction.set_rollback(True)
+    return result
+
+
+def resolve_categories(names, result):
+    """カテゴリー名: ID を返す(ないカテゴリーは作成する)"""
+    if not names:
+        return {}
+    categories = dict(Category.objects.filter(name__in=names).values_list('name', 'pk'))
+    missing = names - categories.keys()
+    if missing:
+        # 同時に作られた場合は既存のものを使う
+        Category.objects.bulk_create([Category(name=name) for name in missing], ignore_conflicts=True)
+        categories = dict(Category.objects.filter(name__in=names).values_list('name', 'pk'))
+        result.categories_created += len(missing)
+    return categories
+
+
+def import_chunk(rows, result, dry_run, update_stock):
+    categories = resolve_categories({data['category'] for _, data in rows if data.get('category')}, result)
+    fields = [*UPDATE_FIELDS, 'stock'] if update_stock else UPDATE_FIELDS
+    # 読んでから書き込むまでの間に注文などで変更されないようロックする(reserve_stock と同じPK順)
+    existing = {
+        product.pk: product
+        for product in Product.objects.select_for_update().only(*fields)
+        .filter(pk__in={data['id'] for _, data in rows if 'id' in data}).order_by('pk')
+    }
+    previous = {pk: {field: getattr(product, field) for field in fields} for pk, product in existing.items()}
+
+    to_create = []
+    to_update = {}  # 同じ商品が複数行あれば後の行の値にする
+    for line_number, data in rows:
+        if 'id' in data:
+            product = existing.get(data['id'])
+            if product is None:
+                result.add_error(line_number, f'id: ID {data["id"]} の商品は存在しません')
+                continue
+            to_update[product.pk] = product
+        else:
+            product = Product()
+            to_create.append(product)
+        product.name = data['name']
+        product.description = data['description']
+        product.price = data['price']
+        if 'stock' in data and (update_stock or product.pk is None):
+            product.stock = data['stock']
+        if 'category' in data:
+            product.category_id = categories.get(data['category']) if data['category'] else None
+
+    # 値の変わった列だけを更新する(bulk_update は行×列ごとに CASE 式を作るため、書き出したファイルを
+    # そのまま取り込み直すときなど、変わっていない行・列を含めると極端に遅くなる)
+    groups = defaultdict(list)  # 変わった列: 商品
+    for product in to_update.values():
+        changed = tuple(field for field in fields if getattr(product, field) != previous[product.pk][field])
+        if changed:
+            groups[changed].append(product)
+        else:
+            result.unchanged += 1
+    now = timezone.now()
+    Product.objects.bulk_create(to_create)
+    for changed_fields, products in groups.items():
+        for product in products:
+            product.updated_at = now  # bulk_update では auto_now が効かない
+        Product.objects.bulk_update(products, [*changed_fields, 'updated_at'])
+    updated = [product for products in groups.values() for product in products]
+    result.created += len(to_create)
+    result.updated += len(updated)
+    if dry_run:
+        return
+
+    scopes = {'products', *(f'category:{product.category_id}' for product in to_create if product.category_id)}
+    for product in updated:
+        scopes.update(product_scopes(product.pk, product.category_id, previous[product.pk]['category_id']))
+    if result.categories_created:
+        scopes.add('categories')
+    bump_on_commit(*scopes)
+
+    changed_prices = [product.pk for product in updated if product.price != previous[product.pk]['price']]
+    if changed_prices:
+        prices_changed.send(sender=Product, product_ids=changed_prices)
+
+
+class Echo:
+    """csv.writer の書き込み先(書いた文字列をそのまま返す)"""
+
+    def write(self, value):
+        return value
+
+
+def export_products(file_format, chunk_size=EXPORT_CHUNK_SIZE, queryset=None):
+    """商品をID順に chunk_size 件ずつ文字列にして返すジェネレーター"""
+    queryset = Product.objects.all() if queryset is None else queryset
+    rows = queryset.order_by('pk').values_list(
+        'id', 'name', 'description', 'price', 'stock', 'category__name'
+    ).iterator(chunk_size=chunk_size)
+
+    if file_format == 'csv':
+        writer = csv.writer(Echo())
+        format_row = writer.writerow
+        yield '\ufeff' + writer.writerow(FIELDS)  # BOM付きにしてExcelでも文字化けしないようにする
+    elif file_format == 'jsonl':
+        def format_row(row):
+            return json.dumps(dict(zip(FIELDS, row)), ensure_ascii=False) + '\n'
+    else:
+        raise ValueError(f'未対応の形式です: {file_format}')
+
+    while chunk := list(islice(rows, chunk_size)):
+        yield ''.join(map(format_row, chunk))
+
+
+def export_response(file_format, chunk_size=EXPORT_CHUNK_SIZE):
+    """全商品をダウンロードさせる StreamingHttpResponse を返す"""
+    response = StreamingHttpResponse(
+        export_products(file_format, chunk_size), content_type=CONTENT_TYPES[file_format]
+    )
+    response['Content-Disposition'] = f'attachment; filename="products-{timezone.localdate():%Y%m%d}.{file_format}"'
+    return response
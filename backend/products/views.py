@@ -3,35 +3,58 @@ from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from django_filters.rest_framework import DjangoFilterBackend
+from ec_shop.pagination import CreatedAtCursorPagination, NameCursorPagination
+from .cache import CatalogCacheMixin
+from .facets import get_facets
 from .models import Product, Category
-from .serializers import ProductSerializer, CategorySerializer
+from .search import SearchCursorPagination, search_products
+from .serializers import ProductSerializer, ProductListSerializer, CategorySerializer
+from .transfer import FORMATS, export_response
 
 # Create your views here.
 
-class CategoryViewSet(viewsets.ModelViewSet):
+class CategoryViewSet(CatalogCacheMixin, viewsets.ModelViewSet):
     queryset = Category.objects.all() # 全てのカテゴリーを取得
     serializer_class = CategorySerializer # カテゴリーのシリアライザーを使用
     permission_classes = [permissions.IsAuthenticated] # 認証されたユーザーのみがアクセスできる
+    pagination_class = NameCursorPagination # 名前順のカーソル型ページネーション
+
+    def get_cache_scopes(self, request):
+        if self.action == 'products':
+            return [f"category:{self.kwargs['pk']}"] # カテゴリー内の商品一覧(カテゴリーの変更でも進む)
+        return ['categories']
 
     @action(detail=True, methods=['get']) # 詳細なデータを取得するためのアクション　detail=TrueはカテゴリーのIDを取得するためのアクション
     def products(self, request, pk=None): # カテゴリーのIDを取得
+        return self.build_response(request, lambda: self.products_response(request)) # 変更がなければ304、キャッシュがあればそれを返す
+
+    def products_response(self, request):
         category = self.get_object() # カテゴリーのオブジェクトを取得   
-        products = category.products.all() # カテゴリーに紐づく商品を取得
-        serializer = ProductSerializer(products, many=True) # 商品のシリアライザーを使用
-        return Response(serializer.data) # 商品のデータを返す
+        products = category.products.for_list() # カテゴリーに紐づく商品を一覧表示に必要なカラムだけ取得
+        paginator = CreatedAtCursorPagination() # 商品一覧と同じ並び順でページ分割
+        page = paginator.paginate_queryset(products, request, view=self)
+        serializer = ProductListSerializer(page, many=True, context=self.get_serializer_context()) # 一覧用の軽量なシリアライザーを使用
+        return paginator.get_paginated_response(serializer.data) # 商品のデータを返す
 
-class ProductViewSet(viewsets.ModelViewSet):
-    queryset = Product.objects.all()
+class ProductViewSet(CatalogCacheMixin, viewsets.ModelViewSet):
+    queryset = Product.objects.with_category()
     serializer_class = ProductSerializer
     permission_classes = [permissions.IsAuthenticated]
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ['category', 'stock', 'price']
+    pagination_class = SearchCursorPagination  # ?q= のときは関連度順
+
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return ProductListSerializer
+        return ProductSerializer
 
     def get_queryset(self):
-        queryset = Product.objects.all()
+        queryset = Product.objects.for_list() if self.action == 'list' else Product.objects.with_category()
         in_stock = self.request.query_params.get('in_stock', None)
         min_price = self.request.query_params.get('min_price', None)
         max_price = self.request.query_params.get('max_price', None)
+        q = self.request.query_params.get('q', None)
 
         if in_stock == 'true':
             queryset = queryset.filter(stock__gt=0)
@@ -39,5 +62,30 @@ class ProductViewSet(viewsets.ModelViewSet):
             queryset = queryset.filter(price__gte=min_price)
         if max_price is not None:
             queryset = queryset.filter(price__lte=max_price)
+        if q:
+            queryset = search_products(queryset, q)
 
         return queryset
+
+    def get_cache_scopes(self, request):
+        if self.action == 'retrieve':
+            return [f"product:{self.kwargs['pk']}", 'categories']
+        # 一覧・ファセットはカテゴリーで絞り込んでいればそのカテゴリーの変更だけで無効化する
+        category = request.query_params.get('category')
+        return [f'category:{category}'] if category else ['products']
+
+    @action(detail=False)
+    def facets(self, request):
+        """一覧と同じ絞り込み条件での、カテゴリー別・価格帯別・在庫ありの件数"""
+        return self.build_response(request, lambda: Response(get_facets(self.filter_queryset(self.get_queryset()))))
+
+    @action(detail=False, permission_classes=[permissions.IsAdminUser])
+    def export(self, request):
+        """全商品をCSV(既定)またはJSONL(?file_format=jsonl)で返す(少しずつ読みながら送る)"""
+        file_format = request.query_params.get('file_format', 'csv')
+        if file_format not in FORMATS:
+            return Response(
+                {'error': f'file_format は {" / ".join(FORMATS)} のどれかを指定してください'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return export_response(file_format)
@@ -14,15 +14,24 @@ class UserSerializer(serializers.ModelSerializer):
         fields = ('id', 'username', 'email', 'password', 'password2')
 
     def validate(self, attrs):
-        if attrs['password'] != attrs['password2']:
+        if attrs.get('password') != attrs.get('password2'):  # 部分更新(PATCH)では省略できる
             raise serializers.ValidationError({"password": "Password fields didn't match."})
         return attrs
 
     def create(self, validated_data):
-        user = User.objects.create(
+        # パスワードを設定してから保存する(INSERTの後にUPDATEしない)
+        user = User(
             username=validated_data['username'],
             email=validated_data.get('email', '')
         )
         user.set_password(validated_data['password'])
         user.save()
-        return user 
\ No newline at end of file
+        return user
+
+    def update(self, instance, validated_data):
+        # パスワードはハッシュ化して保存する(password2 は確認用でモデルのフィールドではない)
+        validated_data.pop('password2', None)
+        password = validated_data.pop('password', None)
+        if password:
+            instance.set_password(password)
+        return super().update(instance, validated_data)
@@ -6,6 +6,8 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 from django.contrib.auth import get_user_model
 from django.contrib.auth import login as django_login, logout as django_logout
+from carts.guest import merge_guest_cart
+from ec_shop.pagination import IdCursorPagination
 from .serializers import UserSerializer
 
 User = get_user_model()
@@ -14,6 +16,7 @@ class UserViewSet(viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = [permissions.AllowAny]
+    pagination_class = IdCursorPagination
 
     @action(detail=False, methods=['post'])
     def register(self, request):    # ユーザー登録
@@ -21,7 +24,9 @@ class UserViewSet(viewsets.ModelViewSet):
         if serializer.is_valid(): # バリデーションチェック　必須項目が入力されているか
             user = serializer.save() # ユーザーを保存
             django_login(request, user) # ログイン　requestにはフロントから送られたデータが入っている
-            return Response(serializer.data, status=status.HTTP_201_CREATED) # レスポンスを返す
+            response = Response(serializer.data, status=status.HTTP_201_CREATED) # レスポンスを返す
+            merge_guest_cart(request, user, response) # ゲストのカートを引き継ぐ
+            return response
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST) # エラーハンドリング 
 
     @action(detail=False, methods=['post'])
@@ -32,7 +37,9 @@ class UserViewSet(viewsets.ModelViewSet):
             user = User.objects.get(username=username)
             if user.check_password(password):
                 django_login(request, user)
-                return Response(UserSerializer(user).data)
+                response = Response(UserSerializer(user).data)
+                merge_guest_cart(request, user, response) # ゲストのカートを引き継ぐ
+                return response
             return Response({'error': 'Invalid password'}, status=status.HTTP_400_BAD_REQUEST)
         except User.DoesNotExist:
             return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)